@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# VmdReader.py - read VMD motion files written by VmdWriter (or MMD)
+#
+
+import argparse
+import os
+import struct
+import tempfile
+import time
+import numpy as np
+
+from VmdWriter import (BONE_FRAME_DTYPE, VmdBoneFrame, VmdInfoIk, VmdShowIkFrame, VmdWriter,
+                       bone_frame_records)
+
+SIGNATURE = b'Vocaloid Motion Data 0002'
+SIGNATURE_OLD = b'Vocaloid Motion Data file' # モデル名が10Byteの旧形式
+
+# ボーン以外のキーフレーム1件の大きさ(読み飛ばす)
+MORPH_FRAME_SIZE = 23
+CAMERA_FRAME_SIZE = 61
+LIGHT_FRAME_SIZE = 28
+SELF_SHADOW_FRAME_SIZE = 9
+IK_INFO_SIZE = 21
+
+def _unique_names(names):
+    """np.unique(names, return_index=True, return_inverse=True) for S15 names
+
+    バイト列のまま比較すると遅いので、名前を2つの64bit整数にまとめたハッシュで分類し、
+    衝突がないことを確かめてから使う。
+    """
+    raw = np.zeros((len(names), 16), dtype=np.uint8)
+    raw[:, :15] = np.ascontiguousarray(names, dtype='S15').view(np.uint8).reshape(-1, 15)
+    key = raw.view('<u8')
+    h = key[:, 0] * np.uint64(0x9e3779b97f4a7c15) ^ key[:, 1]
+    _, index, inverse = np.unique(h, return_index=True, return_inverse=True)
+    if np.array_equal(names[index][inverse], names):
+        return index, inverse
+    _, index, inverse = np.unique(names, return_index=True, return_inverse=True)
+    return index, inverse
+
+def decode_names(names):
+    """decode ms932 bone names (each distinct name is decoded once)
+
+    名前は最初の\\0までを使う(MMDは\\0の後ろにゴミが残っていることがある)。
+    """
+    names = np.asarray(names).ravel()
+    if not len(names):
+        return np.empty(0, dtype=object)
+    index, inverse = _unique_names(names)
+    decoded = np.array([n.split(b'\0')[0].decode('ms932', errors='replace') for n in names[index].tolist()],
+                       dtype=object)
+    return decoded[inverse.ravel()]
+
+class VmdMotion():
+    """bone and show/IK keyframes of a VMD file
+
+    bone_frames は BONE_FRAME_DTYPE の配列(ファイルをメモリマップしたもの)。
+    各列は names, frames, positions, rotations, interpolations で取り出せる。
+    """
+    def __init__(self, model_name, bone_frames, showik_frames):
+        self.model_name = model_name
+        self.bone_frames = bone_frames
+        self.showik_frames = showik_frames
+
+    @property
+    def names(self):
+        return decode_names(self.bone_frames['name'])
+
+    @property
+    def frames(self):
+        return self.bone_frames['frame']
+
+    @property
+    def positions(self):
+        return self.bone_frames['position']
+
+    @property
+    def rotations(self):
+        return self.bone_frames['rotation']
+
+    @property
+    def interpolations(self):
+        return self.bone_frames['interpolation']
+
+    def bone_frame_objects(self):
+        """bone frames as a list of VmdBoneFrame"""
+        from PyQt6.QtGui import QQuaternion, QVector3D
+        objects = []
+        for name, frame, p, r in zip(self.names.tolist(), self.frames.tolist(),
+                                     self.positions.tolist(), self.rotations.tolist()):
+            bf = VmdBoneFrame()
+            bf.name = name
+            bf.frame = frame
+            bf.position = QVector3D(*p)
+            bf.rotation = QQuaternion(r[3], r[0], r[1], r[2])
+            objects.append(bf)
+        return objects
+
+def read_showik_frames(data, offset, count):
+    frames = []
+    for _ in range(count):
+        sf = VmdShowIkFrame()
+        sf.frame, sf.show, ik_count = struct.unpack_from('<LbL', data, offset)
+        offset += 9
+        for _ in range(ik_count):
+            name, onoff = struct.unpack_from('<20sb', data, offset)
+            offset += IK_INFO_SIZE
+            sf.ik.append(VmdInfoIk(name.split(b'\0')[0].decode('ms932', errors='replace'), onoff))
+        frames.append(sf)
+    return frames, offset
+
+class VmdReader():
+    def __init__(self):
+        pass
+
+    def read_vmd_file(self, filename):
+        """Read VMD data from a file
+
+        ボーンキーフレームはファイルをメモリマップして、コピーせずに配列として参照する。
+        表情、カメラ、照明、セルフ影のキーフレームは読み飛ばす。
+        """
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        signature = bytes(data[:30]).split(b'\0')[0]
+        if signature == SIGNATURE:
+            name_size = 20
+        elif signature == SIGNATURE_OLD:
+            name_size = 10
+        else:
+            raise ValueError('not a VMD file: ' + filename)
+        offset = 30
+        model_name = bytes(data[offset:offset + name_size]).split(b'\0')[0].decode('ms932', errors='replace')
+        offset += name_size
+
+        count, = struct.unpack_from('<L', data, offset)
+        offset += 4
+        if offset + count * BONE_FRAME_DTYPE.itemsize > len(data):
+            raise ValueError('truncated bone frames: ' + filename)
+        bone_frames = np.ndarray(count, dtype=BONE_FRAME_DTYPE, buffer=data, offset=offset)
+        offset += count * BONE_FRAME_DTYPE.itemsize
+
+        # 後ろのセクションは省略されていることがある
+        showik_frames = []
+        for size in (MORPH_FRAME_SIZE, CAMERA_FRAME_SIZE, LIGHT_FRAME_SIZE, SELF_SHADOW_FRAME_SIZE, None):
+            if offset + 4 > len(data):
+                break
+            count, = struct.unpack_from('<L', data, offset)
+            offset += 4
+            if size is None:
+                showik_frames, offset = read_showik_frames(data, offset, count)
+            else:
+                offset += count * size
+        return VmdMotion(model_name, bone_frames, showik_frames)
+
+def _showik_tuples(showik_frames):
+    return [(sf.frame, sf.show, [(ik.name, ik.onoff) for ik in sf.ik]) for sf in showik_frames]
+
+def verify_round_trip(filename, tmp_filename=None):
+    """read filename, write it again with VmdWriter and check that nothing changed
+
+    ボーンフレームはレコード単位で、モデル表示・IKフレームは値で比較する。
+    書き出すファイル(tmp_filename)を省略すると一時ファイルに書き出し、比較した後に削除する。
+    """
+    motion = VmdReader().read_vmd_file(filename)
+    remove = tmp_filename is None
+    if remove:
+        fd, tmp_filename = tempfile.mkstemp(suffix='.vmd')
+        os.close(fd)
+    try:
+        records = bone_frame_records(motion.bone_frames['name'], motion.frames, motion.positions,
+                                     motion.rotations, motion.interpolations)
+        VmdWriter().write_vmd_file(tmp_filename, records, motion.showik_frames)
+        again = VmdReader().read_vmd_file(tmp_filename)
+        same = (np.array_equal(motion.bone_frames, again.bone_frames) and
+                _showik_tuples(motion.showik_frames) == _showik_tuples(again.showik_frames))
+        # メモリマップを閉じてから削除する
+        del again
+        return same
+    finally:
+        if remove:
+            os.remove(tmp_filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print a summary of VMD files')
+    parser.add_argument('--verify', action='store_true',
+                        help='write each file again with VmdWriter to a temporary file and compare')
+    parser.add_argument('VMD_FILE', nargs='+')
+
+    arg = parser.parse_args()
+    for filename in arg.VMD_FILE:
+        t = time.perf_counter()
+        motion = VmdReader().read_vmd_file(filename)
+        names = motion.names
+        elapsed = time.perf_counter() - t
+        print('%s: %d bone frames (%d bones, frames %d-%d), %d show/IK frames, %.3fs' % (
+            filename, len(motion.bone_frames), len(set(names.tolist())),
+            motion.frames.min() if len(motion.frames) else 0,
+            motion.frames.max() if len(motion.frames) else 0,
+            len(motion.showik_frames), elapsed))
+        if arg.verify:
+            print('round trip: ' + ('ok' if verify_round_trip(filename) else 'MISMATCH'))
+
+    # ex)
+    # python3 applications/VmdReader.py --verify applications/debug/test.vmd
@@ -1,29 +1,72 @@
 # -*- coding: utf-8 -*-
 
 import struct
-from PyQt6.QtGui import QQuaternion, QVector3D
+import numpy as np
+
+# ボーンキーフレーム1件(111Byte)のレイアウト
+BONE_FRAME_DTYPE = np.dtype([
+    ('name', 'S15'),                   # ボーン名
+    ('frame', '<u4'),                  # フレーム番号
+    ('position', '<f4', (3,)),         # 位置
+    ('rotation', '<f4', (4,)),         # 回転 (x, y, z, w)
+    ('interpolation', 'u1', (64,)),    # 補間パラメータ
+])
+
+def encode_names(names):
+    """encode bone names to ms932 bytes (each distinct name is encoded once)"""
+    names = np.asarray(names)
+    if names.dtype.kind == 'S':
+        return names
+    uniq, inverse = np.unique(names, return_inverse=True)
+    encoded = np.array([n.encode('ms932') for n in uniq.tolist()], dtype='S15')
+    return encoded[inverse.reshape(names.shape)]
+
+def bone_frame_records(names, frames, positions=None, rotations=None, interpolations=None):
+    """build bone frame records from column arrays
+
+    positions (N, 3), rotations (N, 4) (x, y, z, w), interpolations (N, 64) は省略すると0で埋める。
+    """
+    names = encode_names(names)
+    records = np.zeros(len(names), dtype=BONE_FRAME_DTYPE)
+    records['name'] = names
+    records['frame'] = frames
+    if positions is not None:
+        records['position'] = positions
+    if rotations is not None:
+        records['rotation'] = rotations
+    else:
+        records['rotation'][:, 3] = 1
+    if interpolations is not None:
+        records['interpolation'] = interpolations
+    return records
+
+def write_bone_frames(fout, records):
+    """write bone frame records in one call"""
+    fout.write(np.ascontiguousarray(records, dtype=BONE_FRAME_DTYPE).data)
 
 class VmdBoneFrame():
     def __init__(self):
+        # レコードの配列を書き出すだけならPyQt6は不要なので、ここでimportする
+        from PyQt6.QtGui import QQuaternion, QVector3D
         self.name = ''
         self.frame = 0
         self.position = QVector3D(0, 0, 0)
         self.rotation = QQuaternion()
 
     def write(self, fout):
-        name = self.name.encode('ms932')
-        fout.write(name)
-        fout.write(bytearray([0 for i in range(len(name), 15)])) # ボーン名15Byteの残りを\0で埋める
-        fout.write(struct.pack('<L', self.frame))
-        fout.write(struct.pack('<f', self.position.x()))
-        fout.write(struct.pack('<f', self.position.y()))
-        fout.write(struct.pack('<f', self.position.z()))
-        v = self.rotation.toVector4D()
-        fout.write(struct.pack('<f', v.x()))
-        fout.write(struct.pack('<f', v.y()))
-        fout.write(struct.pack('<f', v.z()))
-        fout.write(struct.pack('<f', v.w()))
-        fout.write(bytearray([0 for i in range(0, 64)])) # 補間パラメータ(64Byte)
+        write_bone_frames(fout, bone_frames_to_records([self]))
+
+def bone_frames_to_records(bone_frames):
+    """convert a list of VmdBoneFrame to bone frame records"""
+    positions = np.empty((len(bone_frames), 3))
+    rotations = np.empty((len(bone_frames), 4))
+    for i, bf in enumerate(bone_frames):
+        positions[i] = (bf.position.x(), bf.position.y(), bf.position.z())
+        v = bf.rotation.toVector4D()
+        rotations[i] = (v.x(), v.y(), v.z(), v.w())
+    return bone_frame_records([bf.name for bf in bone_frames],
+                              [bf.frame for bf in bone_frames],
+                              positions, rotations)
 
 class VmdInfoIk():
     def __init__(self, name='', onoff=0):
@@ -46,25 +89,74 @@ class VmdShowIkFrame():
             fout.write(bytearray([0 for i in range(len(name), 20)])) # IKボーン名20Byteの残りを\0で埋める
             fout.write(struct.pack('b', k.onoff))
         
+def write_header(fout, bone_frame_count):
+    fout.write(b'Vocaloid Motion Data 0002\x00\x00\x00\x00\x00')
+    fout.write(b'Dummy Model Name    ')
+    fout.write(struct.pack('<L', bone_frame_count)) # ボーンフレーム数
+
+def write_footer(fout, showik_frames):
+    fout.write(struct.pack('<L', 0)) # 表情キーフレーム数
+    fout.write(struct.pack('<L', 0)) # カメラキーフレーム数
+    fout.write(struct.pack('<L', 0)) # 照明キーフレーム数
+    fout.write(struct.pack('<L', 0)) # セルフ影キーフレーム数
+    fout.write(struct.pack('<L', len(showik_frames))) # モデル表示・IK on/offキーフレーム数
+    for sf in showik_frames:
+        sf.write(fout)
+
 class VmdWriter():
     def __init__(self):
         pass
 
     def write_vmd_file(self, filename, bone_frames, showik_frames):
-        """Write VMD data to a file"""
+        """Write VMD data to a file
+
+        bone_frames は VmdBoneFrame のリスト、または BONE_FRAME_DTYPE の配列
+        """
+        if not isinstance(bone_frames, np.ndarray):
+            bone_frames = bone_frames_to_records(bone_frames)
         fout = open(filename, 'wb')
-        # header
-        fout.write(b'Vocaloid Motion Data 0002\x00\x00\x00\x00\x00')
-        fout.write(b'Dummy Model Name    ')
-        # bone frames
-        fout.write(struct.pack('<L', len(bone_frames))) # ボーンフレーム数
-        for bf in bone_frames:
-            bf.write(fout)
-        fout.write(struct.pack('<L', 0)) # 表情キーフレーム数
-        fout.write(struct.pack('<L', 0)) # カメラキーフレーム数
-        fout.write(struct.pack('<L', 0)) # 照明キーフレーム数
-        fout.write(struct.pack('<L', 0)) # セルフ影キーフレーム数
-        fout.write(struct.pack('<L', len(showik_frames))) # モデル表示・IK on/offキーフレーム数
-        for sf in showik_frames:
-            sf.write(fout)
+        write_header(fout, len(bone_frames))
+        write_bone_frames(fout, bone_frames)
+        write_footer(fout, showik_frames)
         fout.close()
+
+class VmdStreamWriter():
+    """Write bone frames to a VMD file incrementally
+
+    ボーンフレーム数はヘッダに後から書き戻す。途中で異常終了しても、
+    それまでに書き込んだボーンフレームはファイルに残る。
+    """
+    COUNT_OFFSET = 50 # ヘッダ中のボーンフレーム数の位置
+
+    def __init__(self, filename):
+        self.fout = open(filename, 'wb')
+        self.count = 0
+        write_header(self.fout, 0)
+
+    def write_bone_frames(self, bone_frames):
+        if not isinstance(bone_frames, np.ndarray):
+            bone_frames = bone_frames_to_records(bone_frames)
+        if not len(bone_frames):
+            return
+        write_bone_frames(self.fout, bone_frames)
+        self.count += len(bone_frames)
+        self._patch_count()
+
+    def _patch_count(self):
+        end = self.fout.tell()
+        self.fout.seek(self.COUNT_OFFSET)
+        self.fout.write(struct.pack('<L', self.count))
+        self.fout.seek(end)
+        self.fout.flush()
+
+    def close(self, showik_frames):
+        write_footer(self.fout, showik_frames)
+        self._patch_count()
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.fout.closed:
+            self.fout.close()
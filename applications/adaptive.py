@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# adaptive.py - adaptive inference: frame skipping and ROI crops around the subject
+#
+
+import argparse
+import time
+import types
+import numpy as np
+
+import posisions as ps
+
+class AdaptiveSettings():
+    """settings of the adaptive inference mode
+
+    step: step フレームごとに推定する(間のフレームはデコードもしない)。
+    motion_threshold: 指定すると全フレームをデコードし、前回推定したフレームとの差
+        (縮小した輝度画像の平均絶対差、0〜255)がこれを超えるか、stepフレーム経ったときに推定する。
+    roi_size: 指定すると、前のフレームのランドマークを囲む範囲を切り出し、
+        長辺がroi_sizeピクセル以下になるよう縮小してから推定する。
+    """
+    def __init__(self, step=1, motion_threshold=None, roi_size=None, margin=0.3):
+        self.step = max(int(step), 1)
+        self.motion_threshold = motion_threshold
+        self.roi_size = roi_size
+        self.margin = margin
+
+    @property
+    def enabled(self):
+        return self.step > 1 or self.motion_threshold is not None or self.roi_size is not None
+
+    def key(self):
+        """string identifying the settings (part of the landmark cache key)"""
+        if not self.enabled:
+            return ''
+        return 'step=%d,motion=%s,roi=%s,margin=%s' % (self.step, self.motion_threshold,
+                                                        self.roi_size, self.margin)
+
+def thumbnail(image, size=(64, 36)):
+    """small grayscale image used to measure motion between frames"""
+    import cv2
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def select_frames(frames, step, motion_threshold):
+    """pass through the frames that have moved more than motion_threshold since the last passed one
+
+    stepフレーム以上動きがない場合も通す。
+    """
+    last_frame = None
+    last_thumb = None
+    for frame_num, image in frames:
+        thumb = thumbnail(image)
+        if (last_thumb is None or frame_num - last_frame >= step or
+                np.mean(np.abs(thumb - last_thumb)) > motion_threshold):
+            last_frame = frame_num
+            last_thumb = thumb
+            yield frame_num, image
+
+def landmark_bbox(pose_2d):
+    """bounding box (x0, y0, x1, y1) of all poses in normalized image coordinates"""
+    points = np.array([(l.x, l.y) for pose in pose_2d for l in pose])
+    return np.concatenate([points.min(axis=0), points.max(axis=0)])
+
+def crop_region(bbox, width, height, margin):
+    """square pixel region (x0, y0, x1, y1) around bbox enlarged by margin, clipped to the image"""
+    cx = (bbox[0] + bbox[2]) / 2 * width
+    cy = (bbox[1] + bbox[3]) / 2 * height
+    size = max((bbox[2] - bbox[0]) * width, (bbox[3] - bbox[1]) * height) * (1 + 2 * margin)
+    x0 = int(max(cx - size / 2, 0))
+    y0 = int(max(cy - size / 2, 0))
+    x1 = int(min(cx + size / 2, width))
+    y1 = int(min(cy + size / 2, height))
+    if x1 - x0 < 16 or y1 - y0 < 16:
+        return 0, 0, width, height
+    return x0, y0, x1, y1
+
+def downscale(image, max_size):
+    import cv2
+    h, w = image.shape[:2]
+    scale = max_size / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+
+class RoiLandmarker():
+    """run a VIDEO mode landmarker on a crop around the previous frame's landmarks
+
+    切り出した画像上の正規化座標を元の画像の正規化座標に戻して返す。
+    (zは画像の幅を基準とした値なので、幅の比率で換算する)
+    検出できなかった場合、次のフレームは画像全体で推定する。
+    """
+    def __init__(self, landmarker, max_size=640, margin=0.3):
+        self.landmarker = landmarker
+        self.max_size = max_size
+        self.margin = margin
+        self.bbox = None
+
+    def detect_for_video(self, mp_image, timestamp_ms):
+        import mediapipe as mp
+        image = mp_image.numpy_view()
+        height, width = image.shape[:2]
+        if self.bbox is None:
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            x0, y0, x1, y1 = crop_region(self.bbox, width, height, self.margin)
+        crop = np.ascontiguousarray(downscale(image[y0:y1, x0:x1], self.max_size))
+        result = self.landmarker.detect_for_video(mp.Image(image_format=mp.ImageFormat.SRGB, data=crop),
+                                                  timestamp_ms)
+        if not result.pose_landmarks:
+            self.bbox = None
+            return result
+
+        sx = (x1 - x0) / width
+        sy = (y1 - y0) / height
+        pose_2d = [[ps.Landmark(x0 / width + l.x * sx, y0 / height + l.y * sy, l.z * sx, l.visibility)
+                    for l in pose] for pose in result.pose_landmarks]
+        self.bbox = np.clip(landmark_bbox(pose_2d), 0, 1)
+        return types.SimpleNamespace(pose_landmarks=pose_2d,
+                                     pose_world_landmarks=result.pose_world_landmarks)
+
+def evaluate(video, settings, queue_depth=0):
+    """compare adaptive inference with full inference on a video
+
+    全フレームを推定した場合に対する処理時間の比と、補間後の関節位置(ワールド座標)の誤差、
+    ボーンの回転の誤差を返す。
+    """
+    import vmd_mediapipe as vm
+    import pos2vmd
+    import quaternions as qt
+    import timeline
+
+    results = {}
+    for name, s in (('full', None), ('adaptive', settings)):
+        stats = vm.PipelineStats()
+        t = time.perf_counter()
+        frame_nums, world, _ = vm.detect_landmarks(video, queue_depth, stats, adaptive=s)
+        results[name] = (time.perf_counter() - t, frame_nums, world, stats.info.get('fps'))
+
+    full_time, full_frames, full_world, fps = results['full']
+    adaptive_time, adaptive_frames, adaptive_world, _ = results['adaptive']
+    line = timeline.Timeline(full_frames, fps)
+    # 全フレーム推定で検出できたフレームで比較する
+    reference = ps.world_points(full_world)
+    adaptive_line = timeline.Timeline(adaptive_frames, fps)
+    points = ps.interpolate(adaptive_line.scatter(ps.world_points(adaptive_world)))
+    index = np.clip(full_frames, 0, len(points) - 1)
+    points = points[index]
+    joint_error = np.linalg.norm(points - reference, axis=-1)
+    angle = np.degrees(qt.angle_between(pos2vmd.positions_to_rotations(points),
+                                        pos2vmd.positions_to_rotations(reference)))
+    return {
+        'frames': len(line),
+        'full_seconds': full_time,
+        'adaptive_seconds': adaptive_time,
+        'speedup': full_time / adaptive_time if adaptive_time else 0.0,
+        'inferred': len(adaptive_frames),
+        'joint_error_mean': float(joint_error.mean()),
+        'joint_error_max': float(joint_error.max()),
+        'rotation_error_mean': float(angle.mean()),
+        'rotation_error_max': float(angle.max()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare adaptive inference with full inference')
+    parser.add_argument('--step', type=int, default=2, help='infer every STEP frames')
+    parser.add_argument('--motion', type=float, default=None, help='motion threshold (0-255)')
+    parser.add_argument('--roi', type=int, default=None, help='crop around the subject and downscale to ROI pixels')
+    parser.add_argument('VIDEO', nargs='+')
+
+    arg = parser.parse_args()
+    settings = AdaptiveSettings(arg.step, arg.motion, arg.roi)
+    for video in arg.VIDEO:
+        r = evaluate(video, settings)
+        print('%s: %d frames, %d inferred, %.1fs -> %.1fs (%.2fx), '
+              'joint error mean %.4f max %.4f, rotation error mean %.2f max %.2f deg' % (
+                  video, r['frames'], r['inferred'], r['full_seconds'], r['adaptive_seconds'], r['speedup'],
+                  r['joint_error_mean'], r['joint_error_max'],
+                  r['rotation_error_mean'], r['rotation_error_max']))
+
+    # ex)
+    # python3 applications/adaptive.py --step 2 --roi 512 applications/debug/sample.mp4
@@ -1,56 +1,131 @@
-# adjust_center.py - adjust center position
+# adjust_center.py - root motion (center bone positions) from the 2D and 3D landmarks by PnP
 
 import numpy as np
-import cv2
-from PyQt6.QtGui import QVector3D
-
-center_idx = 7
-idx_2d = [0, 1, 2, 3, 4, 5, 6, 7]
-idx_3d = [10, 8, 14, 15, 16, 11, 12, 13]
-camera_position = QVector3D(0, 0, -3600)
-
-def adjust_center(positions_2d, positions_3d, image):
-    # print(positions_2d)
-    p2dlist = []
-    # TODO: Multi person support
-    p = positions_2d[0]
-    for k in idx_2d:
-        p2dlist.append((p[k, 1], p[k, 0]))
-
-    p2d = np.array(p2dlist, dtype='double')
-    print('p2d: ', p2d)
-    
-    p3dlist = []
-    for k in idx_3d:
-        p = QVector3D(positions_3d[k])
-        p -= positions_3d[center_idx] # 胴体の中心を原点(0, 0, 0)とする
-        p3dlist.append((p.x(), -p.y(), p.z()))
-
-    p3d = np.array(p3dlist, dtype='double')
-    print('p3d: ', p3d)
-    
-    focal_length = max([image.shape[0], image.shape[1]])
-    camera = np.array([[focal_length, 0, image.shape[1] / 2],
-                       [0, focal_length, image.shape[0] / 2],
-                       [0, 0, 1]], dtype = 'double')
-    distortion = np.zeros((4, 1))
-    #retval, rot_vec, trans_vec = cv2.solvePnP(p3d, p2d, camera, distortion,
-    #                                              flags = cv2.SOLVEPNP_ITERATIVE)
-    retval, rot_vec, trans_vec, inliers = cv2.solvePnPRansac(p3d, p2d, camera, distortion)
-    
-    center = QVector3D(trans_vec[0], trans_vec[1], trans_vec[2])
-    if trans_vec[2] < 0:
-        center = -center
-
-    rot_mat = cv2.Rodrigues(rot_vec)[0]
-    proj_mat = np.array([[rot_mat[0][0], rot_mat[0][1], rot_mat[0][2], 0],
-                         [rot_mat[1][0], rot_mat[1][1], rot_mat[1][2], 0],
-                         [rot_mat[2][0], rot_mat[2][1], rot_mat[2][2], 0]], dtype='double')
-    eulerAngles = cv2.decomposeProjectionMatrix(proj_mat)[6]
-    print('eulerAngles: \n', eulerAngles)
-    print('trans_vec: ', trans_vec)
-    print('center: ', center)
-    offset = center - positions_3d[center_idx] + camera_position
-    for i in range(len(positions_3d)):
-        positions_3d[i] += offset
+import posisions as ps
 
+# MMDの1単位は約8cm
+METERS_TO_MMD = 12.5
+
+# 並進の推定に使う関節 (顔と手の指を除いた肩から足先まで)
+ROOT_JOINTS = [11, 12, 13, 14, 15, 16, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32]
+
+# 焦点距離の候補 (画像の幅に対する比、水平画角 約90度〜約19度)
+FOCAL_CANDIDATES = np.geomspace(0.5, 3.0, 25)
+
+DEFAULT_ASPECT = 16 / 9
+
+def _camera_points(world, image, aspect):
+    """joint positions in camera axes (N, J, 3) and image points (N, J, 2) in units of the image width
+
+    MediaPipeのワールド座標は腰の中心が原点で、軸の向きはカメラと同じ(xが右、yが下、zが奥)。
+    画像上の座標は幅、高さで正規化されているので、幅を1とした座標に直す。
+    """
+    points = np.asarray(world, dtype=np.float64)[:, ROOT_JOINTS, :3]
+    uv = np.asarray(image, dtype=np.float64)[:, ROOT_JOINTS, :2] * [1.0, 1.0 / aspect]
+    return points, uv
+
+def solve_translations(points, uv, weights, focal, aspect):
+    """camera relative translation (N, 3) of the hip centre for all frames in one pass
+
+    回転を固定(MediaPipeのワールド座標の向き)すると、透視投影
+        u = f (X + tx) / (Z + tz) + cu
+    は並進について線形になるので、フレームごとの3x3の正規方程式をまとめて解く。
+    weights (N, J) は各関節のvisibility。
+    """
+    c = np.array([0.5, 0.5 / aspect])
+    ab = uv - c                       # (N, J, 2)
+    w = weights[..., None]
+    rhs = ab * points[..., 2:3] - focal * points[..., :2]   # (N, J, 2)
+    sw = weights.sum(axis=1)
+    ata = np.zeros((len(points), 3, 3))
+    ata[:, 0, 0] = ata[:, 1, 1] = focal * focal * sw
+    ata[:, :2, 2] = ata[:, 2, :2] = -focal * (w * ab).sum(axis=1)
+    ata[:, 2, 2] = (w * ab * ab).sum(axis=(1, 2))
+    atb = np.empty((len(points), 3))
+    atb[:, :2] = focal * (w * rhs).sum(axis=1)
+    atb[:, 2] = -(w * ab * rhs).sum(axis=(1, 2))
+    return np.linalg.solve(ata, atb[..., None])[..., 0]
+
+def reprojection_errors(points, uv, weights, translations, focal, aspect):
+    """weighted RMS reprojection error of each frame (in units of the image width)"""
+    c = np.array([0.5, 0.5 / aspect])
+    p = points + translations[:, None]
+    z = np.maximum(p[..., 2:3], 1e-6)
+    diff = focal * p[..., :2] / z + c - uv
+    return np.sqrt((weights * (diff ** 2).sum(axis=-1)).sum(axis=1) / weights.sum(axis=1))
+
+def estimate_focal(points, uv, weights, aspect, candidates=FOCAL_CANDIDATES):
+    """focal length (in units of the image width) shared by all frames
+
+    候補ごとに全フレームの並進を解き、再投影誤差の中央値が最小のものを選ぶ。
+    最小の候補の両隣の間をもう一度細かく探す。
+    """
+    def search(candidates):
+        errors = []
+        for focal in candidates:
+            t = solve_translations(points, uv, weights, focal, aspect)
+            errors.append(np.median(reprojection_errors(points, uv, weights, t, focal, aspect)))
+        return int(np.argmin(errors))
+
+    candidates = np.asarray(candidates)
+    k = search(candidates)
+    fine = np.geomspace(candidates[max(k - 1, 0)], candidates[min(k + 1, len(candidates) - 1)], 9)
+    return fine[search(fine)]
+
+def refine_outliers(points, uv, translations, errors, focal, aspect, factor=3.0, min_error=0.01):
+    """solve the frames with large reprojection errors again by RANSAC PnP (cv2.solvePnPRansac)
+
+    回転も未知として、線形解を初期値に外れた関節を除いて解き直す。
+    中央値のfactor倍(かつmin_error)より誤差が大きいフレームのみを対象とする。戻り値は解き直したフレーム数。
+    """
+    outliers = np.flatnonzero(errors > max(np.median(errors) * factor, min_error))
+    if not len(outliers):
+        return 0
+    import cv2
+    camera = np.array([[focal, 0, 0.5], [0, focal, 0.5 / aspect], [0, 0, 1]])
+    refined = 0
+    for i in outliers:
+        tvec = translations[i].reshape(3, 1).copy()
+        ok, rvec, tvec, inliers = cv2.solvePnPRansac(points[i], uv[i], camera, None, np.zeros((3, 1)), tvec,
+                                                     useExtrinsicGuess=True, reprojectionError=min_error)
+        if ok and inliers is not None and tvec[2, 0] > 0:
+            translations[i] = tvec[:, 0]
+            refined += 1
+    return refined
+
+def root_motion(world, image, visibility=None, aspect=None, focal=None, smoothing='savgol', stats=None, fps=None):
+    """center bone positions (N, 3) in MMD units from landmark arrays on a timeline
+
+    world (N, 33, 3 or 4) はMediaPipeのワールド座標、image (N, 33, 2 or 4) は画像上の座標、
+    検出できなかったフレームはNaN。最初の有効なフレームの位置を原点とした腰の移動量を返す。
+    aspect は画像の幅/高さ、focal は幅に対する焦点距離(省略すると全フレームから推定する)。
+    欠損したフレームは補間し、smoothing(posisions.FILTERS)で平滑化する。(fps はタイムラインのフレームレート)
+    """
+    world = np.asarray(world)
+    n = len(world)
+    centers = np.zeros((n, 3))
+    valid = ~np.isnan(world[..., :3]).any(axis=(1, 2)) & ~np.isnan(np.asarray(image)[..., :2]).any(axis=(1, 2))
+    if not valid.any():
+        return centers
+    if not aspect:
+        aspect = DEFAULT_ASPECT
+    points, uv = _camera_points(world[valid], np.asarray(image)[valid], aspect)
+    if visibility is None:
+        weights = np.ones(points.shape[:2])
+    else:
+        weights = np.clip(np.asarray(visibility, dtype=np.float64)[valid][:, ROOT_JOINTS], 1e-3, 1.0)
+
+    if focal is None:
+        focal = estimate_focal(points, uv, weights, aspect)
+    translations = solve_translations(points, uv, weights, focal, aspect)
+    errors = reprojection_errors(points, uv, weights, translations, focal, aspect)
+    refined = refine_outliers(points, uv, translations, errors, focal, aspect)
+    if stats is not None:
+        stats.info.update(focal=float(focal), reprojection_error=float(np.median(errors)), pnp_refined=refined)
+
+    t = np.full((n, 3), np.nan)
+    t[valid] = translations
+    t = ps.smooth_array(t, smoothing, fps)
+    # カメラの軸(yが下、zが奥)からMMDの軸(yが上、zが奥)へ
+    centers = (t - t[np.argmax(valid)]) * [METERS_TO_MMD, -METERS_TO_MMD, METERS_TO_MMD]
+    return centers
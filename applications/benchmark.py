@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+#
+# benchmark.py - measure throughput and memory of each pipeline stage on synthetic landmarks
+#
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+import posisions as ps
+import pos2vmd
+import keyframes
+import adjust_center
+import foot_contact
+import landmark_cache
+from VmdReader import VmdReader
+from VmdWriter import VmdWriter, bone_frame_records
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+PROJECT_PATH = os.path.realpath(DIR_PATH + '/..')
+E2E_IMAGE = os.path.join(PROJECT_PATH, 'data/images/test_image.png')
+
+# -----------------------------------------------------------------
+# 合成データ
+def synthetic_points(frames, seed=0, missing=0.05):
+    """random walk landmarks (frames, 33, 3) with missing frames set to NaN"""
+    rng = np.random.default_rng(seed)
+    points = np.cumsum(rng.normal(scale=0.01, size=(frames, len(ps.NAMES), 3)), axis=0)
+    points[rng.random(frames) < missing] = np.nan
+    return points
+
+def synthetic_landmarks(frames, seed=0, missing=0.05, max_gap=10):
+    """MediaPipe shaped landmarks (world, image) of (frames, 33, 4) with x, y, z, visibility
+
+    ワールド座標は腰を中心とした姿勢(メートル)に揺れを加えたもの、画像上の座標は0〜1。
+    missingの割合のフレームが、長さ1〜max_gapの区間ごとに欠損(NaN)になる。
+    同じseedからは同じデータができる。
+    """
+    rng = np.random.default_rng(seed)
+    rest = rng.uniform(-0.3, 0.3, size=(len(ps.NAMES), 3))
+    rest[:, 1] = np.linspace(0.8, -0.7, len(ps.NAMES)) # 頭が上、足が下
+    t = np.arange(frames)[:, None, None] / 30
+    freq = rng.uniform(0.2, 2.0, size=(1, len(ps.NAMES), 3))
+    phase = rng.uniform(0, 2 * np.pi, size=(1, len(ps.NAMES), 3))
+    xyz = (rest + 0.1 * np.sin(2 * np.pi * freq * t + phase) +
+           rng.normal(scale=0.005, size=(frames, len(ps.NAMES), 3)))
+
+    world = np.empty((frames, len(ps.NAMES), 4), dtype=np.float32)
+    world[..., :3] = xyz * [1, -1, 1] # MediaPipeのyは下向き
+    world[..., 3] = rng.uniform(0.5, 1.0, size=(frames, len(ps.NAMES)))
+    image = world.copy()
+    image[..., 0] = 0.5 + xyz[..., 0] / 2
+    image[..., 1] = 0.5 - xyz[..., 1] / 2
+
+    remaining = int(frames * missing)
+    while remaining > 0:
+        length = min(int(rng.integers(1, max_gap + 1)), remaining)
+        start = int(rng.integers(0, max(frames - length, 1)))
+        world[start:start + length] = np.nan
+        image[start:start + length] = np.nan
+        remaining -= length
+    return world, image
+
+def synthetic_hands(world, seed=0, missing=0.2):
+    """hand world landmarks (frames, 2, 21, 3) of the left and right hands (for the hand bones)
+
+    初期姿勢の手の指を曲げ伸ばしし、手首の向きを揺らしたもの(MediaPipeの軸、メートル)。
+    ポーズを検出できなかったフレームと、missingの割合のフレームの手はNaN。
+    """
+    rng = np.random.default_rng(seed)
+    frames = len(world)
+    rest = pos2vmd._rest_hand()
+    t = np.arange(frames)[:, None] / 30
+    hands = np.empty((frames, 2, len(ps.HAND_NAMES), 3))
+    for side, sx in enumerate([1, -1]):
+        hand = np.broadcast_to(rest * [sx, 1, 1], (frames,) + rest.shape).copy()
+        # 指先ほど大きく、手のひらの向き(手首からの方向と垂直)に曲げる
+        curl = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(0.2, 1.0) * t)
+        bend = np.array([0, 0, 0.3, 0.6, 1.0] + [0, 0.3, 0.6, 1.0] * 4)
+        hand += curl[:, :, None] * bend[None, :, None] * [-0.02 * sx, -0.02, 0]
+        hand += rng.normal(scale=0.002, size=hand.shape)
+        hands[:, side] = hand * [1, -1, 1] # MediaPipeのyは下向き
+    hands[rng.random((frames, 2)) < missing] = np.nan
+    hands[np.isnan(world).any(axis=(1, 2))] = np.nan
+    return hands.astype(np.float32)
+
+def synthetic_walk(frames, seed=0, fps=30, speed=1.2, period=1.0):
+    """world points (frames, 33, 3) of walking feet and center positions (frames, 3) (for foot contact)
+
+    ワールド座標は world_points と同じ(メートル、yが上、腰が原点)。
+    腰は speed (メートル/秒) で z の方向に進み、各足は周期periodの60%の間接地して、残りの間に足を上げて前に出す。
+    """
+    rng = np.random.default_rng(seed)
+    points = np.broadcast_to(np.stack([np.zeros(len(ps.NAMES)), np.linspace(0.8, -0.7, len(ps.NAMES)),
+                                       np.zeros(len(ps.NAMES))], axis=-1), (frames, len(ps.NAMES), 3)).copy()
+    t = np.arange(frames) / fps
+    stride = speed * period * 0.6
+    # 膝、足首、かかと、つま先の腰からの高さと前後の位置
+    leg = {'knee': (-0.45, 0.0), 'ankle': (-0.85, 0.0), 'heel': (-0.92, -0.05), 'foot_index': (-0.92, 0.15)}
+    for side, sx, offset in (('left', 1, 0.0), ('right', -1, 0.5)):
+        phase = (t / period + offset) % 1
+        stance = phase < 0.6
+        z = np.where(stance, stride / 2 - speed * period * phase, -stride / 2 + stride * (phase - 0.6) / 0.4)
+        lift = np.where(stance, 0, 0.1 * np.sin(np.pi * (phase - 0.6) / 0.4))
+        for joint, (y, dz) in leg.items():
+            j = ps.Joint[(side + '_' + joint).upper()]
+            points[:, j] = np.stack([np.full(frames, 0.1 * sx), y + lift * (0.5 if joint == 'knee' else 1),
+                                     z * (0.5 if joint == 'knee' else 1) + dz], axis=-1)
+    points += rng.normal(scale=0.002, size=points.shape)
+    root = np.stack([np.zeros(frames), np.zeros(frames), t * speed * adjust_center.METERS_TO_MMD], axis=-1)
+    return points, root
+
+def project_landmarks(world, focal=1.2, aspect=16 / 9, seed=0):
+    """image landmarks of world landmarks moving around in front of a camera (for root motion)
+
+    腰の位置を奥行き3〜5mの範囲で動かし、焦点距離focal(画像の幅に対する比)で投影する。
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(len(world))[:, None] / 30
+    freq = rng.uniform(0.05, 0.3, size=(1, 3))
+    translations = np.sin(2 * np.pi * freq * t) * [0.5, 0.1, 1.0] + [0, 0, 4]
+    p = world[..., :3] + translations[:, None]
+    image = np.array(world)
+    image[..., 0] = focal * p[..., 0] / p[..., 2] + 0.5
+    image[..., 1] = (focal * p[..., 1] / p[..., 2]) * aspect + 0.5
+    image[..., :2] += rng.normal(scale=0.002, size=image[..., :2].shape)
+    return image
+
+def synthetic_vmd(filename, frames, bones=11):
+    """write a VMD file with frames * bones bone keyframes"""
+    rng = np.random.default_rng(0)
+    count = frames * bones
+    names = np.array(['bone%d' % i for i in range(bones)])[np.arange(count) % bones]
+    rotations = rng.normal(size=(count, 4))
+    rotations /= np.linalg.norm(rotations, axis=1, keepdims=True)
+    records = bone_frame_records(names, np.arange(count) // bones, rotations=rotations)
+    VmdWriter().write_vmd_file(filename, records, [])
+    return filename
+
+class Fixture():
+    """inputs of the cases for a number of frames, built on first use"""
+    def __init__(self, frames, tmpdir):
+        self.frames = frames
+        self.tmpdir = tmpdir
+        self._cache = {}
+
+    def get(self, name):
+        if name not in self._cache:
+            self._cache[name] = getattr(self, '_make_' + name)()
+        return self._cache[name]
+
+    def _make_points(self):
+        return synthetic_points(self.frames)
+
+    def _make_filled(self):
+        return ps.interpolate(self.get('points'))
+
+    def _make_landmarks(self):
+        return synthetic_landmarks(self.frames)
+
+    def _make_filled_landmarks(self):
+        world, image = self.get('landmarks')
+        return ps.interpolate(world).astype(np.float32), ps.interpolate(image).astype(np.float32)
+
+    def _make_positions(self):
+        return ps.arrays_to_positions(*self.get('filled_landmarks'))
+
+    def _make_projected(self):
+        world = self.get('landmarks')[0]
+        return world, project_landmarks(world)
+
+    def _make_hands(self):
+        return synthetic_hands(self.get('landmarks')[0])
+
+    def _make_walk(self):
+        return synthetic_walk(self.frames)
+
+    def _make_sequence(self):
+        return ps.PoseSequence.from_arrays(*self.get('landmarks'))
+
+    def _make_rotations(self):
+        return pos2vmd.positions_to_rotations(ps.world_points(self.get('filled_landmarks')[0]))
+
+    def _make_records(self):
+        return pos2vmd.rotations_to_records(self.get('rotations'), range(self.frames))
+
+    def _make_recording(self):
+        world, image = self.get('landmarks')
+        valid = ~np.isnan(world).any(axis=(1, 2))
+        path = os.path.join(self.tmpdir, 'recording.npz')
+        landmark_cache.write_landmarks(path, np.flatnonzero(valid), world[valid], image[valid], 30)
+        return path
+
+    def _make_vmd(self):
+        return synthetic_vmd(os.path.join(self.tmpdir, 'bench.vmd'), self.frames)
+
+def copy_positions(positions_list):
+    """copy a positions list (smooth_position and normalize_for_vmd modify it)"""
+    return [{'position': {k: type(v)(v) for k, v in info['position'].items()},
+             'extends': dict(info['extends'])} for info in positions_list]
+
+# -----------------------------------------------------------------
+# 計測するケース
+def bench_interpolate(points):
+    ps.interpolate(points)
+
+def bench_lowpass(points):
+    ps.lowpass_filter(points)
+
+def bench_savgol(points):
+    ps.savgol_filter(points)
+
+def bench_oneeuro(points):
+    ps.one_euro_filter(points)
+
+def bench_convert(world, image):
+    ps.arrays_to_positions(world, image)
+
+def bench_smooth_position(positions_list):
+    ps.smooth_position(positions_list)
+
+def bench_normalize_for_vmd(positions_list):
+    ps.normalize_for_vmd(positions_list)
+
+def bench_positions_to_frames(positions_list):
+    for frame_num, info in enumerate(positions_list):
+        pos2vmd.positions_to_frames(info['position'], frame_num)
+
+def bench_positions_to_rotations(points):
+    pos2vmd.positions_to_rotations(points)
+
+def bench_rotations_to_records(rotations):
+    pos2vmd.rotations_to_records(rotations, range(len(rotations)))
+
+def bench_reduce_keyframes(rotations):
+    keyframes.reduce_keyframes(rotations, range(len(rotations)))
+
+def bench_write_vmd(filename, records):
+    VmdWriter().write_vmd_file(filename, records, pos2vmd.make_showik_frames())
+
+def bench_vmd_read(filename):
+    motion = VmdReader().read_vmd_file(filename)
+    # 列を取り出して実際に読み込ませる
+    motion.names
+    motion.rotations.sum()
+
+def bench_e2e(image_file, vmd_file):
+    import vmd_mediapipe as vm
+    vm.vmd_convert(image_file, vmd_file)
+
+def copy_sequence(sequence):
+    return ps.PoseSequence(sequence.points.copy(), sequence.visibility, sequence.image)
+
+def bench_center_2d(sequence):
+    ps.center_positions(sequence)
+
+def bench_root_motion(world, image):
+    adjust_center.root_motion(world, image, world[..., 3], 16 / 9)
+
+def bench_foot_ik(points, root):
+    foot_contact.foot_ik(points, 30, root)
+
+def bench_solve_hands(sequence, hands):
+    import vmd_mediapipe as vm
+    vm.hand_sequence(sequence, hands)
+
+def bench_replay(recording, vmd_file):
+    import vmd_mediapipe as vm
+    import estimators
+    vm.vmd_convert('replay.mp4', vmd_file, estimator=estimators.EstimatorSettings('replay', replay=recording))
+
+def _refined_positions(f):
+    positions_list = copy_positions(f.get('positions'))
+    ps.smooth_position(positions_list)
+    return positions_list
+
+def _e2e_available():
+    import vmd_mediapipe as vm
+    return os.path.exists(vm.MODEL_PATH) and os.path.exists(E2E_IMAGE)
+
+# 名前: (関数, 引数を作る関数(時間に含めない), 実行できるかを返す関数(Noneは常に実行))
+CASES = {
+    'interpolate': (bench_interpolate, lambda f: (f.get('points'),), None),
+    'lowpass': (bench_lowpass, lambda f: (f.get('filled'),), None),
+    'savgol': (bench_savgol, lambda f: (f.get('filled'),), None),
+    'oneeuro': (bench_oneeuro, lambda f: (f.get('filled'),), None),
+    'convert': (bench_convert, lambda f: f.get('landmarks'), None),
+    'smooth_position': (bench_smooth_position, lambda f: (copy_positions(f.get('positions')),), None),
+    'normalize_for_vmd': (bench_normalize_for_vmd, lambda f: (_refined_positions(f),), None),
+    # PoseSequence(配列)版
+    'smooth_sequence': (bench_smooth_position, lambda f: (copy_sequence(f.get('sequence')),), None),
+    'normalize_sequence': (bench_normalize_for_vmd, lambda f: (copy_sequence(f.get('sequence')),), None),
+    'positions_to_frames': (bench_positions_to_frames, lambda f: (_refined_positions(f),), None),
+    'positions_to_rotations': (bench_positions_to_rotations,
+                               lambda f: (ps.world_points(f.get('filled_landmarks')[0]),), None),
+    'rotations_to_records': (bench_rotations_to_records, lambda f: (f.get('rotations'),), None),
+    'reduce_keyframes': (bench_reduce_keyframes, lambda f: (f.get('rotations'),), None),
+    # センターの位置 (画像上の腰の位置 / PnP)
+    'center_2d': (bench_center_2d, lambda f: (f.get('sequence'),), None),
+    'root_motion': (bench_root_motion, lambda f: f.get('projected'), None),
+    # 足の接地の判定と足ＩＫ、センターの位置 (全フレームをまとめて計算)
+    'foot_ik': (bench_foot_ik, lambda f: f.get('walk'), None),
+    # 手首と指のボーンの回転 (欠損の補間を含む)
+    'solve_hands': (bench_solve_hands, lambda f: (f.get('sequence'), f.get('hands')), None),
+    'write_vmd': (bench_write_vmd, lambda f: (os.path.join(f.tmpdir, 'write.vmd'), f.get('records')), None),
+    'vmd_read': (bench_vmd_read, lambda f: (f.get('vmd'),), None),
+    # 記録したランドマークを読み込んでVMDを出力するまで (推定以外の全ステージ)
+    'replay': (bench_replay, lambda f: (f.get('recording'), os.path.join(f.tmpdir, 'replay.vmd')), None),
+    # 静止画の推定からVMD出力まで (data/saved_sessions にモデルがある場合のみ)
+    'e2e': (bench_e2e, lambda f: (E2E_IMAGE, os.path.join(f.tmpdir, 'e2e.vmd')), _e2e_available),
+}
+
+# 指定しない限り実行しないケース
+OPTIONAL_CASES = ('e2e',)
+
+def measure(func, setup, fixture, repeat):
+    """best time of repeat runs and the peak memory allocated during one more run"""
+    best = float('inf')
+    for _ in range(repeat):
+        args = setup(fixture)
+        t = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t)
+
+    # tracemallocを有効にすると遅くなるので、メモリは時間とは別に計測する
+    args = setup(fixture)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+# 読み込み時間を計測するモジュールと、それらが読み込んではいけない重いモジュール
+IMPORT_MODULES = ('vmd_mediapipe', 'pos2vmd', 'posisions', 'VmdWriter', 'VmdReader')
+HEAVY_MODULES = ('cv2', 'mediapipe', 'PyQt6')
+
+_IMPORT_CODE = """
+import json, sys
+import %s
+import pipeline
+print(json.dumps({'peak_rss': pipeline.peak_rss(),
+                  'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+def import_cost(module):
+    """cold-start import time and RSS of a module, measured in a new process with -X importtime
+
+    モジュールごとの時間(自身の分、µs)の大きい順に5つを top に返す。
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _IMPORT_CODE % (module, HEAVY_MODULES)],
+                          cwd=DIR_PATH, capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    result = json.loads(proc.stdout.splitlines()[-1])
+    top = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:5]
+    return {'module': module, 'seconds': times[module][1] / 1e6, 'peak_rss': result['peak_rss'],
+            'heavy': result['heavy'], 'top': [(name, t[0]) for name, t in top]}
+
+def run_imports(modules=IMPORT_MODULES):
+    results = []
+    for module in modules:
+        r = import_cost(module)
+        print('import %-16s %8.4fs %9.1fMB rss  %s' % (
+            module, r['seconds'], r['peak_rss'] / (1 << 20),
+            'loads ' + ', '.join(r['heavy']) if r['heavy'] else ''))
+        results.append(r)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=DIR_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(names, frame_counts, repeat):
+    results = []
+    for frames in frame_counts:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fixture = Fixture(frames, tmpdir)
+            for name in names:
+                func, setup, available = CASES[name]
+                if available is not None and not available():
+                    print('%-22s skipped (model not found)' % name)
+                    continue
+                best, peak = measure(func, setup, fixture, repeat)
+                print('%-22s %8d frames %9.4fs %12.0f frames/s %9.1fMB peak' % (
+                    name, frames, best, frames / best, peak / (1 << 20)))
+                results.append({'case': name, 'frames': frames, 'seconds': best,
+                                'frames_per_second': frames / best, 'peak_bytes': peak})
+    return {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+def compare(report, previous):
+    """print time and memory ratios against a previous report"""
+    old = {(r['case'], r['frames']): r for r in previous['results']}
+    print('compared with %s' % (previous.get('commit') or 'previous run'))
+    for r in report['results']:
+        o = old.get((r['case'], r['frames']))
+        if o is None:
+            continue
+        print('%-22s %8d frames  time x%.2f  peak x%.2f' % (
+            r['case'], r['frames'], r['seconds'] / o['seconds'],
+            r['peak_bytes'] / o['peak_bytes'] if o['peak_bytes'] else 0.0))
+    old_imports = {r['module']: r for r in previous.get('imports', [])}
+    for r in report.get('imports', []):
+        o = old_imports.get(r['module'])
+        if o is None:
+            continue
+        print('import %-16s time x%.2f  rss x%.2f' % (r['module'], r['seconds'] / o['seconds'],
+                                                       r['peak_rss'] / o['peak_rss'] if o['peak_rss'] else 0.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the pipeline stages on synthetic landmarks')
+    parser.add_argument('--frames', type=int, nargs='+', default=[10000],
+                        help='numbers of frames (default: 10000; 108000 is 1 hour at 30fps)')
+    parser.add_argument('--repeat', type=int, default=3, help='repeat count (best time is reported)')
+    parser.add_argument('--json', default=None, help='write the results to a JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('--imports', action='store_true',
+                        help='measure cold-start import time and RSS of the modules (-X importtime)')
+    parser.add_argument('CASE', nargs='*',
+                        help='cases to run (default: all but %s): %s' % (', '.join(OPTIONAL_CASES),
+                                                                        ', '.join(CASES)))
+
+    arg = parser.parse_args()
+    unknown = set(arg.CASE) - set(CASES)
+    if unknown:
+        parser.error('unknown case: ' + ', '.join(sorted(unknown)))
+    if arg.imports and not arg.CASE:
+        names = []
+    else:
+        names = arg.CASE or [name for name in CASES if name not in OPTIONAL_CASES]
+    report = run(names, arg.frames, arg.repeat)
+    if arg.imports:
+        report['imports'] = run_imports()
+    if arg.json:
+        with open(arg.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if arg.compare:
+        with open(arg.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+    # ex)
+    # python3 applications/benchmark.py --frames 1000 100000 --json before.json
+    # python3 applications/benchmark.py --frames 1000 100000 --compare before.json
+    # python3 applications/benchmark.py --imports --json imports.json
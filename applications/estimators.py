@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#
+# estimators.py - pose estimation backends (MediaPipe model variants, batched image mode, replay)
+#
+
+import argparse
+import concurrent.futures
+import os
+import time
+import types
+import numpy as np
+
+import posisions as ps
+import timeline
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+PROJECT_PATH = os.path.realpath(DIR_PATH + '/..')
+MODEL_DIR = os.path.join(PROJECT_PATH, 'data/saved_sessions')
+
+MODEL_VARIANTS = ('lite', 'full', 'heavy')
+BACKENDS = ('mediapipe', 'batch', 'replay')
+DELEGATES = ('cpu', 'gpu')
+
+def model_path(variant='full'):
+    """path of the pose landmarker model of a variant (setup.sh downloads them)"""
+    if variant not in MODEL_VARIANTS:
+        raise ValueError('unknown model variant: %s' % variant)
+    return os.path.join(MODEL_DIR, 'pose_landmarker_%s.task' % variant)
+
+def create_pose_landmarker(path, image_mode=False, num_poses=1, delegate='cpu'):
+    """MediaPipe PoseLandmarker in VIDEO (or IMAGE) running mode"""
+    import mediapipe as mp
+    BaseOptions = mp.tasks.BaseOptions
+    PoseLandmarker = mp.tasks.vision.PoseLandmarker
+    PoseLandmarkerOptions = mp.tasks.vision.PoseLandmarkerOptions
+    VisionRunningMode = mp.tasks.vision.RunningMode
+    options = PoseLandmarkerOptions(
+        base_options=BaseOptions(model_asset_path=path,
+                                 delegate=BaseOptions.Delegate.GPU if delegate == 'gpu' else BaseOptions.Delegate.CPU),
+        running_mode=VisionRunningMode.IMAGE if image_mode else VisionRunningMode.VIDEO,
+        num_poses=num_poses)
+    return PoseLandmarker.create_from_options(options)
+
+class BatchLandmarker():
+    """IMAGE mode landmarkers run on batches of frames by a thread pool
+
+    フレーム間のトラッキングを使わないので、各フレームを独立に推定できる。
+    threads個のモデルを作り、batch_sizeフレームずつ分担して推定する。
+    (VIDEOモードより結果は揺れやすいが、コア数が多いマシンでは速い)
+    """
+    def __init__(self, path, threads=4, num_poses=1, delegate='cpu', batch_size=None):
+        self.threads = max(int(threads), 1)
+        self.batch_size = batch_size or self.threads * 4
+        self.landmarkers = [create_pose_landmarker(path, True, num_poses, delegate) for _ in range(self.threads)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+    def detect_batch(self, mp_images):
+        """results of the images in the same order"""
+        def run(k):
+            return [self.landmarkers[k].detect(image) for image in mp_images[k::self.threads]]
+        parts = list(self.executor.map(run, range(self.threads)))
+        results = [None] * len(mp_images)
+        for k, part in enumerate(parts):
+            results[k::self.threads] = part
+        return results
+
+    def detect(self, mp_image):
+        return self.landmarkers[0].detect(mp_image)
+
+    def detect_for_video(self, mp_image, timestamp_ms):
+        return self.detect(mp_image)
+
+    def close(self):
+        self.executor.shutdown()
+        for landmarker in self.landmarkers:
+            landmarker.close()
+
+class ReplayLandmarker():
+    """landmarker returning landmarks recorded in a file instead of running a model
+
+    ファイルは landmark_cache と同じ形式 (frame_nums, fps, world, image, frame_count)。
+    --record で保存したものや、キャッシュのファイルをそのまま使える。
+    手のランドマーク(hands)も保存されていれば、hand_world_landmarks として返す。
+    画像は使わないので needs_frames は False で、動画はデコードされない。
+    同じファイルからは常に同じ結果になる。
+    """
+    needs_frames = False
+
+    def __init__(self, path):
+        import landmark_cache
+        data = landmark_cache.read_landmarks(path)
+        self.path = path
+        self.fps = timeline.effective_fps(float(data['fps']))
+        self.aspect = float(data['aspect']) if 'aspect' in data else 0.0
+        self.frame_nums = data['frame_nums']
+        # 記録したフレーム数がなければ(古いファイル)、最後に検出したフレームまでとする
+        self.frame_count = int(data['frame_count']) if 'frame_count' in data else (
+            int(self.frame_nums[-1]) + 1 if len(self.frame_nums) else 0)
+        self.world = data['world']
+        self.image = data['image']
+        self.hands = data.get('hands')
+        self.index = {timeline.frame_timestamp(f, self.fps): i for i, f in enumerate(self.frame_nums.tolist())}
+
+    def frames(self, start=0, stop=None, step=1):
+        """(frame_num, None) of the recorded frames in [start, stop)"""
+        for frame_num in self.frame_nums.tolist():
+            if frame_num < start or (stop is not None and frame_num >= stop) or frame_num % step:
+                continue
+            yield frame_num, None
+
+    def _result(self, i):
+        if i is None:
+            return types.SimpleNamespace(pose_landmarks=[], pose_world_landmarks=[])
+        return types.SimpleNamespace(pose_landmarks=[ps.array_to_landmarks(self.image[i])],
+                                     pose_world_landmarks=[ps.array_to_landmarks(self.world[i])],
+                                     hand_world_landmarks=None if self.hands is None else self.hands[i])
+
+    def detect_for_video(self, mp_image, timestamp_ms):
+        return self._result(self.index.get(timestamp_ms))
+
+    def detect(self, mp_image):
+        return self._result(0 if len(self.frame_nums) else None)
+
+    def close(self):
+        pass
+
+class EstimatorSettings():
+    """pose estimation backend and its options
+
+    backend: mediapipe (PoseLandmarker), batch (IMAGE モードを threads 個並列に実行), replay (記録したランドマークを返す)
+    variant: モデルの種類 (lite, full, heavy)。lite が最も速く、heavy が最も精度が高い。
+    delegate: cpu または gpu
+    threads: batch で使うモデルの数
+    replay: replay で読み込むファイル
+    プロセス間で受け渡せるよう設定のみを持ち、create でモデルを作る。
+    """
+    def __init__(self, backend='mediapipe', variant='full', delegate='cpu', threads=4, replay=None):
+        if backend not in BACKENDS:
+            raise ValueError('unknown backend: %s' % backend)
+        if backend == 'replay' and not replay:
+            raise ValueError('replay backend requires a landmark file')
+        self.backend = backend
+        self.variant = variant
+        self.delegate = delegate
+        self.threads = threads
+        self.replay = replay
+
+    @property
+    def model_path(self):
+        """file the results depend on (part of the landmark cache key)"""
+        return self.replay if self.backend == 'replay' else model_path(self.variant)
+
+    def key(self):
+        """string identifying the settings (part of the landmark cache key)
+
+        デフォルト(mediapipe, cpu)は空文字列とし、以前のキャッシュをそのまま使う。
+        モデルの種類はモデルファイルのハッシュで区別される。
+        """
+        if self.backend == 'mediapipe' and self.delegate == 'cpu':
+            return ''
+        return '%s,%s' % (self.backend, self.delegate)
+
+    def create(self, image_mode=False, num_poses=1):
+        """create a landmarker of the backend"""
+        if self.backend == 'replay':
+            return ReplayLandmarker(self.replay)
+        if self.backend == 'batch':
+            return BatchLandmarker(self.model_path, self.threads, num_poses, self.delegate)
+        return create_pose_landmarker(self.model_path, image_mode, num_poses, self.delegate)
+
+def compare_variants(video, variants=MODEL_VARIANTS, backend='mediapipe', delegate='cpu', threads=4,
+                     queue_depth=0, stop=None):
+    """throughput of the model variants on a video
+
+    同じ動画を各モデルで推定し、推定のみの速度(inference)と全体の速度、検出できたフレーム数を返す。
+    最初のモデルの結果との関節位置(ワールド座標)の差も返す。
+    """
+    import vmd_mediapipe as vm
+
+    results = []
+    reference = None
+    for variant in variants:
+        settings = EstimatorSettings(backend, variant, delegate, threads)
+        if not os.path.exists(settings.model_path):
+            print('%s: model not found (%s)' % (variant, settings.model_path))
+            continue
+        stats = vm.PipelineStats()
+        landmarker = settings.create()
+        t = time.perf_counter()
+        try:
+            frame_nums, world, _ = vm.detect_landmarks(video, queue_depth, stats, landmarker, stop=stop)
+        finally:
+            landmarker.close()
+        elapsed = time.perf_counter() - t
+        inference = stats.stage('inference')
+        r = {'variant': variant, 'backend': backend, 'frames': int(inference.count),
+             'detected': len(frame_nums), 'seconds': elapsed,
+             'frames_per_second': inference.count / elapsed if elapsed else 0.0,
+             'inference_per_second': inference.throughput()}
+        if reference is None:
+            reference = (frame_nums, world)
+        else:
+            common, i, j = np.intersect1d(reference[0], frame_nums, return_indices=True)
+            if len(common):
+                diff = ps.world_points(reference[1][i]) - ps.world_points(world[j])
+                r['joint_difference'] = float(np.linalg.norm(diff, axis=-1).mean())
+        results.append(r)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the throughput of the pose landmarker model variants')
+    parser.add_argument('--variants', nargs='+', choices=MODEL_VARIANTS, default=list(MODEL_VARIANTS))
+    parser.add_argument('--backend', choices=('mediapipe', 'batch'), default='mediapipe')
+    parser.add_argument('--delegate', choices=DELEGATES, default='cpu')
+    parser.add_argument('--threads', type=int, default=4, help='models run in parallel by the batch backend')
+    parser.add_argument('--queue-depth', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=None, help='estimate only the first FRAMES frames')
+    parser.add_argument('VIDEO', nargs='+')
+
+    arg = parser.parse_args()
+    for video in arg.VIDEO:
+        for r in compare_variants(video, arg.variants, arg.backend, arg.delegate, arg.threads,
+                                  arg.queue_depth, arg.frames):
+            print('%s %-5s %-9s %6d frames %6d detected %8.1f frames/s (inference %8.1f/s)%s' % (
+                video, r['variant'], r['backend'], r['frames'], r['detected'], r['frames_per_second'],
+                r['inference_per_second'],
+                ', joint difference %.4f' % r['joint_difference'] if 'joint_difference' in r else ''))
+
+    # ex)
+    # python3 applications/estimators.py --variants lite full heavy applications/debug/sample.mp4
+    # python3 applications/estimators.py --backend batch --threads 8 applications/debug/sample.mp4
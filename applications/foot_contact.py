@@ -0,0 +1,155 @@
+# foot_contact.py - foot contact detection and leg IK / center positions computed over whole sequences
+
+import numpy as np
+
+from adjust_center import METERS_TO_MMD
+from posisions import Joint
+
+# 左足、右足の順
+_HEELS = [Joint.LEFT_HEEL, Joint.RIGHT_HEEL]
+_TOES = [Joint.LEFT_FOOT_INDEX, Joint.RIGHT_FOOT_INDEX]
+_ANKLES = [Joint.LEFT_ANKLE, Joint.RIGHT_ANKLE]
+
+IK_BONE_NAMES = ['左足ＩＫ', '右足ＩＫ']
+
+class ContactSettings():
+    """settings of the foot contact stage
+
+    height: 足裏(かかととつま先の低い方)の地面からの高さがこれ未満のとき接地とみなす (メートル)
+    velocity: 足の水平方向の速さがこれ未満のとき接地とみなす (メートル/秒)
+    min_frames: これより短い接地と、接地の間の途切れは無視する
+    blend: 接地の前後で、固定した位置から推定した位置に戻すまでのフレーム数
+    """
+    def __init__(self, height=0.06, velocity=0.5, min_frames=3, blend=3):
+        self.height = height
+        self.velocity = velocity
+        self.min_frames = max(int(min_frames), 1)
+        self.blend = max(int(blend), 0)
+
+def _runs(mask):
+    """start and end (exclusive) indices of the True runs of a 1D mask"""
+    d = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+
+def _spans(n, starts, ends):
+    """mask of length n that is True in [starts[i], ends[i])"""
+    delta = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, ends, -1)
+    return np.cumsum(delta[:-1]) > 0
+
+def _clean(mask, min_frames):
+    """fill gaps and then drop contacts shorter than min_frames"""
+    n = len(mask)
+    # 両端以外の短い途切れを埋める
+    starts, ends = _runs(~mask)
+    short = (ends - starts < min_frames) & (starts > 0) & (ends < n)
+    mask = mask | _spans(n, starts[short], ends[short])
+    starts, ends = _runs(mask)
+    short = ends - starts < min_frames
+    return mask & ~_spans(n, starts[short], ends[short])
+
+def _feet(points, root=None):
+    """heels, toes and ankles (N, 2, 3) in MMD units (moved by root if given)"""
+    points = np.asarray(points)
+    feet = points[:, _HEELS + _TOES + _ANKLES].astype(np.float64) * METERS_TO_MMD
+    if root is not None:
+        feet += np.asarray(root, dtype=np.float64)[:, None]
+    return feet[:, 0:2], feet[:, 2:4], feet[:, 4:6]
+
+def _foot_xz(heels, toes):
+    return (heels[..., [0, 2]] + toes[..., [0, 2]]) / 2
+
+def detect_contacts(points, fps, root=None, settings=None):
+    """foot contact (N, 2) of the left and right feet, and the ground height
+
+    points (N, 33, 3) は平滑化したワールド座標 (メートル、yが上、腰が原点)、
+    root (N, 3) はセンターの位置 (MMDの単位、省略時は腰が動かないとみなす)。
+    かかととつま先(29〜32)の高さと水平方向の速さのしきい値で、全フレームをまとめて判定する。
+    地面の高さ(MMDの単位)は全フレームの足裏の高さの5パーセンタイルとする。
+    """
+    if settings is None:
+        settings = ContactSettings()
+    heels, toes, _ = _feet(points, root)
+    sole = np.minimum(heels[..., 1], toes[..., 1])
+    if not len(sole) or np.isnan(sole).all():
+        return np.zeros((len(sole), 2), dtype=bool), 0.0
+    ground = float(np.nanpercentile(sole, 5))
+    speed = (np.linalg.norm(np.gradient(_foot_xz(heels, toes), axis=0), axis=-1) * fps if len(sole) > 1
+             else np.zeros((len(sole), 2)))
+    contact = ((sole - ground < settings.height * METERS_TO_MMD) &
+               (speed < settings.velocity * METERS_TO_MMD))
+    return np.stack([_clean(contact[:, side], settings.min_frames) for side in range(2)], axis=1), ground
+
+def _pin(values, contact, blend):
+    """values (N, 3) fixed to the mean of each contact run, blended back over blend frames"""
+    n = len(values)
+    starts, ends = _runs(contact)
+    if not len(starts):
+        return values
+    # 接地区間ごとの平均 (累積和の差で [start, end) の和を求める)
+    cumsum = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+    pinned = (cumsum[ends] - cumsum[starts]) / (ends - starts)[:, None]
+    offset = np.zeros_like(values)
+    offset[contact] = np.repeat(pinned, ends - starts, axis=0) - values[contact]
+    if blend:
+        # 接地していないフレームは、前後の最も近い接地フレームとのずれを距離に応じて減らす
+        index = np.arange(n)
+        prev = np.maximum.accumulate(np.where(contact, index, -1))
+        next_ = np.minimum.accumulate(np.where(contact, index, n)[::-1])[::-1]
+        w_prev = np.where(prev >= 0, np.clip(1 - (index - prev) / (blend + 1), 0, 1), 0)
+        w_next = np.where(next_ < n, np.clip(1 - (next_ - index) / (blend + 1), 0, 1), 0)
+        use_prev = w_prev >= w_next
+        nearest = np.where(use_prev, prev, next_).clip(0, n - 1)
+        weight = np.where(use_prev, w_prev, w_next)
+        offset = np.where(contact[:, None], offset, offset[nearest] * weight[:, None])
+    return values + offset
+
+def leg_ik(points, contact, ground, root=None, blend=3):
+    """足ＩＫ positions (N, 2, 3) and center positions (N, 3) in MMD units
+
+    接地しているフレームでは、接地している足の足裏が地面に付くようにセンターの高さを求め、
+    接地していないフレームは前後の接地フレームの補正量を補間する。(rootの上下の動き(ジャンプ)は残す)
+    足ＩＫは直立したときの足首の位置(接地フレームの中央値)からの移動量とし、
+    接地している区間はその区間の平均の位置に固定する。
+    """
+    n = len(points)
+    root = np.zeros((n, 3)) if root is None else np.array(root, dtype=np.float64)
+    heels, toes, ankles = _feet(points)
+    sole = np.minimum(heels[..., 1], toes[..., 1])
+
+    any_contact = contact.any(axis=1)
+    if any_contact.any():
+        # 接地している足のうち低い方の足裏が地面の高さになる腰の高さ
+        required = np.where(contact, ground - sole, -np.inf).max(axis=1)
+        frames = np.flatnonzero(any_contact)
+        root[:, 1] += np.interp(np.arange(n), frames, required[frames] - root[frames, 1])
+    reference = contact if contact.any() else np.ones_like(contact)
+    # 直立したときの腰の高さ(足裏から)と足首の高さ
+    hip_height = np.percentile(-sole[reference], 90)
+    ankle_height = np.median((ankles[..., 1] - sole)[reference])
+    rest = np.stack([np.median(ankles[reference[:, side] if reference[:, side].any() else slice(None), side], axis=0)
+                     for side in range(2)])
+    rest[:, 1] = ground + ankle_height
+
+    centers = np.stack([root[:, 0], root[:, 1] - ground - hip_height, root[:, 2]], axis=-1)
+    ik = ankles + root[:, None] - rest
+    ik = np.stack([_pin(ik[:, side], contact[:, side], blend) for side in range(2)], axis=1)
+    return ik, centers
+
+def foot_ik(points, fps, root=None, settings=None):
+    """detect foot contacts and return (contact (N, 2), 足ＩＫ (N, 2, 3), center (N, 3), info)
+
+    info には左右の足の接地している割合と、接地中の足の滑り(固定する前の水平方向の平均の速さ、メートル/秒)を入れる。
+    """
+    if settings is None:
+        settings = ContactSettings()
+    contact, ground = detect_contacts(points, fps, root, settings)
+    ik, centers = leg_ik(points, contact, ground, root, settings.blend)
+    heels, toes, _ = _feet(points, root)
+    foot = _foot_xz(heels, toes)
+    slide = (np.linalg.norm(np.diff(foot, axis=0), axis=-1) * fps)[contact[1:] & contact[:-1]]
+    info = {'contact_left': float(contact[:, 0].mean()) if len(contact) else 0.0,
+            'contact_right': float(contact[:, 1].mean()) if len(contact) else 0.0,
+            'foot_slide': float(slide.mean() / METERS_TO_MMD) if len(slide) else 0.0}
+    return contact, ik, centers, info
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# hands.py - hand landmarks estimated on crops around the wrists of the pose
+#
+
+import argparse
+import os
+import time
+import numpy as np
+
+import posisions as ps
+import estimators
+import tracking
+
+HAND_MODEL_PATH = os.path.join(estimators.MODEL_DIR, 'hand_landmarker.task')
+
+# 左手、右手の順
+_WRISTS = [ps.Joint.LEFT_WRIST, ps.Joint.RIGHT_WRIST]
+_ELBOWS = [ps.Joint.LEFT_ELBOW, ps.Joint.RIGHT_ELBOW]
+_KNUCKLES = [[ps.Joint.LEFT_PINKY, ps.Joint.LEFT_INDEX, ps.Joint.LEFT_THUMB],
+             [ps.Joint.RIGHT_PINKY, ps.Joint.RIGHT_INDEX, ps.Joint.RIGHT_THUMB]]
+
+# 切り出す範囲の最小の大きさ(ピクセル)
+MIN_CROP = 32
+
+def create_hand_landmarker(path=HAND_MODEL_PATH, num_hands=1, delegate='cpu'):
+    """MediaPipe HandLandmarker in IMAGE running mode
+
+    切り出す位置がフレームごとに変わるので、フレーム間のトラッキングは使わない。
+    """
+    import mediapipe as mp
+    BaseOptions = mp.tasks.BaseOptions
+    options = mp.tasks.vision.HandLandmarkerOptions(
+        base_options=BaseOptions(model_asset_path=path,
+                                 delegate=BaseOptions.Delegate.GPU if delegate == 'gpu' else BaseOptions.Delegate.CPU),
+        running_mode=mp.tasks.vision.RunningMode.IMAGE,
+        num_hands=num_hands)
+    return mp.tasks.vision.HandLandmarker.create_from_options(options)
+
+def wrist_regions(pose_2d, width, height, min_visibility=0.5, scale=1.5):
+    """square pixel regions (x0, y0, x1, y1) around the left and right hands of a pose
+
+    pose_2d (33, 4) はポーズの画像上の座標。手首と、ポーズの指(小指、人差し指、親指)の中間を中心とし、
+    前腕(ひじ-手首)の長さのscale倍を一辺とする。
+    手首のvisibilityがmin_visibility未満の手や、画像からはみ出して小さくなりすぎた範囲はNoneとする。
+    """
+    pose_2d = np.asarray(pose_2d)
+    size_px = np.array([width, height])
+    regions = []
+    for wrist, elbow, knuckles in zip(_WRISTS, _ELBOWS, _KNUCKLES):
+        if pose_2d[wrist, 3] < min_visibility:
+            regions.append(None)
+            continue
+        w = pose_2d[wrist, :2] * size_px
+        tips = pose_2d[knuckles, :2].mean(axis=0) * size_px
+        center = (w + tips) / 2
+        size = max(np.linalg.norm(w - pose_2d[elbow, :2] * size_px) * scale,
+                   np.linalg.norm(tips - w) * 4, MIN_CROP)
+        x0 = int(max(center[0] - size / 2, 0))
+        y0 = int(max(center[1] - size / 2, 0))
+        x1 = int(min(center[0] + size / 2, width))
+        y1 = int(min(center[1] + size / 2, height))
+        regions.append((x0, y0, x1, y1) if x1 - x0 >= MIN_CROP // 2 and y1 - y0 >= MIN_CROP // 2 else None)
+    return regions
+
+class HandSettings():
+    """settings of the hand stage
+
+    min_visibility: ポーズの手首のvisibilityがこれ未満の手は推定しない。
+    scale: 手首の周りを切り出す範囲の大きさ(前腕の長さに対する比)
+    full_frame: 切り出さずに画像全体で両手を推定する(比較用)
+    プロセス間で受け渡せるよう設定のみを持ち、create でモデルを作る。
+    """
+    def __init__(self, min_visibility=0.5, scale=1.5, delegate='cpu', full_frame=False, path=HAND_MODEL_PATH):
+        self.min_visibility = min_visibility
+        self.scale = scale
+        self.delegate = delegate
+        self.full_frame = full_frame
+        self.path = path
+
+    def key(self):
+        """string identifying the settings (part of the landmark cache key)"""
+        return 'hands=%s,%s,%s,%s' % (os.path.basename(self.path), self.min_visibility, self.scale,
+                                      'full' if self.full_frame else 'crop')
+
+    def create(self, stats=None):
+        """create a HandDetector with its own model"""
+        landmarker = create_hand_landmarker(self.path, 2 if self.full_frame else 1, self.delegate)
+        return HandDetector(landmarker, self.min_visibility, self.scale, self.full_frame, stats)
+
+class HandDetector():
+    """world landmarks of the left and right hands of the pose in a frame
+
+    ポーズの推定に渡した画像(デコード、RGB変換済み)をそのまま使い、手首の周りを切り出して推定する。
+    手首が見えていない手は推定しない。(stats の hands_skipped に数える)
+    切り出した範囲で見つかった手首がポーズの手首から離れている場合は、もう一方の手とみなして捨てる。
+    """
+    def __init__(self, landmarker, min_visibility=0.5, scale=1.5, full_frame=False, stats=None):
+        self.landmarker = landmarker
+        self.min_visibility = min_visibility
+        self.scale = scale
+        self.full_frame = full_frame
+        self.stats = stats
+
+    def _count(self, name, n=1):
+        if self.stats is not None:
+            self.stats.count(name, n)
+
+    def detect(self, mp_image, pose_2d):
+        """world landmarks (2, 21, 3) of the left and right hands (NaN for undetected hands)
+
+        pose_2d (33, 4) はポーズの画像上の座標。ワールド座標はMediaPipeの軸(yが下)のメートル単位。
+        """
+        import mediapipe as mp
+        hands = np.full((2, len(ps.HAND_NAMES), 3), np.nan, dtype=np.float32)
+        image = mp_image.numpy_view()
+        height, width = image.shape[:2]
+        pose_2d = np.asarray(pose_2d)
+        wrists = pose_2d[_WRISTS, :2] * (width, height)
+
+        if self.full_frame:
+            result = self.landmarker.detect(mp_image)
+            if not result.hand_landmarks:
+                self._count('no_hand', 2)
+                return hands
+            found = np.array([(h[0].x * width, h[0].y * height) for h in result.hand_landmarks])
+            cost = np.linalg.norm(found[:, None] - wrists[None], axis=-1)
+            for f, side in zip(*tracking.assign(cost)):
+                if cost[f, side] <= max(width, height) * 0.1:
+                    hands[side] = ps.landmarks_to_array(result.hand_world_landmarks[f])[:, :3]
+            self._count('no_hand', int(np.isnan(hands[:, 0, 0]).sum()))
+            return hands
+
+        for side, region in enumerate(wrist_regions(pose_2d, width, height, self.min_visibility, self.scale)):
+            if region is None:
+                self._count('hands_skipped')
+                continue
+            x0, y0, x1, y1 = region
+            # 切り出しはデコード済みの画像のビューから作る (小さい範囲のコピーのみ)
+            crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+            result = self.landmarker.detect(mp.Image(image_format=mp.ImageFormat.SRGB, data=crop))
+            if not result.hand_landmarks:
+                self._count('no_hand')
+                continue
+            wrist = result.hand_landmarks[0][0]
+            found = np.array([x0 + wrist.x * (x1 - x0), y0 + wrist.y * (y1 - y0)])
+            if np.linalg.norm(found - wrists[side]) > (x1 - x0) / 2:
+                self._count('no_hand')
+                continue
+            hands[side] = ps.landmarks_to_array(result.hand_world_landmarks[0])[:, :3]
+        return hands
+
+    def close(self):
+        self.landmarker.close()
+
+def evaluate(video, settings=None, queue_depth=0, stop=None):
+    """compare the hand stage on wrist crops with a naive full-frame hand pass on a video
+
+    同じ動画をポーズのみ、手首の周りの切り出し、画像全体の3通りで推定し、
+    手の推定(hands ステージ)に1フレームあたりにかかった時間、両手を検出できた割合と、
+    切り出しと画像全体の両方で検出できた手のランドマークの差(ワールド座標、メートル)を返す。
+    """
+    import vmd_mediapipe as vm
+
+    if settings is None:
+        settings = HandSettings()
+    full = HandSettings(settings.min_visibility, settings.scale, settings.delegate, True, settings.path)
+    results = {}
+    for name, s in (('pose', None), ('crop', settings), ('full', full)):
+        stats = vm.PipelineStats()
+        t = time.perf_counter()
+        landmarks = vm.detect_landmarks(video, queue_depth, stats, stop=stop, hands=s)
+        elapsed = time.perf_counter() - t
+        frames = max(len(landmarks[0]), 1)
+        results[name] = {
+            'seconds': elapsed,
+            'frames': len(landmarks[0]),
+            'hand_ms_per_frame': stats.stage('hands').seconds / frames * 1000,
+        }
+        if s is not None:
+            detected = ~np.isnan(landmarks[3][..., 0, 0])
+            results[name]['detected'] = float(detected.mean()) if detected.size else 0.0
+            results[name]['skipped'] = stats.counters.get('hands_skipped', 0)
+            results[name]['hands'] = landmarks[3]
+
+    crop, full = results['crop'].pop('hands'), results['full'].pop('hands')
+    both = ~np.isnan(crop[..., 0, 0]) & ~np.isnan(full[..., 0, 0])
+    if both.any():
+        results['difference'] = float(np.linalg.norm(crop[both] - full[both], axis=-1).mean())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the hand stage on wrist crops with a full-frame hand pass')
+    parser.add_argument('--min-visibility', type=float, default=0.5, help='skip hands whose wrist is less visible')
+    parser.add_argument('--scale', type=float, default=1.5, help='crop size relative to the forearm length')
+    parser.add_argument('--frames', type=int, default=None, help='estimate only the first FRAMES frames')
+    parser.add_argument('VIDEO', nargs='+')
+
+    arg = parser.parse_args()
+    settings = HandSettings(arg.min_visibility, arg.scale)
+    for video in arg.VIDEO:
+        r = evaluate(video, settings, stop=arg.frames)
+        print('%s: %d frames, pose only %.1fs' % (video, r['pose']['frames'], r['pose']['seconds']))
+        for name in ('crop', 'full'):
+            print('  %-4s %.1fs, hands %.2f ms/frame, detected %.1f%%, skipped %d' % (
+                name, r[name]['seconds'], r[name]['hand_ms_per_frame'], r[name]['detected'] * 100,
+                r[name]['skipped']))
+        if 'difference' in r:
+            print('  landmark difference (crop - full) %.4f m' % r['difference'])
+
+    # ex)
+    # python3 applications/hands.py --frames 600 applications/debug/sample.mp4
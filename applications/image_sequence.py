@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#
+# image_sequence.py - numbered image files read as the frames of a video, decoded by a thread pool
+#
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+ORDERS = ('natural', 'name', 'mtime')
+REDUCE_FACTORS = (1, 2, 4, 8)
+
+def is_sequence(path):
+    """True for a directory of frames or a glob pattern (frames/*.png)
+
+    dance [1080p].mp4 のように glob の記号を含むファイル名もあるので、存在するファイルはパターンとみなさない。
+    """
+    if os.path.isfile(path):
+        return False
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def _natural_key(path):
+    # 数字の部分は数値として比べる (frame_9.png < frame_10.png)
+    return [int(s) if s.isdigit() else s.lower() for s in re.split(r'(\d+)', path)]
+
+def list_frames(source, order='natural'):
+    """image files of a directory or glob pattern in frame order
+
+    natural: パスの中の数字を数値として並べる (桁数が揃っていない連番でもよい)
+    name: パスの文字列順
+    mtime: 更新時刻順 (同じ時刻はパスの順)
+    """
+    if order not in ORDERS:
+        raise ValueError('unknown frame order: %s' % order)
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    paths = [p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS and os.path.isfile(p)]
+    if order == 'natural':
+        return sorted(paths, key=_natural_key)
+    if order == 'mtime':
+        return sorted(paths, key=lambda p: (os.stat(p).st_mtime_ns, p))
+    return sorted(paths)
+
+def sequence_hash(paths):
+    """SHA-256 of the names, sizes and modification times of the frames (part of the landmark cache key)
+
+    大きな画像を何千枚も読むのは時間がかかるので、内容ではなくファイルの一覧から求める。
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        st = os.stat(path)
+        h.update(('%s\0%d\0%d\n' % (os.path.basename(path), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+def imread_flags(reduce=1):
+    """cv2.imread flags decoding at 1/reduce resolution (IMREAD_REDUCED_COLOR_*)
+
+    JPEGはデコード自体を縮小して行うので速くなる。PNGなどはデコード後に縮小される。
+    """
+    import cv2
+    if reduce not in REDUCE_FACTORS:
+        raise ValueError('reduce must be one of %s' % (REDUCE_FACTORS,))
+    if reduce == 1:
+        return cv2.IMREAD_COLOR
+    return getattr(cv2, 'IMREAD_REDUCED_COLOR_%d' % reduce)
+
+class SequenceSettings():
+    """settings of image sequence input
+
+    fps: フレームレート (省略時は timeline.effective_fps のデフォルト)
+    order: フレームの順序 (list_frames を参照)
+    threads: デコードするスレッド数
+    read_ahead: 推定より先にデコードしておく最大のフレーム数
+    reduce: 1, 2, 4, 8 のいずれか。1/reduce の解像度でデコードする。
+    プロセス間で受け渡せるよう設定のみを持ち、open でフレームを読み込む。
+    """
+    def __init__(self, fps=None, order='natural', threads=4, read_ahead=16, reduce=1):
+        if order not in ORDERS:
+            raise ValueError('unknown frame order: %s' % order)
+        if reduce not in REDUCE_FACTORS:
+            raise ValueError('reduce must be one of %s' % (REDUCE_FACTORS,))
+        self.fps = float(fps) if fps else None
+        self.order = order
+        self.threads = max(int(threads), 1)
+        self.read_ahead = max(int(read_ahead), self.threads)
+        self.reduce = reduce
+
+    def key(self):
+        """string identifying the settings (part of the landmark cache key)
+
+        スレッド数と先読みの量は結果に影響しないので含めない。
+        """
+        return 'sequence=%s,%s,%d' % (self.fps or '', self.order, self.reduce)
+
+    def open(self, source):
+        """FrameSequence of a directory or glob pattern"""
+        return FrameSequence(source, self)
+
+class FrameSequence():
+    """image files decoded as video frames
+
+    フレーム番号はファイルの順番。cv2.imread はGILを解放するので、
+    read_ahead 枚までをスレッドプールで並列にデコードし、順番どおりに返す。
+    読めないファイルはそのフレームを飛ばす。(推定に失敗したフレームと同じく補間される)
+    """
+    def __init__(self, source, settings=None):
+        import cv2
+        self.settings = settings if settings is not None else SequenceSettings()
+        self.paths = list_frames(source, self.settings.order)
+        if not self.paths:
+            raise IOError('no image files: ' + source)
+        self.flags = imread_flags(self.settings.reduce)
+        self.fps = self.settings.fps or 0
+        self.frame_count = len(self.paths)
+        first = cv2.imread(self.paths[0], self.flags)
+        if first is None:
+            raise IOError('cannot read image: ' + self.paths[0])
+        self.size = (first.shape[1], first.shape[0])
+        self.aspect = first.shape[1] / first.shape[0]
+
+    def _read(self, path):
+        import cv2
+        t = time.perf_counter()
+        image = cv2.imread(path, self.flags)
+        return image, time.perf_counter() - t
+
+    def frames(self, decode, start=0, stop=None, step=1):
+        """decode frames [start, stop) and yield (frame_num, BGR image)
+
+        stepを指定すると、フレーム番号がstepの倍数のフレームのみデコードする。
+        decode(StageStats)には各スレッドでデコードにかかった時間を記録する。
+        """
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        indices = iter(range(start + (-start % step), stop, step))
+        pending = collections.deque()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.threads)
+
+        def fill():
+            while len(pending) < self.settings.read_ahead:
+                frame_num = next(indices, None)
+                if frame_num is None:
+                    return
+                pending.append((frame_num, executor.submit(self._read, self.paths[frame_num])))
+
+        try:
+            fill()
+            while pending:
+                frame_num, future = pending.popleft()
+                image, seconds = future.result()
+                fill()
+                decode.add(seconds)
+                if image is None:
+                    print('cannot read frame %d: %s' % (frame_num, self.paths[frame_num]))
+                    continue
+                yield frame_num, image
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def release(self):
+        pass
+
+def _synthetic_frame(t, width, height):
+    # グラデーションの背景と動く円、少しのノイズ (PNGで圧縮されすぎないように)
+    import cv2
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.empty((height, width, 3), np.uint8)
+    image[..., 0] = (x * 255 // width + t) % 256
+    image[..., 1] = (y * 255 // height) % 256
+    image[..., 2] = ((x + y) // 8 + t * 3) % 256
+    center = (int(width * (0.5 + 0.3 * np.sin(t / 10))), int(height * (0.5 + 0.3 * np.cos(t / 13))))
+    cv2.circle(image, center, height // 6, (255, 255, 255), -1)
+    noise = np.random.default_rng(t).integers(0, 8, image.shape, np.uint8)
+    return cv2.add(image, noise)
+
+def write_synthetic_video(path, frames, width=1920, height=1080, fps=30):
+    """write a synthetic mp4 video for compare_decode"""
+    import cv2
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError('cannot write video: ' + path)
+    for t in range(frames):
+        writer.write(_synthetic_frame(t, width, height))
+    writer.release()
+
+def compare_decode(video, frames=300, threads=(1, 4), reduces=(1, 2, 4), formats=('png', 'jpg'), workdir=None):
+    """decode throughput of a video and of the same frames written as image sequences
+
+    動画の先頭framesフレームをVideoCaptureでデコードし、同じフレームを画像(formats)に書き出して、
+    スレッド数(threads)と縮小(reduces)の組み合わせごとにデコードの速度を比べる。
+    戻り値は {'path', 'threads', 'reduce', 'frames', 'seconds', 'frames_per_second'} のリスト。
+    """
+    import cv2
+    from pipeline import PipelineStats
+
+    def measure(name, frames_iter, n_threads, reduce):
+        stats = PipelineStats()
+        t = time.perf_counter()
+        count = sum(1 for _ in frames_iter(stats.stage('decode')))
+        elapsed = time.perf_counter() - t
+        return {'path': name, 'threads': n_threads, 'reduce': reduce, 'frames': count,
+                'seconds': elapsed, 'frames_per_second': count / elapsed if elapsed else 0.0}
+
+    def read_video(decode):
+        cap = cv2.VideoCapture(video)
+        try:
+            for _ in range(frames):
+                t = time.perf_counter()
+                ret, image = cap.read()
+                if not ret:
+                    break
+                decode.add(time.perf_counter() - t)
+                yield image
+        finally:
+            cap.release()
+
+    results = [measure('video', read_video, 1, 1)]
+    tmp = tempfile.mkdtemp(dir=workdir)
+    try:
+        for ext in formats:
+            os.makedirs(os.path.join(tmp, ext))
+        cap = cv2.VideoCapture(video)
+        for i in range(frames):
+            ret, image = cap.read()
+            if not ret:
+                break
+            for ext in formats:
+                cv2.imwrite(os.path.join(tmp, ext, 'frame_%d.%s' % (i, ext)), image)
+        cap.release()
+        for ext in formats:
+            for reduce in reduces:
+                for n in threads:
+                    sequence = SequenceSettings(threads=n, read_ahead=n * 4, reduce=reduce).open(os.path.join(tmp, ext))
+                    results.append(measure(ext, sequence.frames, n, reduce))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the decode throughput of a video and of image sequences')
+    parser.add_argument('--frames', type=int, default=300, help='decode the first FRAMES frames')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4], help='decode threads to compare')
+    parser.add_argument('--reduce', type=int, nargs='+', choices=REDUCE_FACTORS, default=[1, 2, 4],
+                        help='decode at 1/REDUCE resolution (IMREAD_REDUCED_COLOR_*)')
+    parser.add_argument('--formats', nargs='+', choices=('png', 'jpg', 'bmp', 'webp'), default=['png', 'jpg'])
+    parser.add_argument('--synthetic', default=None, metavar='WxH',
+                        help='compare on a synthetic video of WxH pixels instead of VIDEO')
+    parser.add_argument('VIDEO', nargs='*')
+
+    arg = parser.parse_args()
+    videos = list(arg.VIDEO)
+    tmp = None
+    if arg.synthetic:
+        width, height = (int(v) for v in arg.synthetic.lower().split('x'))
+        tmp = tempfile.mkdtemp()
+        videos.append(os.path.join(tmp, 'synthetic_%dx%d.mp4' % (width, height)))
+        write_synthetic_video(videos[-1], arg.frames, width, height)
+    if not videos:
+        parser.error('VIDEO or --synthetic is required')
+    try:
+        for video in videos:
+            print(video)
+            for r in compare_decode(video, arg.frames, arg.threads, arg.reduce, arg.formats):
+                print('  %-5s threads %2d  reduce 1/%d  %5d frames %8.1f frames/s' % (
+                    r['path'], r['threads'], r['reduce'], r['frames'], r['frames_per_second']))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # ex)
+    # python3 applications/image_sequence.py --frames 300 --threads 1 4 8 applications/debug/sample.mp4
+    # python3 applications/image_sequence.py --synthetic 1920x1080 --frames 120
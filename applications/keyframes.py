@@ -0,0 +1,208 @@
+# keyframes.py - reduce bone keyframes and fit VMD interpolation curves
+
+import itertools
+import numpy as np
+import quaternions as qt
+
+# 補間曲線の候補 (x1, y1, x2, y2) 各値は0〜1
+_LEVELS = (0.0, 1 / 3, 2 / 3, 1.0)
+CURVE_CANDIDATES = np.array(list(itertools.product(_LEVELS, repeat=4)))
+LINEAR_CURVE = np.array([20, 20, 107, 107]) / 127 # MMDの既定の直線補間
+
+_TABLE_SIZE = 128
+
+def bezier(ctrl, t, iterations=16):
+    """evaluate VMD interpolation curves
+
+    ctrl (..., 4) は制御点 (x1, y1, x2, y2)、t は0〜1の時刻。x(s) = t となる s を二分法で求めて y(s) を返す。
+    """
+    ctrl = np.asarray(ctrl, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    x1, y1, x2, y2 = ctrl[..., 0], ctrl[..., 1], ctrl[..., 2], ctrl[..., 3]
+    lo = np.zeros(np.broadcast(x1, t).shape)
+    hi = np.ones_like(lo)
+    for _ in range(iterations):
+        s = (lo + hi) / 2
+        x = 3 * (1 - s) ** 2 * s * x1 + 3 * (1 - s) * s ** 2 * x2 + s ** 3
+        below = x < t
+        lo = np.where(below, s, lo)
+        hi = np.where(below, hi, s)
+    s = (lo + hi) / 2
+    return 3 * (1 - s) ** 2 * s * y1 + 3 * (1 - s) * s ** 2 * y2 + s ** 3
+
+def _neighbors(keep):
+    """previous/next kept frame (inclusive) of every frame along axis 0"""
+    n = len(keep)
+    idx = np.arange(n)[:, None]
+    prev = np.maximum.accumulate(np.where(keep, idx, 0), axis=0)
+    nxt = np.minimum.accumulate(np.where(keep, idx, n - 1)[::-1], axis=0)[::-1]
+    return prev, nxt
+
+def _segment_time(frame_nums, prev, nxt):
+    frames = np.asarray(frame_nums, dtype=np.float64)
+    fa = frames[prev]
+    fb = frames[nxt]
+    span = fb - fa
+    return np.where(span > 0, (frames[:, None] - fa) / np.where(span > 0, span, 1), 0.0)
+
+def reconstruct(rotations, frame_nums, keep, curves=None):
+    """rebuild (N, B, 4) rotations from the kept keyframes as MMD would interpolate them
+
+    curves (N, B, 4) は各キーフレームの補間曲線(そのキーフレームに至る区間に使われる)。
+    """
+    prev, nxt = _neighbors(keep)
+    bones = np.arange(rotations.shape[1])
+    t = _segment_time(frame_nums, prev, nxt)
+    if curves is not None:
+        t = bezier(curves[nxt, bones], t)
+    return qt.slerp(rotations[prev, bones], rotations[nxt, bones], t)
+
+def simplify(rotations, frame_nums, tolerance, candidates=None):
+    """Douglas-Peucker simplification of every bone's rotation curve
+
+    tolerance はラジアン単位の許容誤差。戻り値は残すキーフレームのマスク (N, B)。
+    全ボーン・全区間をまとめて評価し、許容誤差を超える区間を誤差最大のフレームで分割することを繰り返す。
+    candidates (N, B) を指定すると、Trueのフレームにのみキーフレームを残し、誤差もそのフレームで評価する。
+    (ポーズを検出できず補間しただけのフレームにはキーフレームを打たない)
+    """
+    rotations = np.asarray(rotations, dtype=np.float64)
+    n, b = rotations.shape[:2]
+    keep = np.zeros((n, b), dtype=bool)
+    if n == 0:
+        return keep
+    if candidates is None:
+        allowed = np.ones((n, b), dtype=bool)
+        keep[0] = keep[-1] = True
+    else:
+        allowed = np.broadcast_to(np.asarray(candidates, dtype=bool), (n, b))
+        # ボーンごとに最初と最後の候補のフレームを残す
+        bones = np.flatnonzero(allowed.any(axis=0))
+        keep[np.argmax(allowed[:, bones], axis=0), bones] = True
+        keep[n - 1 - np.argmax(allowed[::-1, bones], axis=0), bones] = True
+        if not len(bones):
+            return keep
+
+    while True:
+        err = qt.angle_between(reconstruct(rotations, frame_nums, keep), rotations)
+        # ボーンごとに区間が連続するように (B, N) の順に並べる
+        e = np.where(keep | ~allowed, 0.0, err).T.ravel()
+        k = keep.T.ravel()
+        starts = np.flatnonzero(k)
+        seg_id = np.cumsum(k) - 1
+        seg_max = np.maximum.reduceat(e, starts)
+        candidates = np.flatnonzero((e > tolerance) & (e == seg_max[seg_id]))
+        if not len(candidates):
+            break
+        _, first = np.unique(seg_id[candidates], return_index=True)
+        k[candidates[first]] = True
+        keep = k.reshape(b, n).T.copy()
+
+    return keep
+
+def fit_curves(rotations, frame_nums, keep):
+    """choose the VMD rotation interpolation curve of each kept keyframe from CURVE_CANDIDATES
+
+    区間内の回転を球面上の大円(slerpの軌跡)に射影しておき、候補ごとの誤差を
+    2 * acos(|r * cos(y * theta - phi)|) で求める。(r, phi は射影の半径と角度)
+    """
+    rotations = np.asarray(rotations, dtype=np.float64)
+    n, b = rotations.shape[:2]
+    curves = np.broadcast_to(LINEAR_CURVE, (n, b, 4)).copy()
+    prev, nxt = _neighbors(keep)
+    t = _segment_time(frame_nums, prev, nxt)
+    bones = np.arange(b)
+
+    # 区間の内側のフレームを (B, N) の順に取り出す
+    inner = (~keep).T
+    if not inner.any():
+        return curves
+    q = rotations.transpose(1, 0, 2)[inner]
+    qa = rotations[prev, bones].transpose(1, 0, 2)[inner]
+    qb = rotations[nxt, bones].transpose(1, 0, 2)[inner]
+    t = t.T[inner]
+    seg_frame = nxt.T[inner]
+    seg_bone = np.broadcast_to(bones[:, None], inner.shape)[inner]
+
+    qa = qt.normalize(qa)
+    qb = qt.normalize(qb)
+    dot = np.sum(qa * qb, axis=-1)
+    qb = np.where((dot < 0)[:, None], -qb, qb)
+    theta = np.arccos(np.clip(np.abs(dot), -1.0, 1.0))
+    u = qt.normalize(qb - qa * np.abs(dot)[:, None])
+    a = np.sum(q * qa, axis=-1)
+    c = np.sum(q * u, axis=-1)
+    r = np.sqrt(a * a + c * c)
+    phi = np.arctan2(c, a)
+
+    seg_key = seg_bone * n + seg_frame
+    starts = np.flatnonzero(np.r_[True, seg_key[1:] != seg_key[:-1]])
+    # 候補の曲線は表にしておき、時刻の間は線形補間で引く
+    pos = np.clip(t, 0, 1) * (_TABLE_SIZE - 1)
+    lo = np.minimum(pos.astype(np.intp), _TABLE_SIZE - 2)
+    frac = pos - lo
+    table = bezier(CURVE_CANDIDATES[:, None, :], np.linspace(0, 1, _TABLE_SIZE)[None, :])
+
+    def score(y):
+        # cosの値が大きいほど誤差が小さい
+        return np.minimum.reduceat(np.abs(r * np.cos(y * theta - phi)), starts)
+
+    best = np.full(len(starts), -np.inf)
+    best_curve = np.zeros(len(starts), dtype=np.intp)
+    for i, row in enumerate(table):
+        s = score(row[lo] + (row[lo + 1] - row[lo]) * frac)
+        better = s > best
+        best[better] = s[better]
+        best_curve[better] = i
+
+    # 表引きの近似で直線補間より悪くなる区間(曲線の傾きが急な所)は直線補間のままにする
+    chosen = CURVE_CANDIDATES[best_curve]
+    exact = score(bezier(chosen[np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(t)]))], t))
+    linear = score(bezier(LINEAR_CURVE, t))
+    chosen[exact < linear] = LINEAR_CURVE
+    curves[seg_frame[starts], seg_bone[starts]] = chosen
+    return curves
+
+def interpolation_bytes(curves):
+    """build the 64-byte VMD interpolation blocks with the rotation curves (..., 4)
+
+    位置(X, Y, Z)は直線補間。16Byteの並びを1Byteずつずらして4回繰り返す。
+    """
+    curves = np.asarray(curves)
+    c = np.rint(np.clip(curves, 0, 1) * 127).astype(np.uint8)
+    row = np.empty(curves.shape[:-1] + (16,), dtype=np.uint8)
+    linear = np.rint(LINEAR_CURVE * 127).astype(np.uint8)
+    for i in range(4):
+        row[..., i * 4:i * 4 + 3] = linear[i]
+        row[..., i * 4 + 3] = c[..., i]
+    out = np.zeros(curves.shape[:-1] + (64,), dtype=np.uint8)
+    for k in range(4):
+        out[..., k * 16:k * 16 + 16 - k] = row[..., k:]
+        if k:
+            out[..., k * 16 + 16 - k] = 1
+    return out
+
+def reduce_keyframes(rotations, frame_nums, tolerance_deg=0.5, fit_bezier=False, candidates=None):
+    """reduce bone keyframes (N, B, 4) within tolerance_deg degrees
+
+    candidates (N, B) は間引く前のキーフレームのマスク(省略時は全フレーム)で、それ以外のフレームには
+    キーフレームを残さない。(simplify を参照)
+    戻り値は (残すキーフレームのマスク, 補間パラメータ(64Byte)またはNone, 統計情報)。
+    """
+    rotations = np.asarray(rotations, dtype=np.float64)
+    keep = simplify(rotations, frame_nums, np.radians(tolerance_deg), candidates)
+    curves = fit_curves(rotations, frame_nums, keep) if fit_bezier else None
+    interpolations = interpolation_bytes(curves) if fit_bezier else None
+
+    allowed = (np.ones(keep.shape, dtype=bool) if candidates is None
+               else np.broadcast_to(np.asarray(candidates, dtype=bool), keep.shape))
+    total = int(allowed.sum())
+    kept = int(keep.sum())
+    err = (qt.angle_between(reconstruct(rotations, frame_nums, keep, curves), rotations)[allowed] if total
+           else np.zeros(0))
+    info = {
+        'keyframes': total,
+        'kept': kept,
+        'ratio': total / kept if kept else 1.0,
+        'max_error': float(np.degrees(err.max())) if total else 0.0,
+    }
+    return keep, interpolations, info
@@ -0,0 +1,124 @@
+# landmark_cache.py - cache of estimated landmarks keyed by video and model contents
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+_hash_memo = {}
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file (memoized while size and mtime are unchanged)"""
+    st = os.stat(path)
+    memo_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    _hash_memo[memo_key] = h.hexdigest()
+    return _hash_memo[memo_key]
+
+def cache_key(video_path, model_path, variant='', video_hash=None):
+    """key of the landmarks of a video (variant distinguishes estimation settings)
+
+    video_hashを渡すと、動画のハッシュの代わりに使う。(連番画像のディレクトリなど)
+    """
+    h = hashlib.sha256()
+    h.update((video_hash or file_hash(video_path)).encode())
+    h.update(file_hash(model_path).encode())
+    h.update(variant.encode())
+    return h.hexdigest()
+
+def write_landmarks(path, frame_nums, world, image, fps, aspect=0, hands=None, frame_count=None):
+    """save landmarks to an .npz file (written to a temporary file and renamed)
+
+    aspect は画像の幅/高さ(不明の場合は0)。
+    hands (フレーム数, 2, 21, 3) は左右の手のワールド座標 (手を推定した場合のみ保存する)。
+    frame_count は動画からデコードしたフレーム数。(最後に検出したフレームより後のフレームの数が分かるように)
+    一時ファイルは書き込むたびに別の名前なので、複数のプロセスが同じファイルを同時に書いてもよい。
+    (最後に置き換えたものが残る)
+    """
+    fps = float(fps)
+    timestamps = (np.asarray(frame_nums) / fps * 1000).astype(np.int64) if fps else np.zeros(len(frame_nums), np.int64)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp.npz', prefix=os.path.basename(path) + '.',
+                               dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    arrays = {} if hands is None else {'hands': np.asarray(hands, dtype=np.float32)}
+    if frame_count:
+        arrays['frame_count'] = np.int64(frame_count)
+    try:
+        np.savez_compressed(tmp, frame_nums=np.asarray(frame_nums, dtype=np.int64),
+                            timestamps=timestamps, fps=np.float64(fps), aspect=np.float64(aspect or 0),
+                            world=np.asarray(world, dtype=np.float32),
+                            image=np.asarray(image, dtype=np.float32), **arrays)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+def read_landmarks(path):
+    """load landmarks saved by write_landmarks as a dict of arrays"""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def _remove(path):
+    """remove a file unless another process already has"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class LandmarkCache():
+    """directory of .npz files with size-based LRU eviction
+
+    各ファイルには frame_nums, timestamps(ms), fps, frame_count(デコードしたフレーム数)と、
+    world / image ((フレーム数, 33, 4) の x, y, z, visibility) を保存する。
+    読み込むたびにファイルの更新時刻を新しくし、容量を超えたら古いものから削除する。
+    複数のプロセス(vmd_batch のワーカー)が同じディレクトリを使うので、他のプロセスが
+    削除したファイルはキャッシュになかったものとして扱う。
+    """
+    def __init__(self, directory, max_bytes=2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            arrays = read_landmarks(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            print('broken landmark cache %s: %s' % (path, ex))
+            _remove(path)
+            return None
+        return arrays
+
+    def save(self, key, frame_nums, world, image, fps, aspect=0, hands=None, frame_count=None):
+        os.makedirs(self.directory, exist_ok=True)
+        write_landmarks(self.path(key), frame_nums, world, image, fps, aspect, hands, frame_count)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(os.path.join(self.directory, name))
+            total -= size
@@ -0,0 +1,218 @@
+# pipeline.py - run pipeline stages in background threads with bounded queues
+
+import contextlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class StageStats():
+    """processed item count and busy time of a pipeline stage
+
+    events にリストを渡すと、add のたびに (開始時刻, 時間, スレッドID) を記録する。(Chromeのトレース用)
+    """
+    def __init__(self, name, events=None):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.events = events
+
+    def add(self, seconds, count=1):
+        self.seconds += seconds
+        self.count += count
+        if self.events is not None:
+            self.events.append((self.name, time.perf_counter() - seconds, seconds, threading.get_ident()))
+
+    def throughput(self):
+        return self.count / self.seconds if self.seconds else 0.0
+
+def peak_rss():
+    """peak resident set size of this process in bytes (None if unknown)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Cancelled(Exception):
+    """raised by PipelineStats.check_cancelled after cancel was called"""
+
+class PipelineStats():
+    """per-stage timers, counters and other information of a conversion
+
+    trace=True の場合のみ各処理の時刻を記録する。(無効の場合のコストは add 1回につき属性の比較1回)
+    変換の途中の状態(info の frame, frame_count)を別スレッドから読み、cancel で変換を中止できる。
+    """
+    def __init__(self, trace=False):
+        self.stages = {}
+        self.counters = {}
+        self.info = {}
+        self.events = [] if trace else None
+        self.start = time.perf_counter()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """stop the conversion at the next check_cancelled (called from another thread)"""
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats(name, self.events)
+        return self.stages[name]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, summary):
+        """add the stage times and counters of summary (to_dict of another PipelineStats)
+
+        別プロセス(detect_landmarks_sharded のワーカー)の統計を合算する。PipelineStats はスレッドの
+        Event を持っていてプロセス間で受け渡せないので、to_dict の結果を渡す。トレースのイベントは合算しない。
+        """
+        for name, s in summary.get('stages', {}).items():
+            stage = self.stage(name)
+            stage.count += s['count']
+            stage.seconds += s['seconds']
+        for name, n in summary.get('counters', {}).items():
+            self.count(name, n)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        return {
+            'elapsed': self.elapsed(),
+            'stages': {s.name: {'count': s.count, 'seconds': s.seconds} for s in self.stages.values()},
+            'counters': dict(self.counters),
+            'peak_rss': peak_rss(),
+            **self.info,
+        }
+
+    def to_prometheus(self, prefix='vmd_convert'):
+        """statistics in the Prometheus text exposition format"""
+        lines = [
+            '# TYPE %s_elapsed_seconds gauge' % prefix,
+            '%s_elapsed_seconds %f' % (prefix, self.elapsed()),
+            '# TYPE %s_stage_seconds_total counter' % prefix,
+        ]
+        lines += ['%s_stage_seconds_total{stage="%s"} %f' % (prefix, s.name, s.seconds)
+                  for s in self.stages.values()]
+        lines.append('# TYPE %s_stage_items_total counter' % prefix)
+        lines += ['%s_stage_items_total{stage="%s"} %d' % (prefix, s.name, s.count)
+                  for s in self.stages.values()]
+        lines.append('# TYPE %s_events_total counter' % prefix)
+        lines += ['%s_events_total{event="%s"} %d' % (prefix, name, n) for name, n in self.counters.items()]
+        rss = peak_rss()
+        if rss is not None:
+            lines += ['# TYPE %s_peak_rss_bytes gauge' % prefix, '%s_peak_rss_bytes %d' % (prefix, rss)]
+        for name, value in self.info.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines += ['# TYPE %s_%s gauge' % (prefix, name), '%s_%s %s' % (prefix, name, value)]
+        return '\n'.join(lines) + '\n'
+
+    def to_chrome_trace(self):
+        """recorded events in the Chrome trace event format (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self.start) * 1e6, 'dur': seconds * 1e6}
+                  for name, start, seconds, tid in (self.events or [])]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.to_dict()}
+
+    def export(self, filename, fmt='json'):
+        """write the statistics to filename as json, prometheus or chrome (trace)"""
+        with open(filename, 'w', encoding='utf-8') as f:
+            if fmt == 'prometheus':
+                f.write(self.to_prometheus())
+            elif fmt == 'chrome':
+                json.dump(self.to_chrome_trace(), f)
+            else:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def report(self):
+        elapsed = self.elapsed()
+        print('elapsed: %.2fs' % elapsed)
+        for s in self.stages.values():
+            print('%-10s %8d items %8.2fs busy %8.1f items/s' % (
+                s.name, s.count, s.seconds, s.throughput()))
+        for name, n in self.counters.items():
+            print('%-10s %8d' % (name, n))
+
+@contextlib.contextmanager
+def profiling(filename=None):
+    """profile the block with cProfile and dump the result to filename (no-op if None)
+
+    結果は python -m pstats FILE や snakeviz で見られる。
+    """
+    if filename is None:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+
+class _Error():
+    def __init__(self, exc):
+        self.exc = exc
+
+_DONE = object()
+
+def background(iterable, depth):
+    """iterate over iterable in a worker thread, buffering up to depth items
+
+    要素の順序はそのまま保たれる。消費側が途中で終了した場合はワーカースレッドも停止する。
+    """
+    q = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as ex:
+            put(_Error(ex))
+        finally:
+            # 上流のステージも止める
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+            put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Error):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -1,195 +1,203 @@
 # pos2vmd.py - convert joint position data to VMD
 
-from PyQt6.QtGui import QQuaternion, QVector3D
-from VmdWriter import VmdBoneFrame, VmdInfoIk, VmdShowIkFrame
+import numpy as np
+from VmdWriter import VmdBoneFrame, VmdInfoIk, VmdShowIkFrame, bone_frame_records, encode_names
+from posisions import NAMES, PoseSequence, interpolate
+import quaternions as qt
+import rigs
+
+# ボーンの定義は rigs のリグ。事前に求めた表を使い、毎フレーム計算しない。
+_DEFAULT_RIG = rigs.get_rig()
+
+# positions_to_rotations の出力順 (デフォルトのリグ)
+BONE_NAMES = _DEFAULT_RIG.names
+
+# 手のボーン (ボーン名, 根元のランドマーク, 先のランドマーク, 親ボーンのインデックス(-1はひじ))
+# ランドマークの番号は posisions.HAND_NAMES。親指０は持たないモデルが多いので使わない。
+_HAND_BONES = [
+    ('手首', 0, 9, -1),
+    ('親指１', 2, 3, 0), ('親指２', 3, 4, 1),
+    ('人指１', 5, 6, 0), ('人指２', 6, 7, 3), ('人指３', 7, 8, 4),
+    ('中指１', 9, 10, 0), ('中指２', 10, 11, 6), ('中指３', 11, 12, 7),
+    ('薬指１', 13, 14, 0), ('薬指２', 14, 15, 9), ('薬指３', 15, 16, 10),
+    ('小指１', 17, 18, 0), ('小指２', 18, 19, 12), ('小指３', 19, 20, 13),
+]
+
+# hand_rotations の出力順 (左手、右手の順)
+HAND_BONE_NAMES = [side + name for side in ('左', '右') for name, _, _, _ in _HAND_BONES]
+
+_HAND_ROOTS = np.array([b[1] for b in _HAND_BONES])
+_HAND_TIPS = np.array([b[2] for b in _HAND_BONES])
+_HAND_PARENTS = np.array([b[3] for b in _HAND_BONES])
+
+def _hand_axes(hand, side):
+    """directions and ups (..., len(_HAND_BONES), 3) of the bones of a hand (..., 21, 3)
+
+    upは手の甲の向き。指を曲げる軸(人差し指と小指の付け根を結ぶ向き)との外積なので、
+    指を曲げても方向と平行にならない。左右で外積の向きが逆になるので、軸の向きを入れ替える。
+    (手の大きさはメートル単位で数cmなので、from_direction の閾値にかからないよう正規化する)
+    """
+    lateral = qt.normalize(hand[..., 5, :] - hand[..., 17, :])
+    if side:
+        lateral = -lateral
+    directions = qt.normalize(hand[..., _HAND_TIPS, :] - hand[..., _HAND_ROOTS, :])
+    return directions, qt.cross(directions, lateral[..., None, :])
+
+def _rest_hand(arm=(1, -1, 0)):
+    """left hand landmarks (21, 3) in the initial pose of the model
+
+    腕の初期姿勢の向き(arm、xy平面内)に伸ばし、手のひらを下に向けた状態 (親指は前に向ける)。
+    """
+    fingers = [[0.09, -0.025], [0.095, -0.008], [0.09, 0.01], [0.08, 0.027]] # 付け根の (x, z)
+    lengths = [[0.04, 0.025, 0.02], [0.045, 0.028, 0.02], [0.042, 0.026, 0.02], [0.03, 0.02, 0.018]]
+    hand = [[0, 0, 0], [0.02, -0.01, -0.02], [0.035, -0.015, -0.035], [0.05, -0.02, -0.06], [0.062, -0.025, -0.08]]
+    for (x, z), segments in zip(fingers, lengths):
+        for length in [0] + segments:
+            x += length
+            hand.append([x, 0, z])
+    hand = np.array(hand)
+    # 水平に伸ばした手を、腕の初期姿勢の向きに回す
+    c, s = np.array(arm[:2], dtype=np.float64) / np.hypot(arm[0], arm[1])
+    return np.stack([hand[:, 0] * c - hand[:, 1] * s, hand[:, 0] * s + hand[:, 1] * c, hand[:, 2]], axis=-1)
+
+_hand_initial_inv = {}
+
+def _hand_rest(rig):
+    """elbow bone indices and inverse rest rotations (2, len(_HAND_BONES), 4) of the hands of a rig
+
+    手の初期姿勢はリグのひじの初期姿勢の向きに合わせる。(リグごとに一度だけ求める)
+    """
+    if rig not in _hand_initial_inv:
+        if '左ひじ' not in rig.names or '右ひじ' not in rig.names:
+            raise ValueError('rig %s has no elbows for the hand bones' % rig.name)
+        elbows = [rig.index('左ひじ'), rig.index('右ひじ')]
+        arm = rig.rest_directions[elbows[0]]
+        _hand_initial_inv[rig] = elbows, qt.inverse(np.stack([
+            qt.from_direction(*_hand_axes(_rest_hand(arm) * [sx, 1, 1], side))
+            for side, sx in enumerate([1, -1])]))
+    return _hand_initial_inv[rig]
+
+_qt_tables = {}
+
+def _qt_table(rig):
+    """tables of a rig for positions_to_frames (QQuaternion of the inverse rest rotations)"""
+    from PyQt6.QtGui import QQuaternion
+    if rig not in _qt_tables:
+        # 点は平均するランドマークの名前のリスト
+        points = [[NAMES[j] for j, w in zip(landmarks, weights) if w]
+                  for landmarks, weights in zip(rig.landmarks.tolist(), rig.weights.tolist())]
+        bones = [(name, d, u, parent, QQuaternion(w, x, y, z))
+                 for name, d, u, parent, (x, y, z, w) in zip(rig.names, rig.direction.tolist(), rig.up.tolist(),
+                                                          rig.parents.tolist(), rig.initial_inv.tolist())]
+        _qt_tables[rig] = points, bones
+    return _qt_tables[rig]
+
+def positions_to_frames(pos, frame_num=0, rig=None):
+    """convert positions to bone frames
+
+    positions_to_rotations と同じ計算を、1フレーム分だけPyQt6で行う。
+    全ボーンのupを正規化してから fromDirection に渡す。(元は上半身のみで、他のボーンはupの長さが
+    sqrt(1e-5) 以下だと平行とみなされ、関節位置が小さいと曲げた腕や足がまっすぐ伸ばした向きになっていた)
+    """
+    # PyQt6は1フレームずつ計算する場合のみ使う (positions_to_rotations は不要)
+    from PyQt6.QtGui import QQuaternion, QVector3D
+    point_table, bone_table = _qt_table(_DEFAULT_RIG if rig is None else rigs.get_rig(rig))
+    points = []
+    for members in point_table:
+        v = pos[members[0]]
+        for name in members[1:]:
+            v = v + pos[name]
+        points.append(v / len(members) if len(members) > 1 else v)
 
-def positions_to_frames(pos, frame_num=0):
-    """convert positions to bone frames"""
     frames = []
-
-    # 解析結果から直接得られない座標の推定
-    # 首の座標 右肩と左肩の中間とする
-    neck = (pos['right_shoulder'] + pos['left_shoulder']) / 2
-    # 腰の座標 右のヒップと左のヒップの中間とする
-    waist = (pos['right_hip'] + pos['left_hip']) / 2
-    # 頭の中心座標
-    head_center = (pos['right_ear'] + pos['left_ear']) / 2
-
-    # 上半身
-    bf = VmdBoneFrame()
-    bf.name = '上半身'
-    bf.frame = frame_num
-    
-    direction = neck - waist # 首の付け根 - 腰
-    up = QVector3D.crossProduct(direction, (pos['right_shoulder'] - pos['left_shoulder'])).normalized() # 右肩 左肩
-    upper_body_orientation = QQuaternion.fromDirection(direction, up)
-    initial = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 1))
-    bf.rotation = upper_body_orientation * initial.inverted()
-    frames.append(bf)
-    upper_body_rotation = bf.rotation
-
-    # 下半身
-    bf = VmdBoneFrame()
-    bf.name = '下半身'
-    bf.frame = frame_num
-    direction = waist - neck # 腰 - 首の付け根
-    up = QVector3D.crossProduct(direction, (pos['left_hip'] - pos['right_hip']))
-    lower_body_orientation = QQuaternion.fromDirection(direction, up)
-    initial = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(0, 0, 1))
-    bf.rotation = lower_body_orientation * initial.inverted()
-    lower_body_rotation = bf.rotation
-    frames.append(bf)
-
-
-    # 首は回転させず、頭のみ回転させる
-    # 頭
-    bf = VmdBoneFrame()
-    bf.name = '頭'
-    bf.frame = frame_num
-    # 頭頂は右耳、左耳の中間座標で代価
-    # あごは回転角が知りたいだけなので、鼻で判定
-    direction = head_center - neck
-    up = QVector3D.crossProduct((pos['nose'] - neck), (head_center - pos['nose']))
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(1, 0, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = upper_body_rotation.inverted() * rotation
-    frames.append(bf)
-
-
-    # -------------------------------------------------------------------------------------------------
-    # 上半身左
-    # -------------------------------------------------------------------------------------------------
-    # 左腕
-    bf = VmdBoneFrame()
-    bf.name = '左腕'
-    bf.frame = frame_num
-    direction = pos['left_elbow'] - pos['left_shoulder'] # 左ひじ - 左肩
-    up = QVector3D.crossProduct((pos['left_elbow'] - pos['left_shoulder']), (pos['left_wrist'] - pos['left_elbow'])) # 左ひじ - 左肩, 左手首 - 左ひじ
-    orientation = QQuaternion.fromDirection(direction, up)
-    # ボーンの初期状態による　手を45度下向きにしている場合はx:1を指定
-    #initial_orientation = QQuaternion.fromDirection(QVector3D(1.73, -1, 0), QVector3D(1, 1.73, 0))
-    initial_orientation = QQuaternion.fromDirection(QVector3D(1, -1, 0), QVector3D(1, 1, 0))
-    rotation = orientation * initial_orientation.inverted()
-    # 左腕ポーンの回転から親ボーンの回転を差し引いてbf.rotationに格納する。
-    # upper_body_rotation * bf.rotation = rotation なので、
-    bf.rotation = upper_body_rotation.inverted() * rotation
-    left_arm_rotation = bf.rotation # 後で使うので保存しておく
-    frames.append(bf)
-    
-    # 左ひじ
-    bf = VmdBoneFrame()
-    bf.name = '左ひじ'
-    bf.frame = frame_num
-    direction = pos['left_wrist'] - pos['left_elbow'] #左手首 - 左ひじ
-    up = QVector3D.crossProduct((pos['left_elbow'] - pos['left_shoulder']), (pos['left_wrist'] - pos['left_elbow'])) # 左ひじ - 左肩, 左手首 - 左ひじ
-
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(1, -1, 0), QVector3D(1, 1, 0))
-    rotation = orientation * initial_orientation.inverted()
-    # 左ひじポーンの回転から親ボーンの回転を差し引いてbf.rotationに格納する。
-    # upper_body_rotation * left_arm_rotation * bf.rotation = rotation なので、
-    bf.rotation = left_arm_rotation.inverted() * upper_body_rotation.inverted() * rotation
-    # bf.rotation = (upper_body_rotation * left_arm_rotation).inverted() * rotation # 別の表現
-    frames.append(bf)
-
-
-    # -------------------------------------------------------------------------------------------------
-    # 上半身右
-    # -------------------------------------------------------------------------------------------------
-    # 右腕
-    bf = VmdBoneFrame()
-    bf.name = '右腕'
-    bf.frame = frame_num
-    direction = pos['right_elbow'] - pos['right_shoulder'] # 右ひじ - 右肩
-    up = QVector3D.crossProduct((pos['right_elbow'] - pos['right_shoulder']), (pos['right_wrist'] - pos['right_elbow'])) # 右ひじ - 右肩, 右手首 - 右ひじ
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(-1, -1, 0), QVector3D(1, -1, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = upper_body_rotation.inverted() * rotation
-    right_arm_rotation = bf.rotation
-    frames.append(bf)
-    
-    # 右ひじ
-    bf = VmdBoneFrame()
-    bf.name = '右ひじ'
-    bf.frame = frame_num
-    direction = pos['right_wrist'] - pos['right_elbow'] # 右手首 - 右ひじ
-    up = QVector3D.crossProduct((pos['right_elbow'] - pos['right_shoulder']), (pos['right_wrist'] - pos['right_elbow'])) # 右ひじ - 右肩, 右手首 - 右ひじ
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(-1, -1, 0), QVector3D(1, -1, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = right_arm_rotation.inverted() * upper_body_rotation.inverted() * rotation
-    frames.append(bf)
-
-
-    # -------------------------------------------------------------------------------------------------
-    # 下半身左
-    # -------------------------------------------------------------------------------------------------
-    # 左足
-    bf = VmdBoneFrame()
-    bf.name = '左足'
-    bf.frame = frame_num
-    direction = pos['left_knee'] - pos['left_hip'] # 左ひざ - 左脚付け根
-    up = QVector3D.crossProduct((pos['left_knee'] - pos['left_hip']), (pos['left_ankle'] - pos['left_knee'])) # 左ひざ - 左脚付け根, 左足首 - 左ひざ
-
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = lower_body_rotation.inverted() * rotation
-    left_leg_rotation = bf.rotation
-    frames.append(bf)
-    
-    # 左ひざ
-    bf = VmdBoneFrame()
-    bf.name = '左ひざ'
-    bf.frame = frame_num
-    direction = pos['left_ankle'] - pos['left_knee'] # 左足首 - 左ひざ
-    up = QVector3D.crossProduct((pos['left_knee'] - pos['left_hip']), (pos['left_ankle'] - pos['left_knee'])) # 左ひざ - 左脚付け根, 左足首 - 左ひざ
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = left_leg_rotation.inverted() * lower_body_rotation.inverted() * rotation
-    frames.append(bf)
-    
-
-    # -------------------------------------------------------------------------------------------------
-    # 下半身右
-    # -------------------------------------------------------------------------------------------------
-    # 右足
-    bf = VmdBoneFrame()
-    bf.name = '右足'
-    bf.frame = frame_num
-    direction = pos['right_knee'] - pos['right_hip'] # 右ひざ - 右脚付け根
-    up = QVector3D.crossProduct((pos['right_knee'] - pos['right_hip']), (pos['right_ankle'] - pos['right_knee'])) # 右ひざ - 右脚付け根, 右足首 - 右ひざ
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = lower_body_rotation.inverted() * rotation
-    right_leg_rotation = bf.rotation
-    frames.append(bf)
-    
-    # 右ひざ
-    bf = VmdBoneFrame()
-    bf.name = '右ひざ'
-    bf.frame = frame_num
-    direction = pos['right_ankle'] - pos['right_knee'] # 右足首 - 右ひざ
-    up = QVector3D.crossProduct((pos['right_knee'] - pos['right_hip']), (pos['right_ankle'] - pos['right_knee'])) # 右ひざ - 右脚付け根, 右足首 - 右ひざ
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = orientation * initial_orientation.inverted()
-    bf.rotation = right_leg_rotation.inverted() * lower_body_rotation.inverted() * rotation
-    frames.append(bf)
-    
-
+    rotations = []
+    for name, (d0, d1), (a0, a1, b0, b1), parent, initial_inv in bone_table:
+        direction = points[d1] - points[d0]
+        up = QVector3D.crossProduct(points[a1] - points[a0], points[b1] - points[b0]).normalized()
+        rotation = QQuaternion.fromDirection(direction, up) * initial_inv
+        rotations.append(rotation)
+        bf = VmdBoneFrame()
+        bf.name = name
+        bf.frame = frame_num
+        # 親ボーンの回転を差し引く (parent_rotation * bf.rotation = rotation)
+        bf.rotation = rotation if parent < 0 else rotations[parent].inverted() * rotation
+        frames.append(bf)
     return frames
 
-def make_showik_frames():
+def positions_to_rotations(points, rig=None):
+    """convert landmark positions (N, 33, 3) to bone rotations (N, len(rig.names), 4)
+
+    全フレームをまとめて計算する。クォータニオンは (x, y, z, w) の順。
+    rig は rigs.Rig かリグの名前 (省略時は BONE_NAMES のMMDの標準モデル)。
+    posisions.PoseSequence も渡せる(欠損したフレームは補間する)。
+    """
+    rig = _DEFAULT_RIG if rig is None else rigs.get_rig(rig)
+    rotation = _global_rotations(points, rig)
+    # 親ボーンの回転を差し引く
+    # parent_rotation * bf.rotation = rotation なので bf.rotation = parent_rotation.inverted() * rotation
+    parent = np.where((rig.parents >= 0)[:, None], qt.inverse(rotation[:, rig.parents]), qt.IDENTITY)
+    return qt.multiply(parent, rotation)
+
+def hand_rotations(points, hands, rig=None):
+    """convert hand landmarks to wrist and finger bone rotations (N, len(HAND_BONE_NAMES), 4)
+
+    points は positions_to_rotations と同じ体の関節位置、hands (N, 2, 21, 3) は左右の手のワールド座標
+    (体と同じ向きでyが上)。手首はひじ、指は手首または根元側の指からの相対回転になる。
+    手を検出できなかったフレームはNaNのまま返す。
+    """
+    rig = _DEFAULT_RIG if rig is None else rigs.get_rig(rig)
+    elbows, initial_inv = _hand_rest(rig)
+    body = _global_rotations(points, rig)
+    hands = np.asarray(hands, dtype=np.float64)
+    rotations = []
+    for side, elbow in enumerate(elbows):
+        rotation = qt.multiply(qt.from_direction(*_hand_axes(hands[:, side], side)), initial_inv[side])
+        # 親ボーン(0番目はひじ)のグローバルな回転を差し引く
+        parents = np.concatenate([body[:, elbow:elbow + 1], rotation], axis=1)[:, _HAND_PARENTS + 1]
+        local = qt.multiply(qt.inverse(parents), rotation)
+        # qt.normalize はNaNのベクトルを0にする(単位クォータニオンになる)ので、NaNに戻す
+        local[np.isnan(hands[:, side]).any(axis=(1, 2))] = np.nan
+        rotations.append(local)
+    return np.concatenate(rotations, axis=1)
+
+def _global_rotations(points, rig):
+    """global rotations (N, len(rig.names), 4) of the bones of a rig"""
+    if isinstance(points, PoseSequence):
+        points = interpolate(points.points)
+    p = rig.points(np.asarray(points, dtype=np.float64))
+    directions = p[:, rig.direction[:, 1]] - p[:, rig.direction[:, 0]]
+    ups = qt.cross(p[:, rig.up[:, 1]] - p[:, rig.up[:, 0]], p[:, rig.up[:, 3]] - p[:, rig.up[:, 2]])
+    # upを正規化して、from_direction の平行の判定(絶対値の閾値)が関節位置のスケールに依存しないようにする
+    # (positions_to_frames と同じく、閾値以下の長さのupは0として平行とみなす)
+    ups = qt.normalized(ups)
+    # 全ボーンのグローバルな回転をまとめて求める
+    return qt.multiply(qt.from_direction(directions, ups), rig.initial_inv)
+
+def rotations_to_records(rotations, frame_nums, keep=None, interpolations=None, names=BONE_NAMES):
+    """convert bone rotations (N, len(names), 4) to bone frame records
+
+    keep (N, len(names)) を指定すると、Trueのキーフレームのみ出力する。
+    interpolations (N, len(names), 64) は補間パラメータ。
+    names は回転の列のボーン名 (手のボーンを加える場合など)。
+    """
+    rotations = np.asarray(rotations)
+    if keep is None:
+        keep = np.ones(rotations.shape[:2], dtype=bool)
+    frame_idx, bone_idx = np.nonzero(keep)
+    names = encode_names(names)[bone_idx]
+    frames = np.asarray(frame_nums, dtype=np.uint32)[frame_idx]
+    if interpolations is not None:
+        interpolations = interpolations[frame_idx, bone_idx]
+    return bone_frame_records(names, frames, rotations=rotations[frame_idx, bone_idx],
+                              interpolations=interpolations)
+
+def make_showik_frames(ik=False):
+    # ikがTrueのときは足ＩＫを有効にする (足ＩＫの位置を出力する場合。つま先ＩＫは常に無効)
     frames = []
     sf = VmdShowIkFrame()
     sf.show = 1
-    sf.ik.append(VmdInfoIk('左足ＩＫ', 0))
-    sf.ik.append(VmdInfoIk('右足ＩＫ', 0))
+    sf.ik.append(VmdInfoIk('左足ＩＫ', int(ik)))
+    sf.ik.append(VmdInfoIk('右足ＩＫ', int(ik)))
     sf.ik.append(VmdInfoIk('左つま先ＩＫ', 0))
     sf.ik.append(VmdInfoIk('右つま先ＩＫ', 0))
     frames.append(sf)
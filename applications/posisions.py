@@ -1,8 +1,11 @@
+import collections
+import enum
 import numpy as np
-import scipy.fftpack
-from PyQt6.QtGui import QVector3D
 from VmdWriter import VmdBoneFrame
 
+# PyQt6(QVector3D)はフレームごとの辞書を扱う関数の中でのみimportする
+# (配列を扱う処理はPyQt6がなくても動く)
+
 """ Lifting from the Deepでの番号
 # jointの番号と説明 (3Dの番号, 2Dの番号, 説明)
 joint = [(0, None, "腰"),
@@ -60,9 +63,49 @@ NAMES = {
     32: 'right_foot_index',
 }
 
+# 関節のインデックス (Joint.LEFT_HIP == 23)
+Joint = enum.IntEnum('Joint', {name.upper(): idx for idx, name in NAMES.items()})
+
+# 手のランドマーク (MediaPipe HandLandmarker の21点)
+HAND_NAMES = {
+    0: 'wrist',
+    1: 'thumb_cmc',
+    2: 'thumb_mcp',
+    3: 'thumb_ip',
+    4: 'thumb_tip',
+    5: 'index_finger_mcp',
+    6: 'index_finger_pip',
+    7: 'index_finger_dip',
+    8: 'index_finger_tip',
+    9: 'middle_finger_mcp',
+    10: 'middle_finger_pip',
+    11: 'middle_finger_dip',
+    12: 'middle_finger_tip',
+    13: 'ring_finger_mcp',
+    14: 'ring_finger_pip',
+    15: 'ring_finger_dip',
+    16: 'ring_finger_tip',
+    17: 'pinky_mcp',
+    18: 'pinky_pip',
+    19: 'pinky_dip',
+    20: 'pinky_tip',
+}
+
+# MediaPipeのランドマークと同じ属性を持つ軽量な代替 (プロセス間で受け渡した配列から復元する)
+Landmark = collections.namedtuple('Landmark', ['x', 'y', 'z', 'visibility'])
+
+def landmarks_to_array(landmarks):
+    """convert landmarks of one pose to a (33, 4) array of x, y, z, visibility"""
+    return np.array([(l.x, l.y, l.z, l.visibility) for l in landmarks], dtype=np.float32)
+
+def array_to_landmarks(array):
+    """convert a (33, 4) array back to a list of Landmark"""
+    return [Landmark(*row) for row in array.tolist()]
+
 # -----------------------------------------------------------------
 # QVector3Dへコンバート
-def convert(pose_3d, pose_2d):
+def convert(pose_3d, pose_2d, person=0):
+    from PyQt6.QtGui import QVector3D
     positions = {
         'position': {},
         'extends': {}
@@ -70,96 +113,241 @@ def convert(pose_3d, pose_2d):
     if not pose_3d:
         return positions
     
-    # TODO: Multi person support
-    poses = pose_3d[0]
+    poses = pose_3d[person]
     position = {}
     for idx, pose in enumerate(poses):
         position[NAMES[idx]] = QVector3D(pose.x, pose.y*-1, pose.z)
 
     positions['position'] = position
-    positions['extends'][NAMES[23]] = pose_2d[0][23]
-    positions['extends'][NAMES[24]] = pose_2d[0][24]
+    positions['extends'][NAMES[23]] = pose_2d[person][23]
+    positions['extends'][NAMES[24]] = pose_2d[person][24]
 
     return positions
 
 
+def world_points(world):
+    """landmark array (..., 33, 4) to joint positions (..., 33, 3) in the same axes as convert"""
+    points = np.array(world[..., :3], dtype=np.float64)
+    points[..., 1] *= -1
+    return points
+
+def arrays_to_positions(world, image):
+    """convert landmark arrays (N, 33, 4) of world/image coordinates to a positions list"""
+    return [convert([array_to_landmarks(w)], [array_to_landmarks(i)]) for w, i in zip(world, image)]
+
+class PoseSequence():
+    """joint positions of consecutive frames in contiguous float32 arrays
+
+    points (N, 33, 3) は convert と同じ向き(yが上)のワールド座標、visibility (N, 33)、
+    image (N, 33, 4) は画像上の座標 (x, y, z, visibility)。検出できなかったフレームはNaN。
+    positions_list(フレームごとのQVector3Dの辞書)の代わりに convert 以降の処理でそのまま使える。
+    スライスは同じ配列のビューを持つ PoseSequence を返す。
+    """
+    __slots__ = ('points', 'visibility', 'image')
+
+    def __init__(self, points, visibility=None, image=None):
+        self.points = np.asarray(points, dtype=np.float32)
+        shape = self.points.shape[:2]
+        self.visibility = (np.ones(shape, dtype=np.float32) if visibility is None
+                           else np.asarray(visibility, dtype=np.float32))
+        self.image = (np.full(shape + (4,), np.nan, dtype=np.float32) if image is None
+                      else np.asarray(image, dtype=np.float32))
+
+    @classmethod
+    def from_arrays(cls, world, image):
+        """from landmark arrays (N, 33, 4) of world/image coordinates"""
+        world = np.asarray(world)
+        return cls(world_points(world), np.ascontiguousarray(world[..., 3]), image)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, index):
+        return PoseSequence(self.points[index], self.visibility[index], self.image[index])
+
+    def joint(self, joint):
+        """positions (N, 3) of a joint (Joint or name)"""
+        if isinstance(joint, str):
+            joint = Joint[joint.upper()]
+        return self.points[:, joint]
+
+    def valid(self):
+        """mask of the frames with all joint positions"""
+        return ~np.isnan(self.points).any(axis=(1, 2))
+
+    def to_positions_list(self):
+        """positions list of the same frames (QVector3Dの辞書)"""
+        from PyQt6.QtGui import QVector3D
+        positions_list = []
+        for p, i in zip(self.points.tolist(), self.image):
+            positions_list.append({
+                'position': {NAMES[j]: QVector3D(*p[j]) for j in range(len(NAMES))},
+                'extends': {NAMES[j]: Landmark(*i[j].tolist()) for j in (Joint.LEFT_HIP, Joint.RIGHT_HIP)},
+            })
+        return positions_list
+
+
 # -----------------------------------------------------------------
 # refine関連
-def interpolate(vec):
-    last_index = None
-    last_val = None
-    for i in range(0, len(vec)):
-        if vec[i] is not None:
-            if last_index is not None:
-                for j in range(last_index + 1, i):
-                    vec[j] = last_val + (vec[i] - last_val) * (j - last_index) / (i - last_index)
-            else:
-                for j in range(0, i):
-                    vec[j] = vec[i]
-            last_index = i
-            last_val = vec[i]
-
-    for i in range(last_index + 1, len(vec)):
-        vec[i] = last_val
-            
-def lowpass_filter(vec):
-    cutoff_freq = 5
-    sample_freq = 30
-    cutoff_idx = cutoff_freq * len(vec) / sample_freq
-    signal = np.array(vec)
-    transformed = scipy.fftpack.fft(signal)
-    for i in range(cutoff_idx, len(vec)):
-        transformed[i] = 0
-    filterd_signal = np.real(scipy.fftpack.ifft(transformed))
-    for i in range(0, len(vec)):
-        vec[i] = filterd_signal[i]
-    
-def smooth_position(positions_list):
+def convert_sequence(pose_3d, pose_2d, person=0):
+    """convert の PoseSequence 版 (1フレーム、検出できなかった場合は0フレーム)"""
+    if not pose_3d:
+        return PoseSequence(np.zeros((0, len(NAMES), 3)), image=np.zeros((0, len(NAMES), 4)))
+    return PoseSequence.from_arrays(landmarks_to_array(pose_3d[person])[None],
+                                    landmarks_to_array(pose_2d[person])[None])
+
+def interpolate(points):
+    """fill missing (NaN) frames of an (N, ...) array by linear interpolation
+
+    前後の有効なフレームから線形補間する。先頭/末尾の欠損は最初/最後の有効な値で埋める。
+    """
+    points = np.array(points, dtype=np.float64)
+    n = len(points)
+    flat = points.reshape(n, -1)
+    valid = ~np.isnan(flat).any(axis=1)
+    if valid.all() or not valid.any():
+        return points
+
+    idx = np.arange(n)
+    prev = np.maximum.accumulate(np.where(valid, idx, -1))
+    nxt = np.minimum.accumulate(np.where(valid, idx, n)[::-1])[::-1]
+    prev = np.where(prev < 0, nxt, prev)
+    nxt = np.where(nxt >= n, prev, nxt)
+    span = nxt - prev
+    weight = np.where(span > 0, (idx - prev) / np.maximum(span, 1), 0.0)
+    flat[:] = flat[prev] + (flat[nxt] - flat[prev]) * weight[:, None]
+    return points
+
+def lowpass_filter(points, cutoff_freq=5, sample_freq=30):
+    """cut frequencies above cutoff_freq along the time axis (axis 0)"""
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    transformed = np.fft.rfft(points, axis=0)
+    freqs = np.fft.rfftfreq(n, d=1.0 / sample_freq)
+    transformed[freqs > cutoff_freq] = 0
+    return np.fft.irfft(transformed, n=n, axis=0)
+
+def savgol_filter(points, window=9, order=2):
+    """Savitzky-Golay filter along the time axis (axis 0)
+
+    端は端の値を繰り返して延長する。
+    """
+    points = np.asarray(points, dtype=np.float64)
+    window = min(window, len(points))
+    if window % 2 == 0: # 窓の大きさは奇数
+        window -= 1
+    if window <= order:
+        return points.copy()
+    half = window // 2
+    # 窓の中心での多項式近似の値を与える係数
+    x = np.arange(-half, half + 1)
+    coeffs = np.linalg.pinv(np.vander(x, order + 1, increasing=True))[0]
+    padded = np.concatenate([np.repeat(points[:1], half, axis=0), points,
+                             np.repeat(points[-1:], half, axis=0)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0)
+    return windows @ coeffs
+
+class OneEuroFilter():
+    """One Euro filter applied to all joints at once
+
+    フレームごとに呼び出す因果的なフィルタ。freq はサンプリング周波数(fps)。
+    フレームの間隔が一定でない場合は、呼び出すときに前のサンプルからの経過時間 dt (秒) を渡す。
+    (Casiez et al., "1€ Filter: A Simple Speed-based Low-pass Filter for Noisy Input in Interactive Systems")
+    """
+    def __init__(self, freq=30, min_cutoff=1.0, beta=0.007, d_cutoff=1.0):
+        self.freq = freq
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.x = None
+        self.dx = None
+
+    def _alpha(self, cutoff, freq):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau * freq)
+
+    def __call__(self, x, dt=None):
+        x = np.asarray(x, dtype=np.float64)
+        if self.x is None:
+            self.x = x
+            self.dx = np.zeros_like(x)
+            return x
+        freq = self.freq if dt is None or dt <= 0 else 1.0 / dt
+        dx = (x - self.x) * freq
+        a_d = self._alpha(self.d_cutoff, freq)
+        self.dx = self.dx + a_d * (dx - self.dx)
+        cutoff = self.min_cutoff + self.beta * np.abs(self.dx)
+        a = self._alpha(cutoff, freq)
+        self.x = self.x + a * (x - self.x)
+        return self.x
+
+def one_euro_filter(points, freq=30, min_cutoff=1.0, beta=0.007, d_cutoff=1.0):
+    """One Euro filter along the time axis (axis 0)"""
+    f = OneEuroFilter(freq, min_cutoff, beta, d_cutoff)
+    return np.stack([f(p) for p in points]) if len(points) else np.asarray(points, dtype=np.float64)
+
+FILTERS = {
+    'lowpass': lowpass_filter,
+    'savgol': savgol_filter,
+    'oneeuro': one_euro_filter,
+}
+
+# サンプリング周波数を受け取るフィルタの引数名 (savgol はフレーム数の窓なので受け取らない)
+FILTER_RATES = {
+    'lowpass': 'sample_freq',
+    'oneeuro': 'freq',
+}
+
+def smooth_array(points, method=None, fps=None):
+    """interpolate missing frames and apply a smoothing filter to an (N, 33, 3) array
+
+    fps は points のフレームレート。省略時はフィルタのデフォルト(30fps)とみなす。
+    """
+    points = interpolate(points)
+    if method and not np.isnan(points).any():
+        kwargs = {FILTER_RATES[method]: fps} if fps and method in FILTER_RATES else {}
+        points = FILTERS[method](points, **kwargs)
+    return points
+
+def smooth_position(positions_list, method=None, fps=None):
     minimum_length = 3
     total_length = len(positions_list)
     if total_length < minimum_length:
         return
 
-    joint = []
-    for i, _ in enumerate(NAMES):
-        joint.append([[], [], []])
+    if isinstance(positions_list, PoseSequence):
+        positions_list.points[:] = smooth_array(positions_list.points, method, fps)
+        return
+
+    points = np.full((total_length, len(NAMES), 3), np.nan)
+    for i, info in enumerate(positions_list):
+        p = position_to_array(info['position'])
+        if p is not None:
+            points[i] = p
 
-    for info in positions_list:
-        pos = info['position']
-        for i, _ in enumerate(NAMES):
-            if len(pos) < i + 1:
-                joint[i][0].append(None)
-                joint[i][1].append(None)
-                joint[i][2].append(None)
-            else:
-                joint[i][0].append(pos[NAMES[i]].x())
-                joint[i][1].append(pos[NAMES[i]].y())
-                joint[i][2].append(pos[NAMES[i]].z())
-
-    for i, _ in enumerate(NAMES):
-        for j in range(0, 3):
-            interpolate(joint[i][j])
-            #lowpass_filter(joint[i][j])
-                                   
-    for i in range(0, total_length):
-        for j, _ in enumerate(NAMES):
-            p = QVector3D(joint[j][0][i], joint[j][1][i], joint[j][2][i])
-            positions_list[i]['position'][NAMES[j]] = p
+    points = smooth_array(points, method, fps)
+    if np.isnan(points).any():
+        return
+
+    from PyQt6.QtGui import QVector3D
+
+    for info, p in zip(positions_list, points.tolist()):
+        info['position'] = {NAMES[j]: QVector3D(*p[j]) for j in range(len(NAMES))}
             
             
 def normalize_for_vmd(positions_list):
+    if isinstance(positions_list, PoseSequence):
+        _normalize_sequence(positions_list)
+        return
+
     spine_len = 0
-    ground_y = float('inf')
     count = 0
     for info in positions_list:
         pos = info['position']
         if len(pos) < len(NAMES):
             continue
-        if pos['right_ankle'].y() < ground_y: # 右足首
-            ground_y = pos['right_ankle'].y()
-        if pos['left_ankle'].y() < ground_y: # 左足首
-            ground_y = pos['left_ankle'].y()
-        
+        # 地面の高さは foot_contact.detect_contacts で求める
+
         # 首の座標 右肩と左肩の中間とする
         neck = (pos['right_shoulder'] + pos['left_shoulder']) / 2
         # 腰の座標 右のヒップと左のヒップの中間とする
@@ -179,15 +367,78 @@ def normalize_for_vmd(positions_list):
         for key in pos:
             pos[key] *= scale
 
-def refine(positions_list):
-    smooth_position(positions_list)
+def _normalize_sequence(sequence):
+    points = sequence.points
+    valid = sequence.valid()
+    if not valid.any():
+        return
+    # 首は両肩の中間、腰は両ヒップの中間とする
+    neck = (points[valid, Joint.RIGHT_SHOULDER] + points[valid, Joint.LEFT_SHOULDER]) / 2
+    waist = (points[valid, Joint.RIGHT_HIP] + points[valid, Joint.LEFT_HIP]) / 2
+    spine_len = np.linalg.norm(neck - waist, axis=-1).mean()
+    points *= 3.2 / spine_len
+
+def position_to_array(pos):
+    """convert a position dict to a (33, 3) array (None if joints are missing)"""
+    if len(pos) < len(NAMES):
+        return None
+    points = np.empty((len(NAMES), 3))
+    for j in range(len(NAMES)):
+        v = pos[NAMES[j]]
+        points[j] = (v.x(), v.y(), v.z())
+    return points
+
+def to_array(positions_list):
+    """stack positions into an (N, 33, 3) array"""
+    points = np.empty((len(positions_list), len(NAMES), 3))
+    for i, info in enumerate(positions_list):
+        points[i] = position_to_array(info['position'])
+    return points
+
+def smooth_stream(items, window=30):
+    """fill gaps in a stream of (points, info) with a bounded look-ahead window
+
+    smooth_position のストリーム版。pointsがNoneのフレームは前後の有効なフレームから線形補間する。
+    先読みはwindowフレームまでで、それを超える欠損は直前の値で埋める。
+    (先頭から有効なフレームがない場合は捨てる)
+    """
+    last = None
+    pending = []
+    for points, info in items:
+        if points is None:
+            pending.append(info)
+            if len(pending) > window:
+                if last is not None:
+                    for p in pending:
+                        yield last, p
+                pending = []
+            continue
+
+        if last is None:
+            for p in pending:
+                yield points, p
+        else:
+            n = len(pending) + 1
+            for k, p in enumerate(pending, 1):
+                yield last + (points - last) * k / n, p
+        pending = []
+        last = points
+        yield points, info
+
+    if last is not None:
+        for p in pending:
+            yield last, p
+
+def refine(positions_list, method=None, fps=None):
+    smooth_position(positions_list, method, fps)
     normalize_for_vmd(positions_list)
 
 
 
 # -----------------------------------------------------------------
 # 位置補正
-def center(positions, frames, frame_num):
+def center_position(positions):
+    """center bone position (x, y, z) from the 2D hip positions"""
     # left_hip, right_hip
     p2d = positions['extends']
     x = (p2d['left_hip'].x + p2d['right_hip'].x) / 2
@@ -195,11 +446,19 @@ def center(positions, frames, frame_num):
     # 0.5, 0.5がセンターとする
     x -= 0.5
     y -= 0.5
-    
+    return (x*22.5, y*-22.5, 0)
+
+def center_positions(sequence):
+    """center bone positions (N, 3) of a PoseSequence (center_position の配列版)"""
+    hips = sequence.image[:, [Joint.LEFT_HIP, Joint.RIGHT_HIP], :2].astype(np.float64).mean(axis=1) - 0.5
+    return np.stack([hips[:, 0] * 22.5, hips[:, 1] * -22.5, np.zeros(len(hips))], axis=-1)
+
+def center(positions, frames, frame_num):
+    from PyQt6.QtGui import QVector3D
     bf = VmdBoneFrame()
     bf.name = 'センター'
     bf.frame = frame_num
-    bf.position = QVector3D(x*22.5, y*-22.5, 0)
+    bf.position = QVector3D(*center_position(positions))
     frames.append(bf)
 
 
@@ -0,0 +1,147 @@
+# quaternions.py - batched quaternion math on NumPy arrays
+#
+# クォータニオンは VMD のファイル上の並びに合わせて (x, y, z, w) の順で保持する。
+# 各関数は末尾の軸をベクトル/クォータニオンとして扱い、先頭の軸はすべてブロードキャストされる。
+# 結果は PyQt6 の QQuaternion と一致するように計算している。
+
+import numpy as np
+
+IDENTITY = np.array([0.0, 0.0, 0.0, 1.0])
+
+_FUZZY = 0.00001 # qFuzzyIsNull(float) の閾値
+
+
+def normalize(v):
+    """normalize vectors along the last axis (zero vectors are left as is)"""
+    v = np.asarray(v, dtype=np.float64)
+    n = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, n, out=np.zeros_like(v), where=n > 0)
+
+def normalized(v):
+    """normalize vectors like QVector3D.normalized (vectors not longer than the fuzzy threshold become zero)"""
+    v = np.asarray(v, dtype=np.float64)
+    n = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, n, out=np.zeros_like(v), where=n > _FUZZY)
+
+def cross(a, b):
+    """cross product along the last axis (np.cross without its per-call overhead)"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    ax, ay, az = a[..., 0], a[..., 1], a[..., 2]
+    bx, by, bz = b[..., 0], b[..., 1], b[..., 2]
+    return np.stack([ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx], axis=-1)
+
+def multiply(a, b):
+    """Hamilton product a * b"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    ax, ay, az, aw = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bx, by, bz, bw = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    return np.stack([
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+        aw * bw - ax * bx - ay * by - az * bz,
+    ], axis=-1)
+
+def inverse(q):
+    """inverse quaternion (QQuaternion.inverted)"""
+    q = np.asarray(q, dtype=np.float64)
+    len2 = np.sum(q * q, axis=-1, keepdims=True)
+    conj = q * np.array([-1.0, -1.0, -1.0, 1.0])
+    return np.divide(conj, len2, out=np.zeros_like(q), where=len2 > 0)
+
+def from_rotation_matrix(m):
+    """rotation matrices (..., 3, 3) to quaternions (QQuaternion.fromRotationMatrix)"""
+    m = np.asarray(m, dtype=np.float64)
+    shape = m.shape[:-2]
+    m = m.reshape(-1, 3, 3)
+    q = np.empty((len(m), 4))
+
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    pos = trace > 0.00000001
+    if np.any(pos):
+        r = m[pos]
+        s = 2.0 * np.sqrt(trace[pos] + 1.0)
+        q[pos, 3] = 0.25 * s
+        q[pos, 0] = (r[:, 2, 1] - r[:, 1, 2]) / s
+        q[pos, 1] = (r[:, 0, 2] - r[:, 2, 0]) / s
+        q[pos, 2] = (r[:, 1, 0] - r[:, 0, 1]) / s
+
+    # トレースが小さい場合は対角成分の最大の軸から求める
+    diag = np.stack([m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]], axis=-1)
+    axis = np.where(diag[:, 1] > diag[:, 0], 1, 0)
+    axis = np.where(diag[:, 2] > diag[np.arange(len(m)), axis], 2, axis)
+    for i in range(3):
+        sel = ~pos & (axis == i)
+        if not np.any(sel):
+            continue
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+        r = m[sel]
+        s = 2.0 * np.sqrt(r[:, i, i] - r[:, j, j] - r[:, k, k] + 1.0)
+        q[sel, i] = 0.25 * s
+        q[sel, 3] = (r[:, k, j] - r[:, j, k]) / s
+        q[sel, j] = (r[:, j, i] + r[:, i, j]) / s
+        q[sel, k] = (r[:, k, i] + r[:, i, k]) / s
+
+    return q.reshape(shape + (4,))
+
+def rotation_to(v_from, v_to):
+    """shortest arc rotation from v_from to v_to (QQuaternion.rotationTo)"""
+    v0, v1 = np.broadcast_arrays(normalize(v_from), normalize(v_to))
+    d = np.sum(v0 * v1, axis=-1) + 1.0
+    q = np.empty(v0.shape[:-1] + (4,))
+
+    opposite = np.abs(d) <= _FUZZY
+    # 逆向きの場合は任意の軸で180度回転
+    axis = cross([1.0, 0.0, 0.0], v0)
+    alt = np.sum(axis * axis, axis=-1) <= _FUZZY
+    axis = np.where(alt[..., None], cross([0.0, 1.0, 0.0], v0), axis)
+    q_opposite = np.concatenate([normalize(axis), np.zeros(d.shape + (1,))], axis=-1)
+
+    d = np.sqrt(2.0 * np.maximum(d, _FUZZY))
+    q[..., :3] = cross(v0, v1) / d[..., None]
+    q[..., 3] = d * 0.5
+    q = normalize(q)
+    return np.where(opposite[..., None], q_opposite, q)
+
+def from_direction(direction, up):
+    """orientation whose z axis points along direction (QQuaternion.fromDirection)"""
+    direction, up = np.broadcast_arrays(np.asarray(direction, dtype=np.float64),
+                                        np.asarray(up, dtype=np.float64))
+    z_axis = normalize(direction)
+    x_axis = cross(up, z_axis)
+    collinear = np.sum(x_axis * x_axis, axis=-1) <= _FUZZY
+    x_axis = normalize(x_axis)
+    y_axis = cross(z_axis, x_axis)
+    q = from_rotation_matrix(np.stack([x_axis, y_axis, z_axis], axis=-1))
+
+    # upがdirectionと平行な場合は(0, 0, 1)からの最短回転とする
+    if np.any(collinear):
+        q = np.where(collinear[..., None], rotation_to([0.0, 0.0, 1.0], z_axis), q)
+    # 方向が0の場合は単位クォータニオン
+    zero = np.all(np.abs(direction) <= _FUZZY, axis=-1)
+    return np.where(zero[..., None], IDENTITY, q)
+
+def slerp(q0, q1, t):
+    """spherical linear interpolation between q0 and q1 (t broadcasts over the leading axes)"""
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    # 短い方の弧で補間する
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    small = sin_theta < 1e-6
+    safe = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1.0 - t, np.sin((1.0 - t) * theta) / safe)
+    w1 = np.where(small, t, np.sin(t * theta) / safe)
+    return normalize(w0 * q0 + w1 * q1)
+
+def angle_between(q0, q1):
+    """rotation angle (radians) between orientations q0 and q1"""
+    dot = np.abs(np.sum(normalize(q0) * normalize(q1), axis=-1))
+    return 2.0 * np.arccos(np.clip(dot, 0.0, 1.0))
@@ -0,0 +1,159 @@
+# rigs.py - declarative bone definitions of the model rigs, compiled to index and rest-pose tables
+
+import json
+import os
+import numpy as np
+
+from posisions import NAMES
+import quaternions as qt
+
+_LANDMARKS = {name: idx for idx, name in NAMES.items()}
+
+# ランドマークの中点として定義する点 (点の名前: 平均するランドマーク)
+MMD_POINTS = {
+    'neck': ['left_shoulder', 'right_shoulder'], # 首の付け根
+    'waist': ['left_hip', 'right_hip'], # 腰
+    'head_center': ['left_ear', 'right_ear'], # 頭の中心 (頭頂の代わり)
+}
+
+# MMDの標準モデルのボーン (腕は斜め45度下に伸ばした初期姿勢)
+# (ボーン名, 親ボーン名, 方向, upを外積で求める2つのベクトル, 初期姿勢の方向, 初期姿勢のup)
+# ベクトルは (始点, 終点) の点の名前で、終点 - 始点 を表す。
+# 腕とひじ、足とひざは同じup (2ボーンの曲がる面の法線)
+MMD_BONES = [
+    ('上半身', None, ('waist', 'neck'), [('waist', 'neck'), ('left_shoulder', 'right_shoulder')],
+     (0, 1, 0), (0, 0, 1)),
+    ('下半身', None, ('neck', 'waist'), [('neck', 'waist'), ('right_hip', 'left_hip')],
+     (0, -1, 0), (0, 0, 1)),
+    # 首は回転させず、頭のみ回転させる。あごは回転角が知りたいだけなので、鼻で判定
+    ('頭', '上半身', ('neck', 'head_center'), [('neck', 'nose'), ('nose', 'head_center')],
+     (0, 1, 0), (1, 0, 0)),
+    ('左腕', '上半身', ('left_shoulder', 'left_elbow'),
+     [('left_shoulder', 'left_elbow'), ('left_elbow', 'left_wrist')], (1, -1, 0), (1, 1, 0)),
+    ('左ひじ', '左腕', ('left_elbow', 'left_wrist'),
+     [('left_shoulder', 'left_elbow'), ('left_elbow', 'left_wrist')], (1, -1, 0), (1, 1, 0)),
+    ('右腕', '上半身', ('right_shoulder', 'right_elbow'),
+     [('right_shoulder', 'right_elbow'), ('right_elbow', 'right_wrist')], (-1, -1, 0), (1, -1, 0)),
+    ('右ひじ', '右腕', ('right_elbow', 'right_wrist'),
+     [('right_shoulder', 'right_elbow'), ('right_elbow', 'right_wrist')], (-1, -1, 0), (1, -1, 0)),
+    ('左足', '下半身', ('left_hip', 'left_knee'),
+     [('left_hip', 'left_knee'), ('left_knee', 'left_ankle')], (0, -1, 0), (-1, 0, 0)),
+    ('左ひざ', '左足', ('left_knee', 'left_ankle'),
+     [('left_hip', 'left_knee'), ('left_knee', 'left_ankle')], (0, -1, 0), (-1, 0, 0)),
+    ('右足', '下半身', ('right_hip', 'right_knee'),
+     [('right_hip', 'right_knee'), ('right_knee', 'right_ankle')], (0, -1, 0), (-1, 0, 0)),
+    ('右ひざ', '右足', ('right_knee', 'right_ankle'),
+     [('right_hip', 'right_knee'), ('right_knee', 'right_ankle')], (0, -1, 0), (-1, 0, 0)),
+]
+
+def with_rest(bones, rest):
+    """bones with the rest orientations of some bones replaced (rest: {ボーン名: (方向, up)})"""
+    return [b[:4] + tuple(rest[b[0]]) if b[0] in rest else b for b in bones]
+
+def _arm_rest(direction, up):
+    # 左右の腕とひじの初期姿勢 (右は左の方向をx方向に反転し、upは手の甲側を向くよう上下に反転したもの)
+    mirrored = ((-direction[0], direction[1], 0), (up[0], -up[1], 0))
+    return {'左腕': (direction, up), '左ひじ': (direction, up), '右腕': mirrored, '右ひじ': mirrored}
+
+# 組み込みのリグ (--rig で名前を指定する)
+RIGS = {
+    'mmd': {'points': MMD_POINTS, 'bones': MMD_BONES},
+    # 腕を斜め30度下に伸ばした初期姿勢のモデル
+    'mmd30': {'points': MMD_POINTS, 'bones': with_rest(MMD_BONES, _arm_rest((1.73, -1, 0), (1, 1.73, 0)))},
+    # 腕を水平に伸ばした初期姿勢(Tポーズ)のモデル
+    'tpose': {'points': MMD_POINTS, 'bones': with_rest(MMD_BONES, _arm_rest((1, 0, 0), (0, 1, 0)))},
+}
+DEFAULT_RIG = 'mmd'
+
+class Rig():
+    """bone definitions compiled to the tables of the batched solver (pos2vmd.positions_to_rotations)
+
+    ボーンが使う点をランドマークのインデックスと重みに、ベクトルを点のインデックスの配列に変換し、
+    初期姿勢の逆回転と親ボーンのインデックスを事前に求めておく。
+    作るときに一度だけ計算するので、フレームごとの処理は配列の演算のみになる。
+    """
+    def __init__(self, name, bones, points=None):
+        points = dict(points or {})
+        self.name = name
+        self.names = [b[0] for b in bones]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('duplicate bone names in rig %s' % name)
+
+        # ボーンが使う点のみを並べる
+        point_index = {}
+        def vector(v, bone):
+            if len(v) != 2:
+                raise ValueError('bad vector %s of bone %s' % (v, bone))
+            for p in v:
+                if p not in _LANDMARKS and p not in points:
+                    raise ValueError('unknown point %s of bone %s' % (p, bone))
+                point_index.setdefault(p, len(point_index))
+            return [point_index[v[0]], point_index[v[1]]]
+
+        # (ボーン数, 2) の始点と終点のインデックス。up は2つのベクトルの外積
+        self.direction = np.array([vector(b[2], b[0]) for b in bones]).reshape(-1, 2)
+        self.up = np.array([vector(b[3][0], b[0]) + vector(b[3][1], b[0]) for b in bones]).reshape(-1, 4)
+
+        # 点は (点の数, 平均するランドマークの最大数) のランドマークのインデックスと重み
+        # (足りない分は先頭のランドマークを重み0で埋める)
+        members = [points.get(p, [p]) for p in point_index]
+        for p, m in zip(point_index, members):
+            if not m or any(name not in _LANDMARKS for name in m):
+                raise ValueError('bad landmarks %s of point %s' % (m, p))
+        width = max(len(m) for m in members) if members else 1
+        self.landmarks = np.array([[_LANDMARKS[name] for name in m] + [_LANDMARKS[m[0]]] * (width - len(m))
+                                   for m in members], dtype=np.int64).reshape(-1, width)
+        self.weights = np.array([[1 / len(m)] * len(m) + [0.0] * (width - len(m))
+                                 for m in members]).reshape(-1, width)
+        parents = []
+        for b in bones:
+            if b[1] is not None and b[1] not in self.names:
+                raise ValueError('unknown parent %s of bone %s' % (b[1], b[0]))
+            parents.append(-1 if b[1] is None else self.names.index(b[1]))
+        # 親ボーンのインデックス (-1は親なし)
+        self.parents = np.array(parents, dtype=np.int64)
+        self.rest_directions = np.array([b[4] for b in bones], dtype=np.float64).reshape(-1, 3)
+        # 各ボーンの初期姿勢の逆回転
+        self.initial_inv = qt.inverse(qt.from_direction(self.rest_directions,
+                                                        np.array([b[5] for b in bones], dtype=np.float64)))
+
+    def points(self, points):
+        """points (N, 点の数, 3) used by the bones from landmark positions (N, 33, 3)"""
+        return (points[:, self.landmarks] * self.weights[..., None]).sum(axis=2)
+
+    def index(self, bone):
+        return self.names.index(bone)
+
+def load_rig(path):
+    """Rig from a JSON file
+
+    {"points": {"neck": ["left_shoulder", "right_shoulder"]},
+     "bones": [{"name": "上半身", "parent": null, "direction": ["waist", "neck"],
+                "up": [["waist", "neck"], ["left_shoulder", "right_shoulder"]],
+                "rest": [[0, 1, 0], [0, 0, 1]]}, ...]}
+    points を省略した場合は MMD_POINTS (neck, waist, head_center) を使う。
+    """
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    try:
+        bones = [(b['name'], b.get('parent'), b['direction'], b['up'], b['rest'][0], b['rest'][1])
+                 for b in data['bones']]
+    except (KeyError, IndexError, TypeError) as ex:
+        raise ValueError('bad rig file %s: %s' % (path, ex))
+    return Rig(os.path.splitext(os.path.basename(path))[0], bones, data.get('points', MMD_POINTS))
+
+_compiled = {}
+
+def get_rig(rig=None):
+    """compiled Rig of a built-in rig name or a JSON file (DEFAULT_RIG if omitted)"""
+    if isinstance(rig, Rig):
+        return rig
+    rig = rig or DEFAULT_RIG
+    if rig not in _compiled:
+        if rig in RIGS:
+            _compiled[rig] = Rig(rig, RIGS[rig]['bones'], RIGS[rig]['points'])
+        elif os.path.isfile(rig):
+            _compiled[rig] = load_rig(rig)
+        else:
+            raise ValueError('unknown rig: %s' % rig)
+    return _compiled[rig]
@@ -0,0 +1,45 @@
+# sharding.py - split a video into overlapping segments and stitch the results
+
+import numpy as np
+
+def split_segments(frame_count, jobs, overlap):
+    """split [0, frame_count) into jobs segments
+
+    各セグメントは (start, owned, stop) で、[owned, stop) がそのセグメントの担当範囲。
+    [start, owned) は前のセグメントと重なる部分で、トラッキングの立ち上がりに使い、
+    stitchで前のセグメントの結果と混ぜ合わせる。
+    """
+    bounds = np.linspace(0, frame_count, jobs + 1).astype(int)
+    segments = []
+    for owned, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if stop <= owned:
+            continue
+        segments.append((max(owned - overlap, 0), owned, stop))
+    return segments
+
+def stitch(results, segments):
+    """join per-segment results (frame_nums, world, image) into one sequence
+
+    重なり部分で両方のセグメントが検出したフレームは、後のセグメントの重みを
+    0から1へ線形に増やしながら混ぜ合わせる。片方でしか検出されていないフレームはそのまま使う。
+    """
+    frame_nums, world, image = results[0]
+    for (nums, w, im), (start, owned, _) in zip(results[1:], segments[1:]):
+        prev_overlap = frame_nums >= start
+        new_overlap = nums < owned
+        both = np.intersect1d(frame_nums[prev_overlap], nums[new_overlap])
+        pi = np.searchsorted(frame_nums, both)
+        ni = np.searchsorted(nums, both)
+        weight = ((both - start + 1) / (owned - start + 1))[:, None, None]
+        blended_world = world[pi] * (1 - weight) + w[ni] * weight
+        blended_image = image[pi] * (1 - weight) + im[ni] * weight
+
+        keep_prev = ~np.isin(frame_nums, both)
+        keep_new = ~np.isin(nums, both)
+        frame_nums = np.concatenate([frame_nums[keep_prev], both, nums[keep_new]])
+        world = np.concatenate([world[keep_prev], blended_world, w[keep_new]])
+        image = np.concatenate([image[keep_prev], blended_image, im[keep_new]])
+        order = np.argsort(frame_nums, kind='stable')
+        frame_nums, world, image = frame_nums[order], world[order], image[order]
+
+    return frame_nums, world, image
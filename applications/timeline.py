@@ -0,0 +1,82 @@
+# timeline.py - per-frame timeline of the detections and resampling to the VMD frame rate
+
+import numpy as np
+import quaternions as qt
+
+VMD_FPS = 30 # MMDのフレームレート
+
+def effective_fps(fps):
+    """fps of the source, or VMD_FPS if it is unknown (0, None or NaN)"""
+    if not fps or not np.isfinite(fps) or fps < 0:
+        return VMD_FPS
+    return float(fps)
+
+def frame_timestamp(frame_num, fps):
+    """timestamp (ms) of a frame passed to the VIDEO mode landmarker"""
+    return int((frame_num / fps) * 1000)
+
+class Timeline():
+    """source frames from start to stop (the last decoded frame)
+
+    frame_nums は元の動画のフレーム番号、timestamps はその時刻(秒)、
+    valid はポーズが検出されたフレームのマスク。
+    推定に失敗したフレームも除かずに並べるので、VMDのフレーム番号が音声とずれない。
+    stop(デコードしたフレーム数)を渡すと、最後に検出したフレームの後も stop の手前まで並べる。
+    (省略時や、最後に検出したフレームより前の場合は、最後に検出したフレームまで)
+    keys はキーフレームを打つフレームのマスクで、検出されたフレームと最後のフレーム。
+    最後のフレームにもキーフレームを打つので、VMDの長さが元の動画と同じになる。(最後のポーズを保つ)
+    """
+    def __init__(self, detected, fps, start=0, stop=None):
+        detected = np.asarray(detected, dtype=np.int64)
+        stop = max(int(detected.max()) + 1, stop or 0) if len(detected) else start
+        self.fps = effective_fps(fps)
+        self.frame_nums = np.arange(start, stop)
+        self.timestamps = self.frame_nums / self.fps
+        self.valid = np.zeros(len(self.frame_nums), dtype=bool)
+        self.index = detected - start
+        self.valid[self.index] = True
+        self.keys = self.valid.copy()
+        self.keys[-1:] = True
+
+    def __len__(self):
+        return len(self.frame_nums)
+
+    def scatter(self, values):
+        """place the values of the detected frames on the timeline (missing frames are NaN)"""
+        values = np.asarray(values)
+        out = np.full((len(self),) + values.shape[1:], np.nan)
+        out[self.index] = values
+        return out
+
+    def resampled_times(self, fps=VMD_FPS):
+        """timestamps of the frames at fps covering the timeline"""
+        if not len(self):
+            return np.zeros(0)
+        start = self.timestamps[0]
+        count = int(np.floor((self.timestamps[-1] - start) * fps + 1e-6)) + 1
+        return start + np.arange(count) / fps
+
+def _locate(src_times, dst_times):
+    """index of the source interval containing each destination time and the position in it"""
+    src_times = np.asarray(src_times, dtype=np.float64)
+    if len(src_times) < 2:
+        zeros = np.zeros(len(dst_times), dtype=np.intp)
+        return zeros, zeros, np.zeros(len(dst_times))
+    i = np.clip(np.searchsorted(src_times, dst_times, side='right') - 1, 0, len(src_times) - 2)
+    span = src_times[i + 1] - src_times[i]
+    t = np.clip((dst_times - src_times[i]) / np.where(span > 0, span, 1), 0.0, 1.0)
+    return i, i + 1, t
+
+def resample_linear(src_times, values, dst_times):
+    """linear interpolation of values (N, ...) sampled at src_times onto dst_times"""
+    values = np.asarray(values, dtype=np.float64)
+    i0, i1, t = _locate(src_times, dst_times)
+    t = t.reshape((-1,) + (1,) * (values.ndim - 1))
+    return values[i0] + (values[i1] - values[i0]) * t
+
+def resample_rotations(src_times, rotations, dst_times):
+    """slerp of rotations (N, ..., 4) sampled at src_times onto dst_times"""
+    rotations = np.asarray(rotations, dtype=np.float64)
+    i0, i1, t = _locate(src_times, dst_times)
+    t = t.reshape((-1,) + (1,) * (rotations.ndim - 2))
+    return qt.slerp(rotations[i0], rotations[i1], t)
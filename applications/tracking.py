@@ -0,0 +1,121 @@
+# tracking.py - associate the poses detected in each frame into per-person tracks
+
+import numpy as np
+import posisions as ps
+
+# 人物の位置とみなすランドマーク (両肩と両腰)
+TORSO = [11, 12, 23, 24]
+
+def centroid(image):
+    """centre of the shoulders and hips in image coordinates (..., 33, 4) -> (..., 2)"""
+    return np.asarray(image)[..., TORSO, :2].mean(axis=-2)
+
+def assign(cost):
+    """minimum cost assignment of rows to columns (Hungarian method)
+
+    cost は (行数, 列数) の配列。行と列の対応 (rows, cols) を返す。
+    小さい方の数だけ対応付けられる。
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    # 行ごとに列を1つずつ割り当てていく (ポテンシャル付きの最短路法)
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    match = np.zeros(m + 1, dtype=np.intp) # 列に割り当てた行(1始まり、0は未割り当て)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        way = np.zeros(m + 1, dtype=np.intp)
+        used = np.zeros(m + 1, dtype=bool)
+        while match[j0]:
+            used[j0] = True
+            i0 = match[j0]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            j1 = np.argmin(np.where(free, minv[1:], np.inf)) + 1
+            delta = minv[j1]
+            u[match[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(match[1:])
+    rows = match[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+class Track():
+    def __init__(self, track_id):
+        self.track_id = track_id
+        self.frame_nums = []
+        self.world = []
+        self.image = []
+        self.last_centroid = None
+        self.last_frame = -1
+
+    def add(self, frame_num, world, image):
+        self.frame_nums.append(frame_num)
+        self.world.append(world)
+        self.image.append(image)
+        self.last_centroid = centroid(image)
+        self.last_frame = frame_num
+
+    def arrays(self):
+        """landmarks of the frames where the person was detected (frame_nums, world, image)"""
+        return (np.array(self.frame_nums, dtype=np.int64),
+                np.array(self.world, dtype=np.float32),
+                np.array(self.image, dtype=np.float32))
+
+class Tracker():
+    """assign track ids to the poses of each frame
+
+    直前の位置(画像上の肩と腰の中心)との距離をコストとしてハンガリアン法で対応付ける。
+    max_distance(画像の幅に対する割合)より離れている場合や、対応する人物がいない場合は新しいトラックとする。
+    max_missingフレームより長く検出されなかったトラックは終了する。
+    """
+    def __init__(self, max_distance=0.2, max_missing=30):
+        self.max_distance = max_distance
+        self.max_missing = max_missing
+        self.tracks = []
+        self.active = []
+
+    def update(self, frame_num, world, image):
+        """add the poses (P, 33, 4) detected in a frame and return their track ids"""
+        self.active = [t for t in self.active if frame_num - t.last_frame <= self.max_missing]
+        ids = [None] * len(image)
+        if self.active and len(image):
+            points = centroid(image)
+            previous = np.array([t.last_centroid for t in self.active])
+            cost = np.linalg.norm(points[:, None] - previous[None], axis=-1)
+            for p, k in zip(*assign(cost)):
+                if cost[p, k] <= self.max_distance:
+                    self.active[k].add(frame_num, world[p], image[p])
+                    ids[p] = self.active[k].track_id
+        for p, track_id in enumerate(ids):
+            if track_id is None:
+                track = Track(len(self.tracks))
+                track.add(frame_num, world[p], image[p])
+                self.tracks.append(track)
+                self.active.append(track)
+                ids[p] = track.track_id
+        return ids
+
+    def results(self, min_frames=1):
+        """arrays of the tracks detected in at least min_frames frames"""
+        return [t.arrays() for t in self.tracks if len(t.frame_nums) >= min_frames]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# vmd_batch.py - convert many videos/images to VMD with warm models
+#
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import time
+
+import vmd_mediapipe as vm
+from landmark_cache import LandmarkCache, file_hash
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.wmv')
+
+# ワーカープロセスごとに保持するモデル
+_landmarkers = {}
+
+def is_input_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    return ext in VIDEO_EXTENSIONS or ext in vm.IMAGE_EXTENSIONS
+
+def collect_inputs(sources):
+    """expand directories, glob patterns and manifest files into input paths
+
+    マニフェスト(.txt)は1行に1ファイルで、タブ区切りで出力先VMDファイルを指定できる。
+    戻り値は (入力ファイル, 出力ファイルまたはNone) のリスト。
+    """
+    inputs = []
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path) and is_input_file(path):
+                    inputs.append((path, None))
+        elif source.endswith('.txt') and os.path.isfile(source):
+            base = os.path.dirname(source)
+            with open(source, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    fields = line.split('\t')
+                    path = os.path.join(base, fields[0])
+                    output = os.path.join(base, fields[1]) if len(fields) > 1 else None
+                    inputs.append((path, output))
+        elif os.path.isfile(source):
+            # glob の記号を含むファイル名 (dance [1080p].mp4) はパターンとして展開しない
+            if is_input_file(source):
+                inputs.append((source, None))
+        else:
+            for path in sorted(glob.glob(source, recursive=True)):
+                if os.path.isfile(path) and is_input_file(path):
+                    inputs.append((path, None))
+    return inputs
+
+def output_path(input_file, output_dir):
+    name = os.path.splitext(os.path.basename(input_file))[0] + '.vmd'
+    return os.path.join(output_dir or os.path.dirname(input_file), name)
+
+def is_up_to_date(input_file, vmd_file, previous, use_hash):
+    """check whether vmd_file was already made from the current input_file"""
+    if not os.path.exists(vmd_file):
+        return False
+    if use_hash:
+        return previous.get('sha256') is not None and previous['sha256'] == file_hash(input_file)
+    return os.path.getmtime(vmd_file) >= os.path.getmtime(input_file)
+
+def _get_landmarkers():
+    if not _landmarkers:
+        _landmarkers['video'] = vm.ReusableLandmarker()
+        _landmarkers['image'] = vm.create_landmarker(image_mode=True)
+    return _landmarkers['video'], _landmarkers['image']
+
+def convert_one(input_file, vmd_file, center_enabled, queue_depth, use_hash, cache=None):
+    """convert a file in a worker process, reusing the process's models"""
+    result = {'input': input_file, 'output': vmd_file, 'pid': os.getpid()}
+    t = time.perf_counter()
+    try:
+        landmarker, image_landmarker = _get_landmarkers()
+        stats = vm.vmd_convert(input_file, vmd_file, center_enabled, queue_depth,
+                               landmarker=landmarker, image_landmarker=image_landmarker,
+                               cache=cache)
+        result.update(stats.to_dict())
+        result['status'] = 'converted'
+        if use_hash:
+            result['sha256'] = file_hash(input_file)
+    except Exception as ex:
+        result['status'] = 'failed'
+        result['error'] = repr(ex)
+    result['seconds'] = time.perf_counter() - t
+    return result
+
+def load_summary(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        summary = json.load(f)
+    return {entry['input']: entry for entry in summary.get('files', [])}
+
+def run_batch(sources, output_dir=None, workers=1, summary_file=None, center_enabled=False,
+              queue_depth=0, use_hash=False, force=False, cache=None):
+    start = time.perf_counter()
+    previous = load_summary(summary_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    jobs = []
+    for input_file, vmd_file in collect_inputs(sources):
+        vmd_file = vmd_file or output_path(input_file, output_dir)
+        prev = previous.get(input_file, {})
+        if not force and is_up_to_date(input_file, vmd_file, prev, use_hash):
+            entry = dict(prev, input=input_file, output=vmd_file, status='skipped')
+            results.append(entry)
+            continue
+        jobs.append((input_file, vmd_file))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(convert_one, input_file, vmd_file, center_enabled,
+                                   queue_depth, use_hash, cache)
+                   for input_file, vmd_file in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print('%s: %s (%.1fs)' % (result['status'], result['input'], result['seconds']))
+            results.append(result)
+
+    results.sort(key=lambda r: r['input'])
+    summary = {
+        'total_seconds': time.perf_counter() - start,
+        'converted': sum(r['status'] == 'converted' for r in results),
+        'skipped': sum(r['status'] == 'skipped' for r in results),
+        'failed': sum(r['status'] == 'failed' for r in results),
+        'files': results,
+    }
+    if summary_file:
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert videos/images to VMD in batch')
+    parser.add_argument('INPUT', nargs='+', help='directory, glob pattern or manifest (.txt)')
+    parser.add_argument('-o', '--output-dir', help='output directory (default: next to each input)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--summary', default=None, help='JSON summary file')
+    parser.add_argument('--center', action='store_true', help='move center bone (experimental)')
+    parser.add_argument('--queue-depth', type=int, default=8,
+                        help='queue size between decode/inference/convert threads (0: run serially)')
+    parser.add_argument('--hash', action='store_true',
+                        help='detect changed inputs by SHA-256 recorded in the summary instead of mtime')
+    parser.add_argument('--force', action='store_true', help='convert even if the output is up to date')
+    parser.add_argument('--cache-dir', default=vm.CACHE_PATH, help='landmark cache directory')
+    parser.add_argument('--cache-size', type=int, default=2048, help='landmark cache size limit in MB')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the landmark cache')
+
+    arg = parser.parse_args()
+    cache = None if arg.no_cache else LandmarkCache(arg.cache_dir, arg.cache_size << 20)
+    summary = run_batch(arg.INPUT, arg.output_dir, arg.workers, arg.summary, arg.center,
+                        arg.queue_depth, arg.hash, arg.force, cache)
+    print('converted: %d, skipped: %d, failed: %d, %.1fs' % (
+        summary['converted'], summary['skipped'], summary['failed'], summary['total_seconds']))
+
+    # ex)
+    # python3 applications/vmd_batch.py -o out --summary out/summary.json 'videos/*.mp4'
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# vmd_live.py - estimate poses from a camera/stream in real time and output VMD bone frames
+#
+
+import argparse
+import os
+import socket
+import threading
+import time
+import cv2
+import mediapipe as mp
+import numpy as np
+
+from VmdWriter import VmdWriter
+import posisions as ps
+import pos2vmd
+import rigs
+import vmd_mediapipe as vm
+
+VMD_FPS = 30
+
+class RollingVmdSink():
+    """keep the latest seconds of bone frames and rewrite a VMD file periodically
+
+    ファイルは一時ファイルに書いてから置き換えるので、読み込み側が書きかけのファイルを見ることはない。
+    """
+    def __init__(self, filename, seconds=10, interval=15):
+        self.filename = filename
+        self.max_frames = int(seconds * VMD_FPS)
+        self.interval = interval
+        self.frames = []
+        self.count = 0
+
+    def send(self, frame_num, records):
+        self.frames.append(records)
+        if len(self.frames) > self.max_frames:
+            del self.frames[:len(self.frames) - self.max_frames]
+        self.count += 1
+        if self.count % self.interval == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.frames:
+            return
+        records = np.concatenate(self.frames)
+        records['frame'] -= records['frame'].min()
+        tmp = self.filename + '.tmp'
+        VmdWriter().write_vmd_file(tmp, records, pos2vmd.make_showik_frames())
+        os.replace(tmp, self.filename)
+
+    def close(self):
+        self.flush()
+
+class SocketSink():
+    """send the bone frame records of each frame as one UDP datagram"""
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, frame_num, records):
+        self.sock.sendto(records.tobytes(), self.address)
+
+    def close(self):
+        self.sock.close()
+
+class LiveConverter():
+    """convert LIVE_STREAM results to bone frames as they arrive
+
+    推定中に次のフレームが来た場合は、キューに貯めずにそのフレームを捨てる。
+    捨てたフレームの分だけ結果の間隔が空くので、One Euro フィルタには結果のタイムスタンプの差を渡す。
+    """
+    def __init__(self, sink, min_cutoff=1.0, beta=0.007, rig=None):
+        self.sink = sink
+        self.rig = rigs.get_rig(rig)
+        self.one_euro = ps.OneEuroFilter(VMD_FPS, min_cutoff, beta)
+        self.last_timestamp_ms = None
+        self.lock = threading.Lock()
+        self.busy = False
+        self.capture_times = {}
+        self.latencies = []
+        self.solve_times = []
+        self.received = 0
+        self.dropped = 0
+        self.detected = 0
+
+    def submit(self, landmarker, image, timestamp_ms, capture_time):
+        """pass a captured frame to the landmarker unless the previous one is still running"""
+        self.received += 1
+        with self.lock:
+            if self.busy:
+                self.dropped += 1
+                return False
+            self.busy = True
+            self.capture_times[timestamp_ms] = capture_time
+        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        landmarker.detect_async(mp_image, timestamp_ms)
+        return True
+
+    def on_result(self, result, output_image, timestamp_ms):
+        """result callback of the landmarker"""
+        try:
+            capture_time = self.capture_times.pop(timestamp_ms, None)
+            pose_3d = result.pose_world_landmarks
+            if not pose_3d:
+                return
+            t = time.perf_counter()
+            dt = None if self.last_timestamp_ms is None else (timestamp_ms - self.last_timestamp_ms) / 1000
+            self.last_timestamp_ms = timestamp_ms
+            points = self.one_euro(ps.world_points(ps.landmarks_to_array(pose_3d[0])), dt)
+            rotations = pos2vmd.positions_to_rotations(points[None], self.rig)
+            frame_num = int(timestamp_ms * VMD_FPS / 1000)
+            records = pos2vmd.rotations_to_records(rotations, [frame_num], names=self.rig.names)
+            now = time.perf_counter()
+            self.solve_times.append(now - t)
+            if capture_time is not None:
+                self.latencies.append(now - capture_time)
+            self.detected += 1
+            self.sink.send(frame_num, records)
+        finally:
+            with self.lock:
+                self.busy = False
+
+    def report(self):
+        print('frames: %d received, %d dropped, %d detected' % (self.received, self.dropped, self.detected))
+        for name, values in (('capture->rotation', self.latencies), ('rotation solve', self.solve_times)):
+            if not values:
+                continue
+            p50, p90, p99 = np.percentile(np.array(values) * 1000, [50, 90, 99])
+            print('%-18s p50 %.2fms  p90 %.2fms  p99 %.2fms  max %.2fms' % (
+                name, p50, p90, p99, max(values) * 1000))
+
+def create_live_landmarker(callback):
+    BaseOptions = mp.tasks.BaseOptions
+    PoseLandmarker = mp.tasks.vision.PoseLandmarker
+    PoseLandmarkerOptions = mp.tasks.vision.PoseLandmarkerOptions
+    VisionRunningMode = mp.tasks.vision.RunningMode
+    options = PoseLandmarkerOptions(
+        base_options=BaseOptions(model_asset_path=vm.MODEL_PATH),
+        running_mode=VisionRunningMode.LIVE_STREAM,
+        result_callback=callback)
+    return PoseLandmarker.create_from_options(options)
+
+def open_capture(source):
+    # 数字はカメラのデバイス番号とみなす
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+def run_live(source, sink, realtime=False, duration=None, landmarker=None, rig=None):
+    """capture frames and feed them to a LIVE_STREAM landmarker
+
+    realtimeを指定すると、録画済みの動画をそのfpsに合わせた速さで読み込む。
+    処理が追いつかない分のフレームは捨てられるため、カメラ入力と同じ条件で試験できる。
+    rig は出力するモデルのリグ (rigs.get_rig を参照)。
+    """
+    converter = LiveConverter(sink, rig=rig)
+    own_landmarker = landmarker is None
+    if own_landmarker:
+        landmarker = create_live_landmarker(converter.on_result)
+    cap = open_capture(source)
+    fps = cap.get(cv2.CAP_PROP_FPS) or VMD_FPS
+    start = time.perf_counter()
+    last_timestamp = -1
+    frame_index = 0
+    try:
+        while cap.isOpened():
+            if realtime:
+                # 動画上の時刻まで待つ
+                delay = start + frame_index / fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            ret, image = cap.read()
+            if not ret:
+                break
+            capture_time = time.perf_counter()
+            frame_index += 1
+            timestamp_ms = int((capture_time - start) * 1000)
+            if timestamp_ms <= last_timestamp:
+                timestamp_ms = last_timestamp + 1
+            last_timestamp = timestamp_ms
+            converter.submit(landmarker, image, timestamp_ms, capture_time)
+            if duration is not None and capture_time - start >= duration:
+                break
+    finally:
+        if own_landmarker:
+            landmarker.close()
+        cap.release()
+        sink.close()
+    converter.report()
+    return converter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='estimate poses in real time and output VMD bone frames')
+    parser.add_argument('SOURCE', help='camera device number, stream URL or video file')
+    parser.add_argument('--vmd', help='rolling VMD file to rewrite periodically')
+    parser.add_argument('--vmd-seconds', type=float, default=10, help='seconds kept in the rolling VMD file')
+    parser.add_argument('--udp', help='send bone frames to HOST:PORT as UDP datagrams')
+    parser.add_argument('--realtime', action='store_true',
+                        help='read a video file at its own frame rate (offline test of the live mode)')
+    parser.add_argument('--duration', type=float, default=None, help='stop after DURATION seconds')
+    parser.add_argument('--rig', default=rigs.DEFAULT_RIG, metavar='RIG',
+                        help='bones and rest pose of the model: %s, or a JSON rig file' % ', '.join(rigs.RIGS))
+
+    arg = parser.parse_args()
+    if arg.udp:
+        host, port = arg.udp.rsplit(':', 1)
+        sink = SocketSink(host, int(port))
+    elif arg.vmd:
+        sink = RollingVmdSink(arg.vmd, arg.vmd_seconds)
+    else:
+        parser.error('--vmd or --udp is required')
+    run_live(arg.SOURCE, sink, arg.realtime, arg.duration, rig=arg.rig)
+
+    # ex)
+    # python3 applications/vmd_live.py 0 --udp 127.0.0.1:50000
+    # python3 applications/vmd_live.py applications/debug/sample.mp4 --realtime --vmd live.vmd
@@ -9,107 +9,916 @@ def usage(prog):
 
 
 import argparse
+import concurrent.futures
+import itertools
 import os
-import cv2
-import mediapipe as mp
+import time
+# cv2 と mediapipe は読み込みに時間がかかるので、使う関数の中でimportする
+# (--help やVMDの書き出しだけでは読み込まない)
 
-from VmdWriter import VmdWriter
+import numpy as np
+from VmdWriter import VmdWriter, VmdStreamWriter, bone_frame_records
 #from adjust_center import adjust_center
 import posisions as ps
 import pos2vmd
+import pipeline
+import sharding
+import landmark_cache
+import keyframes
+import adjust_center
+import tracking
+import timeline
+import estimators
+import image_sequence
+import rigs
+import foot_contact
+from adaptive import AdaptiveSettings, RoiLandmarker, select_frames
+from hands import HandSettings
+from image_sequence import SequenceSettings
+from pipeline import PipelineStats
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 PROJECT_PATH = os.path.realpath(DIR_PATH + '/..')
-MODEL_PATH = os.path.join(PROJECT_PATH, 'data/saved_sessions/pose_landmarker_full.task')
+MODEL_PATH = estimators.model_path('full')
+CACHE_PATH = os.path.join(PROJECT_PATH, 'data/landmark_cache')
 
-def vmd_convert(image_file, vmd_file, center_enabled=False):
-    image_file_path = os.path.realpath(image_file)
-    cap = cv2.VideoCapture(image_file_path)
+# 推定方法を変えたときに上げる (ランドマークのキャッシュを作り直す)
+LANDMARK_VERSION = 'v3'
 
-    # Mediapipe setting
-    BaseOptions = mp.tasks.BaseOptions
-    PoseLandmarker = mp.tasks.vision.PoseLandmarker
-    PoseLandmarkerOptions = mp.tasks.vision.PoseLandmarkerOptions
-    VisionRunningMode = mp.tasks.vision.RunningMode
-    options = PoseLandmarkerOptions(
-        base_options=BaseOptions(model_asset_path=MODEL_PATH),
-        running_mode=VisionRunningMode.VIDEO)
+IMAGE_EXTENSIONS = image_sequence.IMAGE_EXTENSIONS
 
-    landmarker = PoseLandmarker.create_from_options(options)
+def is_image_file(path):
+    # ディレクトリや frames/*.png のようなパターンは連番画像 (動画として扱う)
+    return not image_sequence.is_sequence(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
 
-    positions_list = []
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    if not fps:
-        print('fps is noset.')
-    frame_num = 0
+def resolve_center_method(center_method, contact=None):
+    """center method of a conversion (None is pnp with foot IK, 2d otherwise)
 
-    print('pose estimation start. fps:%.1f' % (fps))
-    
-    while (cap.isOpened()):
-        ret, image = cap.read()
+    足の接地はメートル単位のワールド座標で判定するので、足ＩＫを出力する場合はセンターもメートルから求める
+    pnp でなければならない。(2d のセンターは画像上の腰の位置で、単位が合わない) それ以外は ValueError。
+    """
+    if center_method is None:
+        return 'pnp' if contact is not None else '2d'
+    if center_method not in ('2d', 'pnp'):
+        raise ValueError('unknown center method: %s' % center_method)
+    if contact is not None and center_method != 'pnp':
+        raise ValueError('foot IK requires the pnp center method')
+    return center_method
+
+def create_landmarker(image_mode=False, num_poses=1, estimator=None):
+    """create a landmarker of the estimator settings (estimators.EstimatorSettings)
+
+    estimatorを省略した場合は MODEL_PATH のモデルを使う。
+    """
+    if estimator is not None:
+        return estimator.create(image_mode, num_poses)
+    return estimators.create_pose_landmarker(MODEL_PATH, image_mode, num_poses)
+
+class ReusableLandmarker():
+    """VIDEO mode landmarker shared by several videos
+
+    VIDEOモードではタイムスタンプが単調増加している必要があるため、
+    動画ごとにタイムスタンプをずらしてモデルを使いまわす。
+    """
+    def __init__(self, landmarker=None, num_poses=1):
+        self.landmarker = landmarker if landmarker is not None else create_landmarker(num_poses=num_poses)
+        self.offset = 0
+        self.last = -1
+
+    def next_video(self):
+        self.offset = self.last + 1000 # 前の動画と1秒空ける
+
+    def detect_for_video(self, mp_image, timestamp_ms):
+        self.last = timestamp_ms + self.offset
+        return self.landmarker.detect_for_video(mp_image, self.last)
+
+    def close(self):
+        self.landmarker.close()
+
+def frame_aspect(cap):
+    """width / height of the video frames (0 if unknown)"""
+    import cv2
+    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    return cap.get(cv2.CAP_PROP_FRAME_WIDTH) / height if height else 0.0
+
+def read_frames(cap, decode, start=0, stop=None, step=1):
+    """decode frames [start, stop) from the capture
+
+    stepを指定すると、フレーム番号がstepの倍数のフレームのみデコードする。(他は読み飛ばす)
+    """
+    if start:
+        import cv2
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    frame_num = start
+    while (cap.isOpened()) and (stop is None or frame_num < stop):
+        t = time.perf_counter()
+        if frame_num % step:
+            ret = cap.grab()
+            image = None
+        else:
+            ret, image = cap.read()
         if not ret:
             break
+        decode.add(time.perf_counter() - t)
+        if image is not None:
+            yield frame_num, image
+        frame_num += 1
+
+def wrap_image(image):
+    """decoded BGR image to mp.Image (None for backends without images)"""
+    if image is None:
+        return None
+    import cv2
+    import mediapipe as mp
+    # OpenCVの画像はBGRの順
+    return mp.Image(image_format=mp.ImageFormat.SRGB, data=cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
 
-        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=image)
+def estimate_poses(frames, landmarker, fps, stats, progress_interval=300, hand_detector=None):
+    """run pose estimation on decoded frames and yield (frame_num, pose_3d, pose_2d, hand_landmarks)
+
+    progress_intervalフレームごとに進捗を表示する。推定したフレーム番号は stats.info['frame'] に書き、
+    バッチごとに stats.check_cancelled で中止されていないか確認する。
+    landmarkerが detect_batch を持つ場合(estimators.BatchLandmarker)は batch_size フレームずつまとめて推定する。
+    hand_detector(hands.HandDetector)を渡すと、ポーズを推定したのと同じ画像で最初の人物の手を推定し、
+    左右の手のワールド座標 (2, 21, 3) を返す。渡さない場合は landmarker の結果の hand_world_landmarks
+    (replay で記録されていたもの)、それもなければ None。
+    """
+    wrap = stats.stage('wrap')
+    inference = stats.stage('inference')
+    hand_stage = stats.stage('hands') if hand_detector is not None else None
+    batch_size = getattr(landmarker, 'batch_size', 1) if hasattr(landmarker, 'detect_batch') else 1
+    count = 0
+    while True:
+        stats.check_cancelled()
+        batch = list(itertools.islice(frames, batch_size))
+        if not batch:
+            break
+        t = time.perf_counter()
+        mp_images = [wrap_image(image) for _, image in batch]
+        t2 = time.perf_counter()
+        wrap.add(t2 - t, len(batch))
         # pose estimation
         try:
-            pose_landmarker_result = landmarker.detect_for_video(mp_image, int((frame_num / fps) * 1000))
+            if batch_size > 1:
+                results = landmarker.detect_batch(mp_images)
+            else:
+                results = [landmarker.detect_for_video(mp_images[0], timeline.frame_timestamp(batch[0][0], fps))]
         except Exception as ex:
-            frame_num +=1
             print(ex)
+            stats.count('inference_errors', len(batch))
             continue
+        finally:
+            inference.add(time.perf_counter() - t2, len(batch))
 
-        pose_2d = pose_landmarker_result.pose_landmarks
-        pose_3d = pose_landmarker_result.pose_world_landmarks
-        if not pose_2d or not pose_3d:
-            frame_num += 1
-            continue
-    
-        #ps.dump(pose_3d, pose_2d)
-        positions = ps.convert(pose_3d, pose_2d)
-        #adjust_center(pose_2d, positions, image)
-        positions_list.append(positions)
-        
-        print('frame_num: ', frame_num)
-        frame_num += 1
-        
-        
-    # close model
-    landmarker.close()
+        for (frame_num, _), mp_image, pose_landmarker_result in zip(batch, mp_images, results):
+            count += 1
+            stats.info['frame'] = frame_num
+            if count % progress_interval == 0:
+                print('frame_num: ', frame_num)
+
+            pose_2d = pose_landmarker_result.pose_landmarks
+            pose_3d = pose_landmarker_result.pose_world_landmarks
+            if not pose_2d or not pose_3d:
+                stats.count('no_pose')
+                continue
+
+            if hand_detector is not None:
+                t = time.perf_counter()
+                hand_landmarks = hand_detector.detect(mp_image, ps.landmarks_to_array(pose_2d[0]))
+                hand_stage.add(time.perf_counter() - t)
+            else:
+                hand_landmarks = getattr(pose_landmarker_result, 'hand_world_landmarks', None)
+            yield frame_num, pose_3d, pose_2d, hand_landmarks
+
+def detect_image(image_file, landmarker=None, stats=None, num_poses=1, estimator=None):
+    """estimate the poses in a still image with IMAGE running mode and return (pose_3d, pose_2d)"""
+    if stats is None:
+        stats = PipelineStats()
+    stats.info['fps'] = 0
+    own_landmarker = landmarker is None
+    if own_landmarker:
+        landmarker = create_landmarker(image_mode=True, num_poses=num_poses, estimator=estimator)
+
+    try:
+        image = None
+        if getattr(landmarker, 'needs_frames', True):
+            import cv2
+            t = time.perf_counter()
+            image = cv2.imread(os.path.realpath(image_file))
+            if image is None:
+                raise IOError('cannot read image: ' + image_file)
+            stats.stage('decode').add(time.perf_counter() - t)
+            stats.info['aspect'] = image.shape[1] / image.shape[0]
+
+        t = time.perf_counter()
+        mp_image = wrap_image(image)
+        pose_landmarker_result = landmarker.detect(mp_image)
+        stats.stage('inference').add(time.perf_counter() - t)
+    finally:
+        if own_landmarker:
+            landmarker.close()
+
+    return pose_landmarker_result.pose_world_landmarks, pose_landmarker_result.pose_landmarks
+
+def detect_image_positions(image_file, landmarker=None, stats=None):
+    """estimate the pose in a still image with IMAGE running mode"""
+    pose_3d, pose_2d = detect_image(image_file, landmarker, stats)
+    if not pose_2d or not pose_3d:
+        return []
+    return [ps.convert(pose_3d, pose_2d)]
+
+def estimate_video(image_file, queue_depth=0, stats=None, landmarker=None, start=0, stop=None,
+                   adaptive=None, estimator=None, hands=None, frames=None):
+    """estimate poses in frames [start, stop) and yield (frame_num, pose_3d, pose_2d, hand_landmarks)
+
+    queue_depthが1以上の場合、デコードと推定をそれぞれ別スレッドで実行し、
+    ステージ間をqueue_depthの大きさのキューでつなぐ。
+    landmarkerを渡した場合はそれを使い、終了時に閉じない。
+    渡さない場合は estimator(estimators.EstimatorSettings)の設定でモデルを作る。
+    adaptive(adaptive.AdaptiveSettings)を渡すと、推定するフレームを間引き、人物の周りを切り出して推定する。
+    画像を使わないlandmarker(needs_frames が False)の場合、動画はデコードせず、stepのみ適用する。
+    最後まで推定すると、stats.info['frame_count'] はデコードしたフレーム数になる。(timeline.Timeline の stop)
+    hands(hands.HandSettings)を渡すと、デコードした画像の手首の周りで手も推定する。(estimate_poses を参照)
+    image_fileがディレクトリかglobのパターンの場合は連番画像として読み込む。
+    frames(image_sequence.SequenceSettings)でフレームレート、順序、デコードのスレッド数などを指定する。
+    """
+    if stats is None:
+        stats = PipelineStats()
+    own_landmarker = landmarker is None
+    if own_landmarker:
+        landmarker = create_landmarker(estimator=estimator)
+    elif isinstance(landmarker, ReusableLandmarker):
+        landmarker.next_video()
+
+    cap = None
+    if getattr(landmarker, 'needs_frames', True) and image_sequence.is_sequence(image_file):
+        cap = (frames or SequenceSettings()).open(image_file)
+        fps = cap.fps
+        stats.info['aspect'] = cap.aspect
+        stats.info['frame_count'] = cap.frame_count
+    elif getattr(landmarker, 'needs_frames', True):
+        import cv2
+        cap = cv2.VideoCapture(os.path.realpath(image_file))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        stats.info['aspect'] = frame_aspect(cap)
+        stats.info['frame_count'] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+    else:
+        fps = landmarker.fps
+        stats.info['aspect'] = landmarker.aspect
+        stats.info['frame_count'] = getattr(landmarker, 'frame_count', 0)
+    if not fps:
+        print('fps is noset.')
+        fps = timeline.effective_fps(fps)
+    stats.info['fps'] = fps
+
+    print('pose estimation start. fps:%.1f' % (fps))
     
-    ps.refine(positions_list)
-    bone_frames = []
-    frame_num = 0
-    for positions in positions_list:
-        if positions is None:
-            frame_num += 1
-            continue
-        frames = pos2vmd.positions_to_frames(positions['position'], frame_num)
-        if center_enabled:
-            ps.center(positions, frames, frame_num)
+    step = 1
+    detector = landmarker
+    if adaptive is not None:
+        # 動きで判定する場合は全フレームをデコードする
+        step = adaptive.step if adaptive.motion_threshold is None or cap is None else 1
+        if adaptive.roi_size and cap is not None:
+            detector = RoiLandmarker(landmarker, adaptive.roi_size, adaptive.margin)
+    if cap is None:
+        decoded = landmarker.frames(start, stop, step)
+    elif isinstance(cap, image_sequence.FrameSequence):
+        decoded = cap.frames(stats.stage('decode'), start, stop, step)
+    else:
+        decoded = read_frames(cap, stats.stage('decode'), start, stop, step)
+    if adaptive is not None and adaptive.motion_threshold is not None and cap is not None:
+        decoded = select_frames(decoded, adaptive.step, adaptive.motion_threshold)
+    if queue_depth > 0:
+        decoded = pipeline.background(decoded, queue_depth)
+    hand_detector = hands.create(stats) if hands is not None and cap is not None else None
+    results = estimate_poses(decoded, detector, fps, stats, hand_detector=hand_detector)
+    if queue_depth > 0:
+        results = pipeline.background(results, queue_depth)
 
-        bone_frames.extend(frames)
-        frame_num += 1
+    try:
+        yield from results
+        # 動画のヘッダのフレーム数は正確とは限らないので、最後まで読んだ位置に置き換える
+        if cap is not None and not isinstance(cap, image_sequence.FrameSequence):
+            import cv2
+            stats.info['frame_count'] = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    finally:
+        # 推定スレッドを止めてからモデルを閉じる
+        results.close()
+        # close model
+        if own_landmarker:
+            landmarker.close()
+        if hand_detector is not None:
+            hand_detector.close()
+        if cap is not None:
+            cap.release()
+
+def detect_positions(image_file, queue_depth=0, stats=None, landmarker=None, adaptive=None, estimator=None,
+                     frames=None):
+    """estimate poses frame by frame and yield (frame_num, converted positions)
+
+    推定に失敗したフレームも、位置が空のまま順に返す。(最後に検出したフレームの後も、デコードしたフレームまで)
+    """
+    if stats is None:
+        stats = PipelineStats()
+    convert = stats.stage('convert')
+    results = estimate_video(image_file, queue_depth, stats, landmarker, adaptive=adaptive, estimator=estimator,
+                             frames=frames)
+    try:
+        next_frame = 0
+        for frame_num, pose_3d, pose_2d, _ in results:
+            for missing in range(next_frame, frame_num):
+                yield missing, ps.convert(None, None)
+            t = time.perf_counter()
+            #ps.dump(pose_3d, pose_2d)
+            positions = ps.convert(pose_3d, pose_2d)
+            #adjust_center(pose_2d, positions, image)
+            convert.add(time.perf_counter() - t)
+            next_frame = frame_num + 1
+            yield frame_num, positions
+        for missing in range(next_frame, stats.info.get('frame_count') or 0):
+            yield missing, ps.convert(None, None)
+    finally:
+        results.close()
+
+def detect_landmarks(image_file, queue_depth=0, stats=None, landmarker=None, start=0, stop=None,
+                     adaptive=None, estimator=None, hands=None, frames=None):
+    """estimate poses and return arrays of the detected frames
+
+    フレーム番号、ワールド座標、画像上の座標(x, y, z, visibility)の配列を返す。
+    hands(hands.HandSettings)を渡した場合は、左右の手のワールド座標 (フレーム数, 2, 21, 3)
+    (検出できなかった手はNaN)を4つ目に返す。
+    """
+    frame_nums, world, image, hand_landmarks = [], [], [], []
+    missing_hands = np.full((2, len(ps.HAND_NAMES), 3), np.nan, dtype=np.float32)
+    for frame_num, pose_3d, pose_2d, hand in estimate_video(image_file, queue_depth, stats, landmarker,
+                                                            start, stop, adaptive, estimator, hands,
+                                                            frames):
+        frame_nums.append(frame_num)
+        world.append(ps.landmarks_to_array(pose_3d[0]))
+        image.append(ps.landmarks_to_array(pose_2d[0]))
+        if hands is not None:
+            hand_landmarks.append(missing_hands if hand is None else hand)
+
+    shape = (-1, len(ps.NAMES), 4)
+    landmarks = (np.array(frame_nums, dtype=np.int64),
+                 np.array(world, dtype=np.float32).reshape(shape),
+                 np.array(image, dtype=np.float32).reshape(shape))
+    if hands is None:
+        return landmarks
+    return landmarks + (np.array(hand_landmarks, dtype=np.float32).reshape((-1,) + missing_hands.shape),)
+
+def detect_tracks(image_file, num_poses, queue_depth=0, stats=None, landmarker=None, min_frames=15,
+                  adaptive=None, estimator=None, frames=None):
+    """estimate the poses of up to num_poses persons and split them into tracks
+
+    1回の推定で全員のポーズを求め、tracking.Trackerでフレーム間の人物を対応付ける。
+    min_framesフレーム未満しか検出されなかったトラック(誤検出)は捨てる。
+    戻り値は人物ごとの (フレーム番号, ワールド座標, 画像上の座標) のリスト。
+    """
+    if stats is None:
+        stats = PipelineStats()
+    tracker = tracking.Tracker()
+    if is_image_file(image_file):
+        pose_3d, pose_2d = detect_image(image_file, landmarker, stats, num_poses, estimator)
+        poses = [(0, pose_3d, pose_2d, None)] if pose_3d and pose_2d else []
+        min_frames = 1
+        own_landmarker = False
+    else:
+        own_landmarker = landmarker is None
+        if own_landmarker:
+            landmarker = create_landmarker(num_poses=num_poses, estimator=estimator)
+        poses = estimate_video(image_file, queue_depth, stats, landmarker, adaptive=adaptive, frames=frames)
+
+    track = stats.stage('track')
+    try:
+        for frame_num, pose_3d, pose_2d, _ in poses:
+            t = time.perf_counter()
+            world = np.array([ps.landmarks_to_array(p) for p in pose_3d])
+            image = np.array([ps.landmarks_to_array(p) for p in pose_2d])
+            tracker.update(frame_num, world, image)
+            track.add(time.perf_counter() - t)
+    finally:
+        if own_landmarker:
+            poses.close()
+            landmarker.close()
+    return tracker.results(min_frames)
+
+def detect_segment(image_file, start, stop, adaptive=None, estimator=None, frames=None):
+    """estimate poses in frames [start, stop) (runs in a worker process)
+
+    (detect_landmarks の結果, 統計の to_dict) を返す。
+    """
+    stats = PipelineStats()
+    result = detect_landmarks(image_file, stats=stats, start=start, stop=stop, adaptive=adaptive,
+                              estimator=estimator, frames=frames)
+    return result, stats.to_dict()
+
+def detect_landmarks_sharded(image_file, jobs, overlap=30, stats=None, adaptive=None, estimator=None,
+                             frames=None):
+    """estimate poses with jobs worker processes, one per time segment
+
+    各プロセスがそれぞれ自分のモデルを持ち、CAP_PROP_POS_FRAMESでシークして担当区間を処理する。
+    (連番画像の場合は担当区間のファイルのみ読む)
+    区間の境目はoverlapフレームだけ重ねて推定し、sharding.stitchでつなぎ合わせる。
+    各ワーカーの処理時間とカウンタは stats に合算する。(重ねたフレームは両方の区間で数える)
+    """
+    import cv2
+    if stats is None:
+        stats = PipelineStats()
+    if image_sequence.is_sequence(image_file):
+        sequence = (frames or SequenceSettings()).open(image_file)
+        frame_count = sequence.frame_count
+        stats.info['fps'] = sequence.fps
+        stats.info['aspect'] = sequence.aspect
+    else:
+        cap = cv2.VideoCapture(os.path.realpath(image_file))
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        stats.info['fps'] = cap.get(cv2.CAP_PROP_FPS)
+        stats.info['aspect'] = frame_aspect(cap)
+        cap.release()
+    if frame_count <= 0:
+        print('frame count is unknown. fall back to a single process.')
+        return detect_landmarks(image_file, stats=stats, adaptive=adaptive, estimator=estimator, frames=frames)
+
+    stats.info['frame_count'] = frame_count
+    segments = sharding.split_segments(frame_count, jobs, overlap)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(detect_segment, image_file, start, stop, adaptive, estimator, frames)
+                   for start, _, stop in segments]
+        results = []
+        for future in futures:
+            result, summary = future.result()
+            results.append(result)
+            stats.merge(summary)
+
+    return sharding.stitch(results, segments)
+
+def load_landmarks(image_file, queue_depth=0, jobs=1, overlap=30, stats=None, landmarker=None,
+                   cache=None, rebuild_cache=False, adaptive=None, estimator=None, hands=None, frames=None):
+    """estimate landmarks of a video, or load them from the landmark cache
+
+    (フレーム番号, ワールド座標, 画像上の座標, 手のワールド座標) を返す。手は hands を渡した場合のみで、
+    それ以外は None。手を推定する場合はプロセスを分割しない。
+    記録したランドマークを読み込むだけの replay ではキャッシュもプロセスの分割も使わない。
+    連番画像のキャッシュのキーは、画像の内容ではなくファイルの一覧から求める。(image_sequence.sequence_hash)
+    """
+    if stats is None:
+        stats = PipelineStats()
+    if estimator is not None and estimator.backend == 'replay':
+        cache = None
+        jobs = 1
+    if hands is not None:
+        jobs = 1
+    key = None
+    if cache is not None:
+        video_hash = None
+        if image_sequence.is_sequence(image_file):
+            if frames is None:
+                frames = SequenceSettings()
+            video_hash = image_sequence.sequence_hash(image_sequence.list_frames(image_file, frames.order))
+        key = landmark_cache.cache_key(image_file, MODEL_PATH if estimator is None else estimator.model_path,
+                                       LANDMARK_VERSION + (adaptive.key() if adaptive is not None else '') +
+                                       (estimator.key() if estimator is not None else '') +
+                                       (hands.key() if hands is not None else '') +
+                                       (frames.key() if video_hash is not None else ''),
+                                       video_hash)
+        cached = None if rebuild_cache else cache.load(key)
+        if cached is not None:
+            print('landmark cache hit: ' + cache.path(key))
+            stats.info['fps'] = float(cached['fps'])
+            stats.info['aspect'] = float(cached['aspect']) if 'aspect' in cached else 0.0
+            stats.info['frame_count'] = int(cached['frame_count']) if 'frame_count' in cached else 0
+            stats.info['cache'] = 'hit'
+            return cached['frame_nums'], cached['world'], cached['image'], cached.get('hands')
+        stats.info['cache'] = 'miss'
 
-    showik_frames = pos2vmd.make_showik_frames()
+    hand_landmarks = None
+    if jobs > 1:
+        frame_nums, world, image = detect_landmarks_sharded(image_file, jobs, overlap, stats, adaptive,
+                                                            estimator, frames)
+    elif hands is not None:
+        frame_nums, world, image, hand_landmarks = detect_landmarks(image_file, queue_depth, stats, landmarker,
+                                                                    adaptive=adaptive, estimator=estimator,
+                                                                    hands=hands, frames=frames)
+    else:
+        frame_nums, world, image = detect_landmarks(image_file, queue_depth, stats, landmarker,
+                                                    adaptive=adaptive, estimator=estimator, frames=frames)
+    if cache is not None:
+        cache.save(key, frame_nums, world, image, stats.info.get('fps') or 0, stats.info.get('aspect'),
+                   hand_landmarks, stats.info.get('frame_count'))
+    return frame_nums, world, image, hand_landmarks
+
+def write_vmd(vmd_file, sequence, line, stats, center_enabled=False, smoothing=None,
+              reduce_tolerance=None, fit_bezier=False, resample=False, center_method=None, aspect=None,
+              hands=None, rig=None, contact=None):
+    """refine positions, solve bone rotations and write them to vmd_file
+
+    sequence(posisions.PoseSequence)は line(timeline.Timeline)の各フレームの位置で、
+    検出できなかったフレームは平滑化の際に前後から補間される。キーフレームは検出できたフレームと、
+    VMDの長さを元の動画に合わせるための最後のフレームにのみ打つ。(timeline.Timeline の keys)
+    resampleを指定すると、元の動画のfpsから30fpsに変換する。
+    center_methodは 2d (画像上の腰の位置) または pnp (adjust_center.root_motion、aspectは画像の幅/高さ)。
+    (省略時と足ＩＫを出力する場合は resolve_center_method を参照)
+    hands (len(line), 2, 21, 3) を渡すと、手首と指のボーンも出力する。(hand_sequence を参照)
+    rig(rigs.Rig またはリグの名前)で出力するボーンと初期姿勢を指定する。(省略時はMMDの標準モデル)
+    contact(foot_contact.ContactSettings)を渡すと、足の接地を判定して足ＩＫとセンターの位置を出力し、
+    足ＩＫを有効にする。(センターは接地した足が地面に付く高さになる)
+    """
+    rig = rigs.get_rig(rig)
+    center_method = resolve_center_method(center_method, contact)
+    centers = None
+    ik = None
+    if (center_enabled or contact is not None) and center_method == 'pnp':
+        t = time.perf_counter()
+        # 平滑化と正規化の前のワールド座標(メートル、MediaPipeの軸)を使う
+        centers = adjust_center.root_motion(sequence.points * [1, -1, 1], sequence.image, sequence.visibility,
+                                            aspect, stats=stats, fps=line.fps)
+        stats.stage('center').add(time.perf_counter() - t, len(sequence))
+    t = time.perf_counter()
+    ps.smooth_position(sequence, smoothing, line.fps)
+    if contact is not None:
+        stats.stage('refine').add(time.perf_counter() - t, len(sequence))
+        t = time.perf_counter()
+        # 接地の判定は正規化の前のワールド座標(メートル)と pnp のセンターで、全フレームをまとめて行う
+        detected, ik, centers, info = foot_contact.foot_ik(sequence.points, line.fps, centers, contact)
+        stats.stage('foot_ik').add(time.perf_counter() - t, len(sequence))
+        stats.info.update(info)
+        print('foot contact: left %.0f%%, right %.0f%%, slide %.3f m/s' % (
+            info['contact_left'] * 100, info['contact_right'] * 100, info['foot_slide']))
+        t = time.perf_counter()
+    ps.normalize_for_vmd(sequence)
+    stats.stage('refine').add(time.perf_counter() - t, len(sequence))
+    t = time.perf_counter()
+    rotations = pos2vmd.positions_to_rotations(sequence, rig)
+    stats.stage('solve').add(time.perf_counter() - t, len(rotations))
+    frame_nums = line.frame_nums
+    keep = np.broadcast_to(line.keys[:, None], rotations.shape[:2])
+    names = rig.names
+    if hands is not None:
+        t = time.perf_counter()
+        hand_rotations, hand_keep, hand_names = hand_sequence(sequence, hands, smoothing, rig, line.fps)
+        rotations = np.concatenate([rotations, hand_rotations], axis=1)
+        keep = np.concatenate([keep, hand_keep], axis=1)
+        names = names + hand_names
+        stats.stage('solve_hands').add(time.perf_counter() - t, len(rotations))
+    if center_enabled and centers is None:
+        centers = ps.center_positions(sequence)
+    if resample:
+        times = line.resampled_times()
+        rotations = timeline.resample_rotations(line.timestamps, rotations, times)
+        if centers is not None:
+            centers = timeline.resample_linear(line.timestamps, centers, times)
+        if ik is not None:
+            ik = timeline.resample_linear(line.timestamps, ik.reshape(len(ik), -1), times).reshape(-1, 2, 3)
+        frame_nums = np.rint(times * timeline.VMD_FPS).astype(np.int64)
+        keep = None
+
+    if reduce_tolerance is None:
+        bone_frames = pos2vmd.rotations_to_records(rotations, frame_nums, keep, names=names)
+    else:
+        t = time.perf_counter()
+        # 検出できなかったフレーム(keep が False)には、間引く前と同じくキーフレームを打たない
+        keep, interpolations, info = keyframes.reduce_keyframes(rotations, frame_nums,
+                                                                 reduce_tolerance, fit_bezier, keep)
+        stats.stage('reduce').add(time.perf_counter() - t, len(rotations))
+        stats.info.update(info)
+        print('keyframes: %d -> %d (%.1fx), max error %.3f deg' % (
+            info['keyframes'], info['kept'], info['ratio'], info['max_error']))
+        bone_frames = pos2vmd.rotations_to_records(rotations, frame_nums, keep, interpolations, names)
+    if centers is not None:
+        center_keep = slice(None) if resample else line.keys
+        center_frames = bone_frame_records(['センター'] * len(centers[center_keep]),
+                                           frame_nums[center_keep], centers[center_keep])
+        bone_frames = np.concatenate([bone_frames, center_frames])
+    if ik is not None:
+        ik_keep = slice(None) if resample else line.keys
+        ik_frames = bone_frame_records(np.repeat([foot_contact.IK_BONE_NAMES], len(ik[ik_keep]), axis=0).ravel(),
+                                       np.repeat(frame_nums[ik_keep], 2), ik[ik_keep].reshape(-1, 3))
+        bone_frames = np.concatenate([bone_frames, ik_frames])
+
+    t = time.perf_counter()
+    showik_frames = pos2vmd.make_showik_frames(ik is not None)
     writer = VmdWriter()
     writer.write_vmd_file(vmd_file, bone_frames, showik_frames)
+    stats.stage('write').add(time.perf_counter() - t, len(bone_frames))
+
+def hand_sequence(sequence, hands, smoothing=None, rig=None, fps=None):
+    """wrist and finger bone rotations of the hands detected at least once
+
+    hands (フレーム数, 2, 21, 3) は各フレームの左右の手のワールド座標(MediaPipeの軸)で、検出できなかった手はNaN。
+    手ごとに欠損を補間して平滑化し、回転、キーフレームを打つフレーム(その手を検出できたフレーム)、ボーン名を返す。
+    一度も検出できなかった手のボーンは出力しない。
+    """
+    hands = np.asarray(hands, dtype=np.float64)
+    detected = ~np.isnan(hands).any(axis=(2, 3))
+    sides = np.flatnonzero(detected.any(axis=0))
+    points = np.stack([ps.smooth_array(hands[:, side] * [1, -1, 1], smoothing, fps) for side in range(2)], axis=1)
+    rotations = pos2vmd.hand_rotations(sequence, points, rig)
+    bones = len(pos2vmd.HAND_BONE_NAMES) // 2
+    columns = (sides[:, None] * bones + np.arange(bones)).ravel()
+    return (rotations[:, columns], np.repeat(detected[:, sides], bones, axis=1),
+            [pos2vmd.HAND_BONE_NAMES[c] for c in columns])
+
+def timeline_sequence(line, world, image):
+    """PoseSequence of every frame of the timeline
+
+    検出できなかったフレームの関節位置はNaNとし、平滑化で補間させる。
+    画像上の座標(センターの計算に使う)はここで補間しておく。
+    """
+    return ps.PoseSequence.from_arrays(line.scatter(world), ps.interpolate(line.scatter(image)))
+
+def person_vmd_path(vmd_file, index):
+    """VMD file name of the index-th person (out.vmd -> out_1.vmd)"""
+    base, ext = os.path.splitext(vmd_file)
+    return '%s_%d%s' % (base, index + 1, ext or '.vmd')
+
+def vmd_convert(image_file, vmd_file, center_enabled=False, queue_depth=0, jobs=1, overlap=30,
+                landmarker=None, image_landmarker=None, cache=None, rebuild_cache=False,
+                smoothing=None, reduce_tolerance=None, fit_bezier=False, num_poses=1, resample=False,
+                adaptive=None, estimator=None, record=None, center_method=None, hands=None, frames=None,
+                rig=None, contact=None, stats=None):
+    """convert a video, image sequence or still image to a VMD file and return the pipeline stats
+
+    静止画はIMAGEモードで推定する。landmarker(VIDEOモード)、image_landmarker(IMAGEモード)を
+    渡すと、モデルを作り直さずにそれを使う。
+    ディレクトリやglobのパターン(frames/*.png)は連番画像として動画と同じく推定し、
+    frames(image_sequence.SequenceSettings)でフレームレートや順序、デコードのスレッド数を指定する。
+    cache(LandmarkCache)を渡すと、動画の推定結果をキャッシュから読み込む/保存する。
+    smoothingには posisions.FILTERS のフィルタ名を指定する。
+    reduce_toleranceに角度(度)を指定すると、その誤差で復元できるキーフレームを間引く。
+    fit_bezierを指定すると、間引いた区間に合わせて補間曲線を設定する。
+    num_posesが2以上の場合は複数人を推定し、人物ごとに person_vmd_path のファイルへ出力する。
+    (この場合、キャッシュと jobs は使用しない)
+    VMDのフレーム番号は元の動画のフレーム番号とし、resampleを指定すると30fpsに変換する。
+    adaptive(adaptive.AdaptiveSettings)を渡すと、動画の一部のフレームのみ推定し、間は補間する。
+    estimator(estimators.EstimatorSettings)で推定のバックエンドを指定する。(landmarkerを渡さない場合)
+    recordにファイル名を指定すると、動画から推定したランドマークを保存する。(replayで読み込める)
+    center_methodはセンターの位置の求め方 (write_vmd を参照)。
+    hands(hands.HandSettings)を渡すと、動画の手首の周りで手を推定し、手首と指のボーンも出力する。
+    (1人の動画のみ、静止画と num_poses が2以上の場合は使用しない)
+    rig(rigs.Rig またはリグの名前)で出力するモデルのボーンと初期姿勢を指定する。(write_vmd を参照)
+    contact(foot_contact.ContactSettings)を渡すと、足の接地から足ＩＫとセンターの位置を出力する。(write_vmd を参照)
+    stats(PipelineStats)を渡すと、その中に各ステージの時間などを記録する。
+    """
+    if stats is None:
+        stats = PipelineStats()
+    # 推定する前にオプションを確かめる
+    center_method = resolve_center_method(center_method, contact)
+    if num_poses > 1:
+        tracks = detect_tracks(image_file, num_poses, queue_depth, stats,
+                               image_landmarker if is_image_file(image_file) else landmarker,
+                               adaptive=adaptive, estimator=estimator, frames=frames)
+        stats.info['persons'] = len(tracks)
+        stats.info['frames'] = sum(len(frame_nums) for frame_nums, _, _ in tracks)
+        print('persons: %d' % len(tracks))
+        for i, (frame_nums, world, image) in enumerate(tracks):
+            line = timeline.Timeline(frame_nums, stats.info.get('fps'), frame_nums[0], stats.info.get('frame_count'))
+            t = time.perf_counter()
+            sequence = timeline_sequence(line, world, image)
+            stats.stage('convert').add(time.perf_counter() - t, len(sequence))
+            write_vmd(person_vmd_path(vmd_file, i), sequence, line, stats,
+                      center_enabled, smoothing, reduce_tolerance, fit_bezier, resample,
+                      center_method, stats.info.get('aspect'), rig=rig, contact=contact)
+        stats.report()
+        return stats
+
+    if is_image_file(image_file):
+        sequence = ps.convert_sequence(*detect_image(image_file, image_landmarker, stats, estimator=estimator))
+        line = timeline.Timeline(range(len(sequence)), timeline.VMD_FPS)
+        hand_landmarks = None
+    else:
+        frame_nums, world, image, hand_landmarks = load_landmarks(image_file, queue_depth, jobs, overlap, stats,
+                                                                  landmarker, cache, rebuild_cache, adaptive,
+                                                                  estimator, hands, frames)
+        if record:
+            landmark_cache.write_landmarks(record, frame_nums, world, image, stats.info.get('fps') or 0,
+                                           stats.info.get('aspect'), hand_landmarks, stats.info.get('frame_count'))
+        line = timeline.Timeline(frame_nums, stats.info.get('fps'), stop=stats.info.get('frame_count'))
+        t = time.perf_counter()
+        sequence = timeline_sequence(line, world, image)
+        if hand_landmarks is not None:
+            hand_landmarks = line.scatter(hand_landmarks)
+            stats.info['hands_detected'] = int((~np.isnan(hand_landmarks[..., 0, 0])).sum())
+        stats.stage('convert').add(time.perf_counter() - t, len(sequence))
+    stats.info['frames'] = len(sequence)
+    stats.info['detected'] = int(line.valid.sum())
+    stats.check_cancelled()
     
+    write_vmd(vmd_file, sequence, line, stats, center_enabled, smoothing,
+              reduce_tolerance, fit_bezier, resample, center_method, stats.info.get('aspect'), hand_landmarks,
+              rig, contact)
+    stats.report()
+    return stats
+
+def _one_euro_stream(smoothed, stats):
+    """apply the One Euro filter to a stream of (points, (frame_num, positions))
+
+    フィルタの時間の間隔は、フレーム番号と動画のfps(最初のフレームを推定したときに分かる)から求める。
+    """
+    one_euro = ps.OneEuroFilter()
+    last = None
+    for points, (frame_num, positions) in smoothed:
+        fps = timeline.effective_fps(stats.info.get('fps'))
+        dt = None if last is None else (frame_num - last) / fps
+        last = frame_num
+        yield one_euro(points, dt), (frame_num, positions)
+
+def vmd_convert_stream(image_file, vmd_file, center_enabled=False, window=30, chunk_size=256,
+                       queue_depth=0, smoothing=None, reduce_tolerance=None, fit_bezier=False,
+                       adaptive=None, estimator=None, frames=None, rig=None, stats=None):
+    """convert with constant memory and return the pipeline stats
+
+    検出、欠損補間、回転の計算、VMDへの書き出しをフレームの流れに沿って行い、
+    chunk_sizeフレームごとにファイルへ書き込む。
+    全フレームの背骨の長さが分からないので normalize_for_vmd は行わない。回転の計算は
+    upを正規化して行うので、upの長さが from_direction の閾値以下になる退化したフレームを除き、
+    オフラインの変換(vmd_convert)と同じ回転になる。
+    平滑化は因果的なフィルタ(oneeuro)のみ使用できる。
+    キーフレームの間引きはチャンクごとに行う(チャンクの先頭と末尾のフレームは常に残る)。
+    推定に失敗したフレームは前後から補間し、元の動画と同じフレーム番号で出力する。
+    """
+    if smoothing not in (None, 'oneeuro'):
+        raise ValueError('only oneeuro smoothing is available in streaming mode')
+    if stats is None:
+        stats = PipelineStats()
+    rig = rigs.get_rig(rig)
+    items = ((ps.position_to_array(positions['position']), (frame_num, positions))
+             for frame_num, positions in detect_positions(image_file, queue_depth, stats,
+                                                          adaptive=adaptive, estimator=estimator,
+                                                          frames=frames))
+    smoothed = ps.smooth_stream(items, window)
+    if smoothing == 'oneeuro':
+        smoothed = _one_euro_stream(smoothed, stats)
+
+    total = kept = 0
+    max_error = 0.0
+    with VmdStreamWriter(vmd_file) as writer:
+        while True:
+            chunk = list(itertools.islice(smoothed, chunk_size))
+            if not chunk:
+                break
+            t = time.perf_counter()
+            frame_nums = np.array([frame_num for _, (frame_num, _) in chunk], dtype=np.int64)
+            rotations = pos2vmd.positions_to_rotations(np.stack([points for points, _ in chunk]), rig)
+            if reduce_tolerance is None:
+                records = pos2vmd.rotations_to_records(rotations, frame_nums, names=rig.names)
+            else:
+                keep, interpolations, info = keyframes.reduce_keyframes(rotations, frame_nums,
+                                                                         reduce_tolerance, fit_bezier)
+                records = pos2vmd.rotations_to_records(rotations, frame_nums, keep, interpolations, rig.names)
+                total += info['keyframes']
+                kept += info['kept']
+                max_error = max(max_error, info['max_error'])
+            t2 = time.perf_counter()
+            stats.stage('solve').add(t2 - t, len(chunk))
+            writer.write_bone_frames(records)
+            if center_enabled:
+                center_frames = []
+                for _, (frame_num, positions) in chunk:
+                    if positions['extends']:
+                        ps.center(positions, center_frames, frame_num)
+                writer.write_bone_frames(center_frames)
+            stats.stage('write').add(time.perf_counter() - t2, len(chunk))
 
+        writer.close(pos2vmd.make_showik_frames())
+    if reduce_tolerance is not None and kept:
+        stats.info.update(keyframes=total, kept=kept, ratio=total / kept, max_error=max_error)
+        print('keyframes: %d -> %d (%.1fx), max error %.3f deg' % (total, kept, total / kept, max_error))
+    stats.report()
+    return stats
 
    
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='estimate 3D pose and generate VMD motion')
     parser.add_argument('--center', action='store_true', help='move center bone (experimental)')
+    parser.add_argument('--center-method', choices=['2d', 'pnp'], default=None,
+                        help='center position from the 2D hip position, or from PnP root motion estimation '
+                             '(default: 2d, pnp with --foot-ik)')
+    parser.add_argument('--stream', action='store_true', help='write VMD incrementally with constant memory')
+    parser.add_argument('--window', type=int, default=30, help='look-ahead frames for gap filling in --stream mode')
+    parser.add_argument('--queue-depth', type=int, default=8,
+                        help='queue size between decode/inference/convert threads (0: run serially)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='split the video into JOBS segments estimated by separate processes')
+    parser.add_argument('--overlap', type=int, default=30,
+                        help='frames shared by adjacent segments in --jobs mode')
+    parser.add_argument('--smooth', choices=sorted(ps.FILTERS), default=None,
+                        help='smoothing filter for joint positions (only oneeuro in --stream mode)')
+    parser.add_argument('--step', type=int, default=1,
+                        help='adaptive mode: infer every STEP frames and interpolate the others')
+    parser.add_argument('--motion-threshold', type=float, default=None,
+                        help='adaptive mode: infer when the image changed more than this (0-255), at least every STEP frames')
+    parser.add_argument('--roi-size', type=int, default=None,
+                        help='adaptive mode: crop around the previous landmarks and downscale to ROI_SIZE pixels')
+    parser.add_argument('--resample', action='store_true',
+                        help='resample the motion from the video frame rate to 30fps')
+    parser.add_argument('--num-poses', type=int, default=1,
+                        help='maximum number of persons; each person is written to VMD_FILE_1.vmd, VMD_FILE_2.vmd ...')
+    parser.add_argument('--backend', choices=estimators.BACKENDS, default='mediapipe',
+                        help='pose estimation backend (batch: IMAGE mode models run in parallel, '
+                             'replay: landmarks recorded by --record)')
+    parser.add_argument('--model', choices=estimators.MODEL_VARIANTS, default='full',
+                        help='pose landmarker model variant')
+    parser.add_argument('--delegate', choices=estimators.DELEGATES, default='cpu', help='inference device')
+    parser.add_argument('--threads', type=int, default=4, help='models run in parallel by the batch backend')
+    parser.add_argument('--replay', default=None, metavar='FILE', help='landmark file read by the replay backend')
+    parser.add_argument('--record', default=None, metavar='FILE',
+                        help='save the estimated landmarks to FILE (.npz) for --backend replay')
+    parser.add_argument('--hands', action='store_true',
+                        help='estimate hands on crops around the wrists and add wrist and finger bones')
+    parser.add_argument('--hand-visibility', type=float, default=0.5, metavar='MIN',
+                        help='skip hand estimation when the wrist visibility is below MIN (with --hands)')
+    parser.add_argument('--fps', type=float, default=None,
+                        help='frame rate of an image sequence (IMAGE_FILE is a directory or a glob pattern)')
+    parser.add_argument('--frame-order', choices=image_sequence.ORDERS, default='natural',
+                        help='order of the image sequence files (natural: numbers in the names compared as numbers)')
+    parser.add_argument('--decode-threads', type=int, default=4, help='threads decoding the image sequence')
+    parser.add_argument('--read-ahead', type=int, default=16,
+                        help='frames of the image sequence decoded ahead of the pose estimation')
+    parser.add_argument('--decode-scale', type=int, choices=image_sequence.REDUCE_FACTORS, default=1,
+                        help='decode the image sequence at 1/DECODE_SCALE resolution (fast for JPEG)')
+    parser.add_argument('--rig', default=rigs.DEFAULT_RIG, metavar='RIG',
+                        help='bones and rest pose of the model: %s, or a JSON rig file' % ', '.join(rigs.RIGS))
+    parser.add_argument('--foot-ik', action='store_true',
+                        help='detect foot contacts and write leg IK and center positions (enables leg IK)')
+    parser.add_argument('--contact-height', type=float, default=0.06, metavar='M',
+                        help='sole height above the ground below which a foot is in contact (meters)')
+    parser.add_argument('--contact-speed', type=float, default=0.5, metavar='M/S',
+                        help='horizontal foot speed below which a foot is in contact (meters per second)')
+    parser.add_argument('--reduce', type=float, default=None, metavar='DEG',
+                        help='drop bone keyframes reconstructable within DEG degrees')
+    parser.add_argument('--bezier', action='store_true',
+                        help='fit interpolation curves to the reduced keyframes (with --reduce)')
+    parser.add_argument('--cache-dir', default=CACHE_PATH, help='landmark cache directory')
+    parser.add_argument('--cache-size', type=int, default=2048, help='landmark cache size limit in MB')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the landmark cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='ignore cached landmarks and estimate again')
+    parser.add_argument('--stats', default=None, metavar='FILE', help='write per-stage statistics to FILE')
+    parser.add_argument('--stats-format', choices=['json', 'prometheus', 'chrome'], default='json',
+                        help='format of --stats (chrome: trace of every stage call for chrome://tracing)')
+    parser.add_argument('--profile', default=None, metavar='FILE', help='profile the conversion with cProfile')
     parser.add_argument('IMAGE_FILE')
     parser.add_argument('VMD_FILE')
     
     arg = parser.parse_args()
-    vmd_convert(arg.IMAGE_FILE, arg.VMD_FILE, arg.center)
+    adaptive = AdaptiveSettings(arg.step, arg.motion_threshold, arg.roi_size)
+    adaptive = adaptive if adaptive.enabled else None
+    if arg.bezier and arg.reduce is None:
+        parser.error('--bezier requires --reduce')
+    if arg.stream and arg.num_poses > 1:
+        parser.error('--stream supports only one person')
+    if arg.stream and arg.resample:
+        parser.error('--resample is not available in --stream mode')
+    if arg.stream and arg.smooth not in (None, 'oneeuro'):
+        parser.error('--stream supports only --smooth oneeuro')
+    if (arg.backend == 'replay') != (arg.replay is not None):
+        parser.error('--replay FILE is required by (and only used with) --backend replay')
+    if arg.stream and arg.center_method == 'pnp':
+        parser.error('--center-method pnp is not available in --stream mode')
+    if arg.record and (arg.stream or arg.num_poses > 1):
+        parser.error('--record is not available with --stream or --num-poses')
+    if arg.hands and (arg.stream or arg.num_poses > 1 or arg.jobs > 1 or is_image_file(arg.IMAGE_FILE)):
+        parser.error('--hands is available only for videos of one person without --stream or --jobs')
+    if arg.foot_ik and arg.stream:
+        parser.error('--foot-ik is not available in --stream mode')
+    if arg.foot_ik and arg.center_method == '2d':
+        parser.error('--foot-ik requires --center-method pnp')
+    hands = HandSettings(arg.hand_visibility, delegate=arg.delegate) if arg.hands else None
+    contact = foot_contact.ContactSettings(arg.contact_height, arg.contact_speed) if arg.foot_ik else None
+    try:
+        rig = rigs.get_rig(arg.rig)
+    except ValueError as ex:
+        parser.error(str(ex))
+    frames = SequenceSettings(arg.fps, arg.frame_order, arg.decode_threads, arg.read_ahead, arg.decode_scale)
+    estimator = estimators.EstimatorSettings(arg.backend, arg.model, arg.delegate, arg.threads, arg.replay)
+    stats = PipelineStats(trace=arg.stats is not None and arg.stats_format == 'chrome')
+    with pipeline.profiling(arg.profile):
+        if arg.stream:
+            vmd_convert_stream(arg.IMAGE_FILE, arg.VMD_FILE, arg.center, arg.window,
+                               queue_depth=arg.queue_depth, smoothing=arg.smooth,
+                               reduce_tolerance=arg.reduce, fit_bezier=arg.bezier, adaptive=adaptive,
+                               estimator=estimator, frames=frames, rig=rig, stats=stats)
+        else:
+            cache = None if arg.no_cache else landmark_cache.LandmarkCache(arg.cache_dir, arg.cache_size << 20)
+            vmd_convert(arg.IMAGE_FILE, arg.VMD_FILE, arg.center, arg.queue_depth,
+                        arg.jobs, arg.overlap, cache=cache, rebuild_cache=arg.rebuild_cache,
+                        smoothing=arg.smooth, reduce_tolerance=arg.reduce, fit_bezier=arg.bezier,
+                        num_poses=arg.num_poses, resample=arg.resample, adaptive=adaptive,
+                        estimator=estimator, record=arg.record, center_method=arg.center_method, hands=hands,
+                        frames=frames, rig=rig, contact=contact, stats=stats)
+    if arg.stats:
+        stats.export(arg.stats, arg.stats_format)
 
     # ex)
     # python3 applications/vmd_mediapipe.py applications/debug/pose.jpg applications/debug/test.vmd
     # python3 applications/vmd_mediapipe.py applications/debug/dummy.png applications/debug/test.vmd
     # python3 applications/vmd_mediapipe.py applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --model lite --record sample.npz applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --backend replay --replay sample.npz applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --hands applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --rig tpose applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --foot-ik applications/debug/sample.mp4 applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --fps 60 applications/debug/frames applications/debug/test.vmd
+    # python3 applications/vmd_mediapipe.py --fps 60 --decode-scale 2 'applications/debug/frames/*.jpg' applications/debug/test.vmd
     
 
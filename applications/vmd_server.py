@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+#
+# vmd_server.py - local conversion service with warm models and an asynchronous job queue
+#
+
+import argparse
+import contextlib
+import http.server
+import itertools
+import json
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import vmd_mediapipe as vm
+import estimators
+import posisions as ps
+import rigs
+from foot_contact import ContactSettings
+import image_sequence
+from image_sequence import SequenceSettings
+from landmark_cache import LandmarkCache
+from pipeline import Cancelled, PipelineStats
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# ジョブごとに指定できる vmd_convert の引数 (名前: (引数名, 型))
+OPTIONS = {
+    'center': ('center_enabled', bool),
+    'center_method': ('center_method', str),
+    'smooth': ('smoothing', str),
+    'reduce': ('reduce_tolerance', float),
+    'bezier': ('fit_bezier', bool),
+    'resample': ('resample', bool),
+    'rig': ('rig', str),
+}
+
+class ServiceBusy(Exception):
+    """raised by submit when the job queue is full"""
+
+def check_input(input_file):
+    """raise ValueError unless input_file is a regular file or an image sequence with frames"""
+    if os.path.isfile(input_file):
+        return
+    if image_sequence.is_sequence(input_file) and image_sequence.list_frames(input_file):
+        return
+    raise ValueError('input file not found: %s' % input_file)
+
+def job_options(options):
+    """vmd_convert keyword arguments of the options of a job (ValueError for unknown or invalid ones)
+
+    replay にファイルを指定すると、そのジョブは記録したランドマークを読み込んで変換する。(モデルを使わない)
+    fps と frame_order は入力が連番画像(ディレクトリかglobのパターン)の場合に使う。
+    foot_ik を true にすると、足の接地から足ＩＫとセンターの位置を出力する。(center_method は pnp のみ)
+    """
+    options = dict(options or {})
+    kwargs = {}
+    replay = options.pop('replay', None)
+    if replay is not None:
+        if not os.path.isfile(replay):
+            raise ValueError('replay file not found: %s' % replay)
+        kwargs['estimator'] = estimators.EstimatorSettings('replay', replay=replay)
+    fps = options.pop('fps', None)
+    order = options.pop('frame_order', 'natural')
+    if fps is not None or order != 'natural':
+        kwargs['frames'] = SequenceSettings(None if fps is None else float(fps), order)
+    foot_ik = options.pop('foot_ik', False)
+    if not isinstance(foot_ik, bool):
+        raise ValueError('foot_ik must be true or false')
+    if foot_ik:
+        kwargs['contact'] = ContactSettings()
+    for name, value in options.items():
+        if name not in OPTIONS:
+            raise ValueError('unknown option: %s' % name)
+        key, type_ = OPTIONS[name]
+        if type_ is bool and not isinstance(value, bool):
+            raise ValueError('%s must be true or false' % name)
+        kwargs[key] = type_(value)
+    if kwargs.get('smoothing') is not None and kwargs['smoothing'] not in ps.FILTERS:
+        raise ValueError('unknown smoothing filter: %s' % kwargs['smoothing'])
+    kwargs['center_method'] = vm.resolve_center_method(kwargs.get('center_method'), kwargs.get('contact'))
+    if 'rig' in kwargs and kwargs['rig'] not in rigs.RIGS:
+        raise ValueError('unknown rig: %s' % kwargs['rig'])
+    if kwargs.get('fit_bezier') and kwargs.get('reduce_tolerance') is None:
+        raise ValueError('bezier requires reduce')
+    return kwargs
+
+class LandmarkerPool():
+    """pre-initialized pairs of landmarkers (VIDEO and IMAGE mode) lent to the jobs
+
+    起動時にsize組のモデルを作っておき、ジョブごとに1組を貸して、終わったら返してもらう。
+    VIDEOモードのモデルは vmd_mediapipe.ReusableLandmarker でタイムスタンプをずらして使いまわす。
+    (batch バックエンドはタイムスタンプを使わないのでそのまま使う)
+    """
+    def __init__(self, size, estimator=None):
+        self.free = queue.Queue()
+        self.landmarkers = []
+        for _ in range(size):
+            video = vm.create_landmarker(estimator=estimator)
+            if estimator is None or estimator.backend == 'mediapipe':
+                video = vm.ReusableLandmarker(video)
+            pair = (video, vm.create_landmarker(image_mode=True, estimator=estimator))
+            self.landmarkers.append(pair)
+            self.free.put(pair)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        pair = self.free.get()
+        try:
+            yield pair
+        finally:
+            self.free.put(pair)
+
+    def close(self):
+        for video, image in self.landmarkers:
+            video.close()
+            image.close()
+        self.landmarkers = []
+
+class Job():
+    """a conversion request, its state and timings
+
+    queue_wait(キューで待った時間)、run_time(変換にかかった時間)、throughput(1秒あたりのフレーム数)を報告する。
+    進捗は変換中の stats(PipelineStats)の info の frame, frame_count から求める。
+    """
+    def __init__(self, job_id, input_file, output, kwargs, upload=False):
+        self.id = job_id
+        self.input = input_file
+        self.output = output
+        self.kwargs = kwargs
+        self.upload = upload
+        self.state = QUEUED
+        self.error = None
+        self.stats = PipelineStats()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        info = self.stats.info
+        now = time.time()
+        run_time = ((self.finished or now) - self.started) if self.started else None
+        frames = info.get('frames', 0)
+        d = {
+            'id': self.id,
+            'state': self.state,
+            'input': None if self.upload else self.input,
+            'output': self.output,
+            'frame': info.get('frame'),
+            'frame_count': info.get('frame_count'),
+            # キューで待っている間にキャンセルされた場合は、キャンセルされるまでの時間
+            'queue_wait': (self.started or self.finished or now) - self.submitted,
+            'run_time': run_time,
+        }
+        if self.state == DONE:
+            d['frames'] = frames
+            d['throughput'] = frames / run_time if run_time else 0.0
+            d['stages'] = {s.name: {'count': s.count, 'seconds': s.seconds} for s in self.stats.stages.values()}
+            d['counters'] = dict(self.stats.counters)
+        if self.error is not None:
+            d['error'] = self.error
+        return d
+
+class ConversionService():
+    """asynchronous conversion jobs run by worker threads with warm models
+
+    max_jobs 個のワーカースレッドがキューからジョブを取り出し、プールのモデルで vmd_convert を実行する。
+    実行待ちのジョブが max_queue 個ある場合、submit は ServiceBusy を送出する。(アドミッション制御)
+    終了したジョブは新しいものから max_history 個まで保持する。
+    pool_size を0にするとモデルを作らない (replay のジョブのみ受け付ける)。
+    出力するファイルは output_dir の中に限る。(output_path を参照)
+    """
+    def __init__(self, max_jobs=2, max_queue=8, estimator=None, output_dir=None, cache=None,
+                 pool_size=None, max_history=256):
+        self.max_jobs = max(int(max_jobs), 1)
+        self.max_queue = max(int(max_queue), 1)
+        self.estimator = estimator
+        self.cache = cache
+        self.max_history = max_history
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix='vmd_server_')
+        self.upload_dir = os.path.join(self.output_dir, 'uploads')
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.pool = LandmarkerPool(self.max_jobs if pool_size is None else pool_size, estimator)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.queued = 0
+        self.running = 0
+        self.ids = itertools.count(1)
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.max_jobs)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, input_file, options=None, output=None, upload=False):
+        """queue a conversion of input_file and return its Job
+
+        uploadを指定すると、input_fileは一時ファイルとみなし、変換後に削除する。
+        input_file(アップロード以外)と replay のファイルがなければ、キューに入れずに ValueError を送出する。
+        """
+        kwargs = job_options(options)
+        if 'estimator' not in kwargs and not self.pool.landmarkers:
+            raise ValueError('no models are loaded; only replay jobs are accepted')
+        if not upload:
+            check_input(input_file)
+        output_file = None if output is None else self.output_path(output)
+        with self.lock:
+            if self.queued >= self.max_queue:
+                raise ServiceBusy('%d jobs are waiting' % self.queued)
+            job_id = '%d' % next(self.ids)
+            job = Job(job_id, input_file, output_file or os.path.join(self.output_dir, job_id + '.vmd'), kwargs,
+                      upload)
+            self.jobs[job_id] = job
+            self.queued += 1
+            self._forget()
+        self.pending.put(job)
+        return job
+
+    def output_path(self, output):
+        """path of an output file name relative to output_dir (ValueError if it is outside output_dir)
+
+        シンボリックリンクをたどった先で判定する。アップロードしたファイルのディレクトリには書かせない。
+        """
+        root = os.path.realpath(self.output_dir)
+        uploads = os.path.realpath(self.upload_dir)
+        path = os.path.realpath(os.path.join(root, output))
+        if (path == root or os.path.commonpath([root, path]) != root or
+                os.path.commonpath([uploads, path]) == uploads):
+            raise ValueError('output must be a file in the output directory: %s' % output)
+        return path
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """cancel a queued or running job (False if it has already finished)"""
+        job = self.jobs.get(job_id)
+        with self.lock:
+            if job is None or job.state in FINISHED:
+                return False
+            if job.state == QUEUED:
+                # ワーカーはキャンセルされたジョブを取り出しても実行しない
+                self.queued -= 1
+                self._finish(job, CANCELLED)
+                return True
+        job.stats.cancel()
+        return True
+
+    def status(self):
+        with self.lock:
+            states = [job.state for job in self.jobs.values()]
+            return {
+                'max_jobs': self.max_jobs,
+                'max_queue': self.max_queue,
+                'models': len(self.pool.landmarkers),
+                'queued': self.queued,
+                'running': self.running,
+                **{state: states.count(state) for state in FINISHED},
+            }
+
+    def close(self):
+        """cancel the remaining jobs, stop the workers and close the models"""
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        for _ in self.workers:
+            self.pending.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.pool.close()
+
+    def _forget(self):
+        finished = [job for job in self.jobs.values() if job.state in FINISHED]
+        for job in finished[:max(len(finished) - self.max_history, 0)]:
+            del self.jobs[job.id]
+
+    def _finish(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        job.finished = time.time()
+        if job.upload and os.path.exists(job.input):
+            os.remove(job.input)
+        job.done.set()
+
+    def _worker(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.state != QUEUED:
+                    continue
+                self.queued -= 1
+                self.running += 1
+                job.state = RUNNING
+                job.started = time.time()
+            try:
+                self._run(job)
+                state, error = DONE, None
+            except Cancelled:
+                state, error = CANCELLED, None
+            except Exception as ex:
+                state, error = FAILED, repr(ex)
+            with self.lock:
+                self.running -= 1
+                self._finish(job, state, error)
+
+    def _run(self, job):
+        kwargs = dict(job.kwargs)
+        if 'estimator' in kwargs:
+            # replay は記録したランドマークを読むだけなので、プールのモデルを使わない
+            vm.vmd_convert(job.input, job.output, stats=job.stats, **kwargs)
+            return
+        with self.pool.acquire() as (landmarker, image_landmarker):
+            vm.vmd_convert(job.input, job.output, landmarker=landmarker, image_landmarker=image_landmarker,
+                           cache=self.cache, estimator=self.estimator, stats=job.stats, **kwargs)
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP API of the ConversionService (self.server.service)
+
+    POST /jobs                   JSON {"input": パス, "output": パス(省略可), "options": {...}} でジョブを登録する
+                                 (Content-Type は application/json、output は --output-dir からの相対パス)
+    POST /jobs?filename=a.mp4    本文を動画/画像ファイルとしてアップロードしてジョブを登録する (オプションはクエリで指定)
+                                 (Content-Type は application/octet-stream)
+    GET /jobs/ID                 ジョブの状態
+    GET /jobs/ID/events          終了するまで進捗を1行1つのJSONで送り続ける
+    GET /jobs/ID/result          出力したVMDファイル
+    DELETE /jobs/ID              ジョブのキャンセル
+    GET /status                  キューの状態
+    """
+    protocol_version = 'HTTP/1.0'
+    event_interval = 0.2
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print('%s %s' % (self.command, format % args))
+
+    def _send_json(self, code, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self, job_id):
+        job = self.server.service.get(job_id)
+        if job is None:
+            self._send_json(404, {'error': 'job not found: %s' % job_id})
+        return job
+
+    def _route(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        return parts, dict(urllib.parse.parse_qsl(url.query))
+
+    def do_GET(self):
+        parts, _ = self._route()
+        if parts == ['status']:
+            self._send_json(200, self.server.service.status())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self._job(parts[1])
+            if job is not None:
+                self._send_json(200, job.to_dict())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self._job(parts[1])
+            if job is not None:
+                self._send_events(job)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+            job = self._job(parts[1])
+            if job is not None:
+                self._send_result(job)
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        parts, query = self._route()
+        if parts != ['jobs']:
+            self._send_json(404, {'error': 'not found'})
+            return
+        # ブラウザがプリフライトなしで送れる Content-Type (text/plain など)は受け付けない
+        upload = 'filename' in query
+        content_type = 'application/octet-stream' if upload else 'application/json'
+        if self.headers.get_content_type() != content_type:
+            self._send_json(415, {'error': 'Content-Type must be %s' % content_type})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        service = self.server.service
+        try:
+            if upload:
+                filename = query.pop('filename')
+                # クエリの値はJSON (replay のみファイル名のまま)。不正な値ならファイルを保存しない
+                options = {k: v if k == 'replay' else json.loads(v) for k, v in query.items()}
+                input_file = self._save_upload(filename, length)
+                try:
+                    job = service.submit(input_file, options, upload=True)
+                except Exception:
+                    os.remove(input_file)
+                    raise
+            else:
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if 'input' not in body:
+                    raise ValueError('input is required')
+                job = service.submit(body['input'], body.get('options'), body.get('output'))
+        except ServiceBusy as ex:
+            self._send_json(429, {'error': str(ex)}, {'Retry-After': '1'})
+            return
+        except (ValueError, TypeError) as ex:
+            self._send_json(400, {'error': str(ex)})
+            return
+        self._send_json(202, job.to_dict(), {'Location': '/jobs/' + job.id})
+
+    def do_DELETE(self):
+        parts, _ = self._route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            self._send_json(404, {'error': 'not found'})
+            return
+        job = self._job(parts[1])
+        if job is not None:
+            cancelled = self.server.service.cancel(job.id)
+            self._send_json(200 if cancelled else 409, job.to_dict())
+
+    def _save_upload(self, filename, length):
+        """save the request body to the upload directory (keeps the extension for image/video detection)"""
+        ext = os.path.splitext(os.path.basename(filename))[1]
+        fd, path = tempfile.mkstemp(suffix=ext, dir=self.server.service.upload_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        except Exception:
+            os.remove(path)
+            raise
+        return path
+
+    def _send_events(self, job):
+        # 接続を閉じるまで送る (Content-Length なし)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        last = None
+        while True:
+            finished = job.done.is_set()
+            d = job.to_dict()
+            progress = (d['state'], d['frame'])
+            if progress != last or finished:
+                self.wfile.write(json.dumps(d, ensure_ascii=False).encode('utf-8') + b'\n')
+                self.wfile.flush()
+                last = progress
+            if finished:
+                return
+            job.done.wait(self.event_interval)
+
+    def _send_result(self, job):
+        if job.state != DONE:
+            self._send_json(409, job.to_dict())
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(job.output)))
+        self.send_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(job.output))
+        self.end_headers()
+        with open(job.output, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        super().__init__(address, RequestHandler)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """the same HTTP API on a Unix domain socket (curl --unix-socket PATH)"""
+    daemon_threads = True
+
+    def __init__(self, path, service, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, UnixRequestHandler)
+
+class UnixRequestHandler(RequestHandler):
+    def address_string(self):
+        # Unixドメインソケットのクライアントにはアドレスがない
+        return 'unix'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local VMD conversion service with warm models')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, metavar='PATH', help='listen on a Unix domain socket instead')
+    parser.add_argument('--max-jobs', type=int, default=2, help='jobs converted at the same time (models kept warm)')
+    parser.add_argument('--max-queue', type=int, default=8, help='jobs waiting in the queue before rejecting (429)')
+    parser.add_argument('--output-dir', default=None, help='directory of the VMD files (default: temporary)')
+    parser.add_argument('--backend', choices=('mediapipe', 'batch'), default='mediapipe')
+    parser.add_argument('--model', choices=estimators.MODEL_VARIANTS, default='full')
+    parser.add_argument('--delegate', choices=estimators.DELEGATES, default='cpu')
+    parser.add_argument('--threads', type=int, default=4, help='models run in parallel by the batch backend')
+    parser.add_argument('--replay-only', action='store_true',
+                        help='do not load models; accept only jobs with the replay option')
+    parser.add_argument('--cache-dir', default=vm.CACHE_PATH, help='landmark cache directory')
+    parser.add_argument('--cache-size', type=int, default=2048, help='landmark cache size limit in MB')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the landmark cache')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+
+    arg = parser.parse_args()
+    estimator = estimators.EstimatorSettings(arg.backend, arg.model, arg.delegate, arg.threads)
+    cache = None if arg.no_cache else LandmarkCache(arg.cache_dir, arg.cache_size << 20)
+    t = time.perf_counter()
+    service = ConversionService(arg.max_jobs, arg.max_queue, estimator, arg.output_dir, cache,
+                                0 if arg.replay_only else None)
+    print('%d models loaded in %.1fs' % (len(service.pool.landmarkers), time.perf_counter() - t))
+    if arg.unix:
+        server = UnixHTTPServer(arg.unix, service, arg.verbose)
+        print('listening on %s' % arg.unix)
+    else:
+        server = HTTPServer((arg.host, arg.port), service, arg.verbose)
+        print('listening on http://%s:%d' % (arg.host, arg.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    # ex)
+    # python3 applications/vmd_server.py --max-jobs 2 --output-dir out
+    # curl -H 'Content-Type: application/json' -d '{"input": "movie.mp4", "options": {"center": true}}' http://127.0.0.1:8765/jobs
+    # curl -H 'Content-Type: application/octet-stream' --data-binary @movie.mp4 'http://127.0.0.1:8765/jobs?filename=movie.mp4&smooth="savgol"'
+    # curl -N http://127.0.0.1:8765/jobs/1/events
+    # curl -o movie.vmd http://127.0.0.1:8765/jobs/1/result
+    # python3 applications/vmd_server.py --replay-only --unix /tmp/vmd.sock
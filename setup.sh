@@ -10,7 +10,12 @@ if ! [ -x "$(command -v git)" ]; then
 fi
 
 echo 'Downloading models...'
-${WGET} https://storage.googleapis.com/mediapipe-models/pose_landmarker/pose_landmarker_full/float16/latest/pose_landmarker_full.task
+# lite, heavy は --model で選択する (vmd_mediapipe.py --model lite)
+for VARIANT in full lite heavy; do
+	${WGET} https://storage.googleapis.com/mediapipe-models/pose_landmarker/pose_landmarker_${VARIANT}/float16/latest/pose_landmarker_${VARIANT}.task
+done
+# 手首と指のボーン (vmd_mediapipe.py --hands)
+${WGET} https://storage.googleapis.com/mediapipe-models/hand_landmarker/hand_landmarker/float16/latest/hand_landmarker.task
 cd ../..
 
 echo 'Installing dependencies...'
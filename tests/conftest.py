@@ -0,0 +1,6 @@
+# conftest.py - make the modules of applications/ importable from the tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'applications'))
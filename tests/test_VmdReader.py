@@ -0,0 +1,77 @@
+# test_VmdReader.py - VMD files written by VmdWriter read back by VmdReader
+
+import os
+import numpy as np
+import pytest
+
+import keyframes
+import pos2vmd
+from VmdReader import VmdReader, verify_round_trip
+from VmdWriter import VmdWriter, VmdStreamWriter, bone_frame_records
+
+def _records(frames=50, seed=0):
+    rng = np.random.default_rng(seed)
+    names = pos2vmd.BONE_NAMES + pos2vmd.HAND_BONE_NAMES[:3] + ['センター', '左足ＩＫ']
+    n = frames * len(names)
+    rotations = rng.normal(size=(n, 4))
+    rotations /= np.linalg.norm(rotations, axis=-1, keepdims=True)
+    curves = rng.uniform(0, 1, size=(n, 4))
+    return bone_frame_records(names * frames, np.repeat(np.arange(frames), len(names)),
+                              rng.normal(size=(n, 3)), rotations, keyframes.interpolation_bytes(curves))
+
+def _showik(ik):
+    return [(sf.frame, sf.show, [(i.name, i.onoff) for i in sf.ik]) for sf in ik]
+
+@pytest.mark.parametrize('ik', [False, True])
+def test_round_trip(tmp_path, ik):
+    records = _records()
+    showik = pos2vmd.make_showik_frames(ik)
+    path = str(tmp_path / 'motion.vmd')
+    VmdWriter().write_vmd_file(path, records, showik)
+    motion = VmdReader().read_vmd_file(path)
+
+    assert np.array_equal(motion.bone_frames, records)
+    assert motion.names.tolist()[:len(pos2vmd.BONE_NAMES)] == pos2vmd.BONE_NAMES
+    assert np.array_equal(motion.frames, records['frame'])
+    assert np.array_equal(motion.positions, records['position'])
+    assert np.array_equal(motion.rotations, records['rotation'])
+    assert np.array_equal(motion.interpolations, records['interpolation'])
+    assert _showik(motion.showik_frames) == _showik(showik)
+
+def test_round_trip_stream_writer(tmp_path):
+    records = _records()
+    path = str(tmp_path / 'stream.vmd')
+    with VmdStreamWriter(path) as writer:
+        for start in range(0, len(records), 128):
+            writer.write_bone_frames(records[start:start + 128])
+        writer.close(pos2vmd.make_showik_frames())
+    assert np.array_equal(VmdReader().read_vmd_file(path).bone_frames, records)
+
+def test_round_trip_bone_frame_objects(tmp_path):
+    pytest.importorskip('PyQt6.QtGui')
+    records = bone_frame_records(['センター', '頭'], [0, 3], [[1, 2, 3], [0, 0, 0]], [[0, 0, 0, 1], [0.6, 0, 0, 0.8]])
+    path = str(tmp_path / 'objects.vmd')
+    VmdWriter().write_vmd_file(path, records, [])
+    again = str(tmp_path / 'again.vmd')
+    VmdWriter().write_vmd_file(again, VmdReader().read_vmd_file(path).bone_frame_objects(), [])
+    with open(path, 'rb') as a, open(again, 'rb') as b:
+        assert a.read() == b.read()
+
+def test_truncated_file(tmp_path):
+    path = str(tmp_path / 'motion.vmd')
+    VmdWriter().write_vmd_file(path, _records(), [])
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:1000])
+    with pytest.raises(ValueError):
+        VmdReader().read_vmd_file(path)
+
+def test_verify_round_trip_leaves_no_files(tmp_path):
+    path = str(tmp_path / 'motion.vmd')
+    VmdWriter().write_vmd_file(path, _records(), pos2vmd.make_showik_frames())
+    assert verify_round_trip(path)
+    assert os.listdir(tmp_path) == ['motion.vmd']
+    # 書き出すファイルを指定した場合は残す
+    assert verify_round_trip(path, str(tmp_path / 'copy.vmd'))
+    assert sorted(os.listdir(tmp_path)) == ['copy.vmd', 'motion.vmd']
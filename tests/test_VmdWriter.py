@@ -0,0 +1,99 @@
+# test_VmdWriter.py - the structured-array writer against the per-field writer of the original VmdWriter
+
+import struct
+import numpy as np
+import pytest
+
+import pos2vmd
+from VmdWriter import (VmdWriter, VmdStreamWriter, VmdBoneFrame, bone_frame_records,
+                       bone_frames_to_records)
+
+QtGui = pytest.importorskip('PyQt6.QtGui')
+
+def _legacy_write_vmd_file(filename, bone_frames, showik_frames):
+    """VmdWriter.write_vmd_file before the records were introduced (each field packed by struct)"""
+    with open(filename, 'wb') as fout:
+        fout.write(b'Vocaloid Motion Data 0002\x00\x00\x00\x00\x00')
+        fout.write(b'Dummy Model Name    ')
+        fout.write(struct.pack('<L', len(bone_frames)))
+        for bf in bone_frames:
+            name = bf.name.encode('ms932')
+            fout.write(name)
+            fout.write(bytearray([0 for i in range(len(name), 15)]))
+            fout.write(struct.pack('<L', bf.frame))
+            fout.write(struct.pack('<f', bf.position.x()))
+            fout.write(struct.pack('<f', bf.position.y()))
+            fout.write(struct.pack('<f', bf.position.z()))
+            v = bf.rotation.toVector4D()
+            fout.write(struct.pack('<f', v.x()))
+            fout.write(struct.pack('<f', v.y()))
+            fout.write(struct.pack('<f', v.z()))
+            fout.write(struct.pack('<f', v.w()))
+            fout.write(bytearray([0 for i in range(0, 64)]))
+        for _ in range(4):
+            fout.write(struct.pack('<L', 0))
+        fout.write(struct.pack('<L', len(showik_frames)))
+        for sf in showik_frames:
+            sf.write(fout)
+
+def _bone_frames(count, seed=0):
+    rng = np.random.default_rng(seed)
+    names = pos2vmd.BONE_NAMES + ['センター']
+    frames = []
+    for i in range(count):
+        bf = VmdBoneFrame()
+        bf.name = names[i % len(names)]
+        bf.frame = i // len(names)
+        bf.position = QtGui.QVector3D(*rng.normal(size=3).tolist())
+        bf.rotation = QtGui.QQuaternion(*rng.normal(size=4).tolist()).normalized()
+        frames.append(bf)
+    return frames
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('count', [0, 1, 250])
+def test_write_vmd_file_matches_legacy_writer(tmp_path, count):
+    bone_frames = _bone_frames(count)
+    showik = pos2vmd.make_showik_frames()
+    _legacy_write_vmd_file(tmp_path / 'legacy.vmd', bone_frames, showik)
+    expected = _read(tmp_path / 'legacy.vmd')
+
+    # VmdBoneFrame のリスト
+    VmdWriter().write_vmd_file(tmp_path / 'objects.vmd', bone_frames, showik)
+    assert _read(tmp_path / 'objects.vmd') == expected
+
+    # 列の配列から作ったレコード
+    records = bone_frame_records(
+        [bf.name for bf in bone_frames], [bf.frame for bf in bone_frames],
+        np.array([(bf.position.x(), bf.position.y(), bf.position.z()) for bf in bone_frames]).reshape(-1, 3),
+        np.array([(bf.rotation.x(), bf.rotation.y(), bf.rotation.z(), bf.rotation.scalar())
+                  for bf in bone_frames]).reshape(-1, 4))
+    VmdWriter().write_vmd_file(tmp_path / 'records.vmd', records, showik)
+    assert _read(tmp_path / 'records.vmd') == expected
+
+    # チャンクに分けて書き込む
+    with VmdStreamWriter(tmp_path / 'stream.vmd') as writer:
+        for start in range(0, count, 100):
+            writer.write_bone_frames(bone_frames_to_records(bone_frames[start:start + 100]))
+        writer.close(showik)
+    assert _read(tmp_path / 'stream.vmd') == expected
+
+def test_rotations_to_records_matches_positions_to_frames(tmp_path):
+    import posisions as ps
+    rng = np.random.default_rng(1)
+    world = np.ones((20, len(ps.NAMES), 4), dtype=np.float32)
+    world[..., :3] = rng.normal(scale=0.3, size=world[..., :3].shape)
+    bone_frames = []
+    for i, info in enumerate(ps.arrays_to_positions(world, world)):
+        bone_frames.extend(pos2vmd.positions_to_frames(info['position'], i))
+    showik = pos2vmd.make_showik_frames()
+    _legacy_write_vmd_file(tmp_path / 'legacy.vmd', bone_frames, showik)
+
+    # 同じ回転(float32に丸めたもの)を配列から書き出す
+    rotations = np.array([(bf.rotation.x(), bf.rotation.y(), bf.rotation.z(), bf.rotation.scalar())
+                          for bf in bone_frames], dtype=np.float32).reshape(len(world), -1, 4)
+    records = pos2vmd.rotations_to_records(rotations, range(len(world)))
+    VmdWriter().write_vmd_file(tmp_path / 'records.vmd', records, showik)
+    assert _read(tmp_path / 'records.vmd') == _read(tmp_path / 'legacy.vmd')
@@ -0,0 +1,32 @@
+# test_adaptive.py - frame selection of the adaptive inference mode
+
+import numpy as np
+
+import adaptive
+
+def _frames(levels):
+    """(frame_num, BGR image) of frames filled with the given brightness"""
+    return [(i, np.full((72, 128, 3), level, dtype=np.uint8)) for i, level in enumerate(levels)]
+
+def test_select_frames():
+    # 10フレーム目で大きく、15フレーム目で少しだけ明るさが変わる
+    levels = [100] * 10 + [200] * 5 + [205] * 5
+    selected = [frame_num for frame_num, _ in adaptive.select_frames(_frames(levels), 4, 10)]
+    assert selected == [0, 4, 8, 10, 14, 18]
+
+def test_select_frames_on_motion_or_step():
+    levels = [0, 50, 100, 150, 200, 250]
+    # 閾値を超える動きがあるフレームはすべて通す
+    assert [f for f, _ in adaptive.select_frames(_frames(levels), 10, 10)] == list(range(6))
+    # 動きがなければ step フレームごと
+    assert [f for f, _ in adaptive.select_frames(_frames([0] * 7), 3, 10)] == [0, 3, 6]
+
+def test_images_are_passed_through():
+    frames = _frames([0, 100])
+    for (frame_num, image), (_, expected) in zip(adaptive.select_frames(frames, 1, 10), frames):
+        assert image is expected
+
+def test_settings_key():
+    assert adaptive.AdaptiveSettings().key() == ''
+    assert not adaptive.AdaptiveSettings().enabled
+    assert adaptive.AdaptiveSettings(step=2).key() != adaptive.AdaptiveSettings(step=2, motion_threshold=5).key()
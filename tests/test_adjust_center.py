@@ -0,0 +1,62 @@
+# test_adjust_center.py - root motion recovered from landmarks projected by a known camera
+
+import numpy as np
+import pytest
+
+import adjust_center as ac
+import benchmark
+import pipeline
+
+FRAMES = 120
+FOCAL = 1.2
+ASPECT = 16 / 9
+
+def _translations(seed=0):
+    """hip translations (N, 3) in camera axes used by benchmark.project_landmarks"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(FRAMES)[:, None] / 30
+    freq = rng.uniform(0.05, 0.3, size=(1, 3))
+    return np.sin(2 * np.pi * freq * t) * [0.5, 0.1, 1.0] + [0, 0, 4]
+
+@pytest.fixture
+def landmarks():
+    world, _ = benchmark.synthetic_landmarks(FRAMES, missing=0)
+    return world, benchmark.project_landmarks(world, FOCAL, ASPECT)
+
+def _centers():
+    """expected center bone positions (MMD units, relative to the first frame)"""
+    t = _translations()
+    return (t - t[0]) * [ac.METERS_TO_MMD, -ac.METERS_TO_MMD, ac.METERS_TO_MMD]
+
+def test_solve_translations(landmarks):
+    points, uv = ac._camera_points(*landmarks, ASPECT)
+    weights = np.ones(points.shape[:2])
+    translations = ac.solve_translations(points, uv, weights, FOCAL, ASPECT)
+    # 画像上の座標のノイズ(幅の0.2%)の分だけずれる (奥行きは4m前後)
+    error = np.abs(translations - _translations())
+    assert error[:, :2].max() < 0.02 and error[:, 2].max() < 0.1
+    assert np.median(ac.reprojection_errors(points, uv, weights, translations, FOCAL, ASPECT)) < 0.003
+    assert ac.estimate_focal(points, uv, weights, ASPECT) == pytest.approx(FOCAL, rel=0.1)
+
+def test_root_motion(landmarks):
+    world, image = landmarks
+    stats = pipeline.PipelineStats()
+    centers = ac.root_motion(world, image, aspect=ASPECT, focal=FOCAL, smoothing=None, stats=stats)
+    np.testing.assert_array_equal(centers[0], 0)
+    # 8cm(1単位)以内 (前後の移動の幅は約25単位)
+    assert np.abs(centers - _centers()).max() < 1.0
+    assert stats.info['focal'] == FOCAL and stats.info['reprojection_error'] < 0.003
+
+def test_root_motion_fills_missing_frames(landmarks):
+    world, image = landmarks
+    missing = world.copy()
+    missing[40:50] = np.nan
+    centers = ac.root_motion(missing, image, visibility=world[..., 3], aspect=ASPECT, focal=FOCAL,
+                             smoothing=None)
+    assert np.isfinite(centers).all()
+    assert np.abs(centers - _centers()).max() < 1.0
+    # 焦点距離を推定しても動きの向きと大きさは合う
+    estimated = ac.root_motion(world, image, aspect=ASPECT)
+    assert np.corrcoef(estimated[:, 2], _centers()[:, 2])[0, 1] > 0.99
+    # 1フレームも検出できなければ動かない
+    assert (ac.root_motion(np.full((3, 33, 4), np.nan), image[:3]) == 0).all()
@@ -0,0 +1,59 @@
+# test_estimators.py - the replay backend (recorded landmarks returned by timestamp)
+
+import numpy as np
+import pytest
+
+import estimators
+import landmark_cache
+import posisions as ps
+import timeline
+
+FRAME_NUMS = [0, 1, 3, 5, 8]
+
+@pytest.fixture
+def recording(tmp_path):
+    world = np.arange(len(FRAME_NUMS), dtype=np.float32)[:, None, None] * np.ones((1, 33, 4), np.float32)
+    hands = np.arange(len(FRAME_NUMS), dtype=np.float32)[:, None, None, None] * np.ones((1, 2, 21, 3), np.float32)
+    path = str(tmp_path / 'recording.npz')
+    landmark_cache.write_landmarks(path, FRAME_NUMS, world, world + 100, 29.97, 16 / 9, hands=hands,
+                                   frame_count=10)
+    return path
+
+def test_lookup_by_timestamp(recording):
+    landmarker = estimators.EstimatorSettings('replay', replay=recording).create()
+    assert not landmarker.needs_frames
+    assert landmarker.frame_count == 10 and landmarker.aspect == pytest.approx(16 / 9)
+    # 検出したフレームの時刻には記録したランドマーク、それ以外は検出なし
+    for frame_num in range(10):
+        result = landmarker.detect_for_video(None, timeline.frame_timestamp(frame_num, landmarker.fps))
+        if frame_num in FRAME_NUMS:
+            i = FRAME_NUMS.index(frame_num)
+            np.testing.assert_array_equal(ps.landmarks_to_array(result.pose_world_landmarks[0]), i)
+            np.testing.assert_array_equal(ps.landmarks_to_array(result.pose_landmarks[0]), i + 100)
+            np.testing.assert_array_equal(result.hand_world_landmarks, i)
+        else:
+            assert result.pose_landmarks == [] and result.pose_world_landmarks == []
+
+def test_frames(recording):
+    landmarker = estimators.ReplayLandmarker(recording)
+    assert [f for f, image in landmarker.frames()] == FRAME_NUMS
+    assert [f for f, image in landmarker.frames(1, 8)] == [1, 3, 5]
+    assert [f for f, image in landmarker.frames(step=2)] == [0, 8]
+    assert all(image is None for _, image in landmarker.frames())
+
+def test_old_recording(tmp_path):
+    # frame_count がない場合は最後に検出したフレームまで、fps が不明ならVMDのフレームレート
+    path = str(tmp_path / 'old.npz')
+    world = np.zeros((2, 33, 4), np.float32)
+    landmark_cache.write_landmarks(path, [2, 6], world, world, 0)
+    landmarker = estimators.ReplayLandmarker(path)
+    assert landmarker.frame_count == 7 and landmarker.fps == timeline.effective_fps(0)
+    assert landmarker.hands is None
+    assert landmarker.detect_for_video(None, timeline.frame_timestamp(6, landmarker.fps)).pose_landmarks
+
+def test_settings():
+    with pytest.raises(ValueError):
+        estimators.EstimatorSettings('replay')
+    with pytest.raises(ValueError):
+        estimators.EstimatorSettings('unknown')
+    assert estimators.EstimatorSettings('replay', replay='a.npz').model_path == 'a.npz'
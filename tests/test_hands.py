@@ -0,0 +1,66 @@
+# test_hands.py - crops around the wrists and the hand bone rotations
+
+import numpy as np
+
+import hands
+import pos2vmd
+import posisions as ps
+import quaternions as qt
+
+J = ps.Joint
+
+def _rest_body(frames):
+    """joint positions (N, 33, 3) whose elbows are in the rest pose of the mmd rig (arms 45 degrees down)
+
+    ひじの向きは (±1, -1, 0)、腕とひじの曲がる面の法線(up)は初期姿勢と同じ (1, ±1, 0)。
+    """
+    points = np.zeros((len(ps.NAMES), 3))
+    points[[J.LEFT_SHOULDER, J.RIGHT_SHOULDER, J.LEFT_HIP, J.RIGHT_HIP]] = [[0.2, 0.5, 0], [-0.2, 0.5, 0],
+                                                                           [0.1, 0, 0], [-0.1, 0, 0]]
+    for shoulder, elbow, wrist, sx in ((J.LEFT_SHOULDER, J.LEFT_ELBOW, J.LEFT_WRIST, 1),
+                                       (J.RIGHT_SHOULDER, J.RIGHT_ELBOW, J.RIGHT_WRIST, -1)):
+        points[elbow] = points[shoulder] + [0.1 * sx, -0.1, 0.1]
+        points[wrist] = points[elbow] + [0.2 * sx, -0.2, 0]
+    return np.broadcast_to(points, (frames,) + points.shape).copy()
+
+def _rest_hands(frames):
+    """hands (N, 2, 21, 3) in the rest pose of the mmd rig (left, right)"""
+    rest = pos2vmd._rest_hand((1, -1, 0))
+    return np.broadcast_to(np.stack([rest, rest * [-1, 1, 1]]), (frames, 2) + rest.shape).copy()
+
+def test_rest_hands_are_identity():
+    points = _rest_body(3)
+    elbows = [pos2vmd.BONE_NAMES.index(name) for name in ('左ひじ', '右ひじ')]
+    body = pos2vmd._global_rotations(points, pos2vmd._DEFAULT_RIG)[:, elbows]
+    assert np.degrees(qt.angle_between(body, qt.IDENTITY)).max() < 1e-4
+    # hand_rotations から ひじ の回転を除いているので、手が初期姿勢なら全ボーンが回転しない
+    rotations = pos2vmd.hand_rotations(points, _rest_hands(3))
+    assert rotations.shape == (3, len(pos2vmd.HAND_BONE_NAMES), 4)
+    assert np.degrees(qt.angle_between(rotations, qt.IDENTITY)).max() < 1e-4
+
+def test_missing_hands_stay_nan():
+    hand_points = _rest_hands(3)
+    hand_points[1, 0] = np.nan
+    hand_points[2] = np.nan
+    rotations = pos2vmd.hand_rotations(_rest_body(3), hand_points)
+    left = np.array([name.startswith('左') for name in pos2vmd.HAND_BONE_NAMES])
+    assert np.isfinite(rotations[0]).all()
+    assert np.isnan(rotations[1, left]).all() and np.isfinite(rotations[1, ~left]).all()
+    assert np.isnan(rotations[2]).all()
+
+def test_wrist_regions():
+    pose_2d = np.zeros((len(ps.NAMES), 4))
+    pose_2d[:, 3] = 1
+    pose_2d[J.LEFT_ELBOW, :2] = [0.5, 0.3]
+    pose_2d[J.LEFT_WRIST, :2] = [0.5, 0.5]
+    pose_2d[[J.LEFT_PINKY, J.LEFT_INDEX, J.LEFT_THUMB], :2] = [0.5, 0.54]
+    pose_2d[J.RIGHT_WRIST, 3] = 0.1
+    left, right = hands.wrist_regions(pose_2d, 1000, 1000)
+    # 手首と指の中間を中心に、前腕の長さの1.5倍の正方形
+    assert left == (350, 370, 650, 670)
+    # 手首が見えていない手は推定しない
+    assert right is None
+    # 画像の端で小さくなりすぎた範囲も推定しない
+    pose_2d[J.LEFT_ELBOW, :2] = [0.5, 1.0]
+    pose_2d[J.LEFT_WRIST, :2] = pose_2d[[J.LEFT_PINKY, J.LEFT_INDEX, J.LEFT_THUMB], :2] = [0.5, 1.02]
+    assert hands.wrist_regions(pose_2d, 1000, 1000)[0] is None
@@ -0,0 +1,20 @@
+# test_image_sequence.py - detection of image sequence inputs
+
+import image_sequence
+import vmd_batch
+
+def test_file_names_with_glob_characters(tmp_path):
+    video = tmp_path / 'dance [1080p].mp4'
+    video.write_bytes(b'')
+    assert not image_sequence.is_sequence(str(video))
+    assert vmd_batch.collect_inputs([str(video)]) == [(str(video), None)]
+
+def test_directories_and_patterns(tmp_path):
+    for i in range(3):
+        (tmp_path / ('frame_%d.png' % i)).write_bytes(b'')
+    assert image_sequence.is_sequence(str(tmp_path))
+    assert image_sequence.is_sequence(str(tmp_path / '*.png'))
+    assert image_sequence.is_sequence(str(tmp_path / 'frame_[0-1].png'))
+    assert len(image_sequence.list_frames(str(tmp_path / 'frame_[0-1].png'))) == 2
+    assert not image_sequence.is_sequence(str(tmp_path / 'frame_0.png'))
+    assert not image_sequence.is_sequence(str(tmp_path / 'missing.mp4'))
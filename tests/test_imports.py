@@ -0,0 +1,18 @@
+# test_imports.py - the array code paths do not load cv2, mediapipe or PyQt6
+
+import os
+import subprocess
+import sys
+
+APPLICATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'applications')
+
+HEAVY_MODULES = ['PyQt6', 'cv2', 'mediapipe']
+
+def test_array_modules_do_not_import_heavy_modules():
+    # 他のテストで読み込まれていない、新しいインタプリタで確かめる
+    code = ('import sys\n'
+            'import pos2vmd, posisions, VmdWriter, VmdReader, keyframes\n'
+            'print(" ".join(m for m in %r if m in sys.modules))\n' % HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=APPLICATIONS, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.split() == []
@@ -0,0 +1,39 @@
+# test_keyframes.py - keyframe reduction
+
+import numpy as np
+
+import benchmark
+import keyframes
+import pos2vmd
+import posisions as ps
+import quaternions as qt
+
+def _rotations(frames=300):
+    world, _ = benchmark.synthetic_landmarks(frames, missing=0)
+    return pos2vmd.positions_to_rotations(ps.world_points(world))
+
+def test_reduce_within_tolerance():
+    rotations = _rotations()
+    keep, _, info = keyframes.reduce_keyframes(rotations, np.arange(len(rotations)), 0.5)
+    assert keep[0].all() and keep[-1].all()
+    assert info['kept'] < info['keyframes'] == keep.size
+    assert info['max_error'] <= 0.5 + 1e-9
+
+def test_reduce_keeps_only_candidates():
+    rotations = _rotations()
+    n, b = rotations.shape[:2]
+    rng = np.random.default_rng(0)
+    candidates = np.broadcast_to(rng.random(n)[:, None] > 0.2, (n, b)).copy()
+    candidates[:5] = False
+    candidates[:, -1] = False # 一度も検出できなかったボーン
+    for fit_bezier in (False, True):
+        keep, _, info = keyframes.reduce_keyframes(rotations, np.arange(n), 0.5, fit_bezier, candidates)
+        assert not (keep & ~candidates).any()
+        assert info['keyframes'] == candidates.sum()
+        # 候補のフレームは、残したキーフレームから許容誤差内で復元できる
+        err = np.degrees(qt.angle_between(keyframes.reconstruct(rotations, np.arange(n), keep), rotations))
+        if not fit_bezier:
+            assert err[candidates].max() <= 0.5 + 1e-9
+        for bone in range(b - 1):
+            frames = np.flatnonzero(candidates[:, bone])
+            assert keep[frames[0], bone] and keep[frames[-1], bone]
@@ -0,0 +1,90 @@
+# test_landmark_cache.py - cache keys, LRU eviction and cache files shared by several processes
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import landmark_cache
+
+APPLICATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'applications')
+
+def _landmarks(frames=60, seed=0):
+    world = np.random.default_rng(seed).random((frames, 33, 4))
+    return np.arange(frames), world, world
+
+def test_hit_and_miss(tmp_path):
+    cache = landmark_cache.LandmarkCache(str(tmp_path / 'cache'))
+    assert cache.load('a') is None
+    frame_nums, world, image = _landmarks()
+    cache.save('a', frame_nums, world, image, 30, 16 / 9, frame_count=61)
+    arrays = cache.load('a')
+    assert arrays['frame_nums'].tolist() == frame_nums.tolist()
+    np.testing.assert_allclose(arrays['world'], world, rtol=1e-6)
+    assert float(arrays['fps']) == 30 and int(arrays['frame_count']) == 61
+    assert cache.load('b') is None
+
+def test_key_invalidation(tmp_path):
+    video = tmp_path / 'video.mp4'
+    model = tmp_path / 'model.task'
+    video.write_bytes(b'video')
+    model.write_bytes(b'model')
+    key = landmark_cache.cache_key(str(video), str(model))
+    assert landmark_cache.cache_key(str(video), str(model)) == key
+    assert landmark_cache.cache_key(str(video), str(model), 'batch,cpu') != key
+    assert landmark_cache.cache_key(str(video), str(model), video_hash='frames') != key
+    # 動画やモデルの内容が変わるとキーも変わる
+    video.write_bytes(b'another video')
+    changed = landmark_cache.cache_key(str(video), str(model))
+    assert changed != key
+    model.write_bytes(b'another model')
+    assert landmark_cache.cache_key(str(video), str(model)) not in (key, changed)
+
+def test_lru_eviction(tmp_path):
+    cache = landmark_cache.LandmarkCache(str(tmp_path))
+    for i, key in enumerate('abc'):
+        cache.save(key, *_landmarks(seed=i), 30)
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    # 読み込んだものは最近使ったものになる
+    assert cache.load('a') is not None
+    sizes = {key: os.path.getsize(cache.path(key)) for key in 'abc'}
+    cache.max_bytes = sizes['a'] + sizes['c']
+    cache.evict()
+    assert sorted(os.listdir(str(tmp_path))) == ['a.npz', 'c.npz']
+    cache.max_bytes = sizes['a']
+    cache.evict()
+    assert os.listdir(str(tmp_path)) == ['a.npz']
+
+# 同じキーと別のキーを交互に書き、容量を小さくして毎回削除させる
+WRITER = '''
+import sys
+import numpy as np
+import landmark_cache
+cache = landmark_cache.LandmarkCache(sys.argv[1], max_bytes=20000)
+world = np.random.default_rng(int(sys.argv[2])).random((60, 33, 4))
+for i in range(40):
+    key = 'shared' if i % 2 else 'key%s_%d' % (sys.argv[2], i)
+    cache.save(key, np.arange(60), world, world, 30)
+    cache.load('shared')
+'''
+
+def test_concurrent_writers(tmp_path):
+    directory = str(tmp_path / 'cache')
+    workers = [subprocess.Popen([sys.executable, '-c', WRITER, directory, str(seed)], cwd=APPLICATIONS,
+                                stderr=subprocess.PIPE, text=True) for seed in range(3)]
+    for worker in workers:
+        _, err = worker.communicate(timeout=120)
+        assert worker.returncode == 0, err
+    names = os.listdir(directory)
+    assert not [name for name in names if name.endswith('.tmp.npz')]
+    for name in names:
+        assert len(landmark_cache.read_landmarks(os.path.join(directory, name))['frame_nums']) == 60
+
+def test_files_removed_by_another_process(tmp_path):
+    cache = landmark_cache.LandmarkCache(str(tmp_path))
+    world = np.zeros((1, 33, 4))
+    cache.save('a', [0], world, world, 30)
+    os.remove(cache.path('a'))
+    assert cache.load('a') is None
+    cache.evict()
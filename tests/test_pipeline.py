@@ -0,0 +1,92 @@
+# test_pipeline.py - background stages (pipeline.background) and exported statistics
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import pipeline
+
+def test_background_keeps_order():
+    assert list(pipeline.background(iter(range(100)), 4)) == list(range(100))
+
+def test_background_backpressure():
+    produced = []
+    closed = threading.Event()
+
+    def items():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    results = pipeline.background(items(), 3)
+    assert next(results) == 0
+    time.sleep(0.3)
+    # 取り出した1個 + キューの3個 + put で待っている1個 より先は読まない
+    assert len(produced) <= 5
+    results.close()
+    # 消費側が終了すると上流も閉じる
+    assert closed.is_set()
+    assert len(produced) <= 5
+
+def test_background_error_reaches_consumer():
+    def items():
+        yield 0
+        yield 1
+        raise ValueError('broken frame')
+
+    results = pipeline.background(items(), 1)
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ValueError, match='broken frame'):
+        next(results)
+
+def _stats():
+    stats = pipeline.PipelineStats(trace=True)
+    stats.stage('decode').add(0.5, 10)
+    stats.stage('inference').add(1.5, 10)
+    stats.count('no_pose', 2)
+    stats.info['fps'] = 30.0
+    stats.info['input'] = 'a.mp4'
+    return stats
+
+def test_export_json(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    _stats().export(path)
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    assert data['stages'] == {'decode': {'count': 10, 'seconds': 0.5}, 'inference': {'count': 10, 'seconds': 1.5}}
+    assert data['counters'] == {'no_pose': 2}
+    assert data['fps'] == 30.0 and data['input'] == 'a.mp4'
+    assert data['elapsed'] >= 0
+
+def test_export_prometheus(tmp_path):
+    path = str(tmp_path / 'stats.prom')
+    _stats().export(path, 'prometheus')
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert 'vmd_convert_stage_seconds_total{stage="inference"} 1.500000' in lines
+    assert 'vmd_convert_stage_items_total{stage="decode"} 10' in lines
+    assert 'vmd_convert_events_total{event="no_pose"} 2' in lines
+    assert 'vmd_convert_fps 30.0' in lines
+    # 数値でない情報は出力しない
+    assert not [line for line in lines if 'a.mp4' in line]
+    # すべての値の前に型の宣言がある
+    declared = {line.split()[2] for line in lines if line.startswith('# TYPE')}
+    assert {line.split('{')[0].split()[0] for line in lines if not line.startswith('#')} <= declared
+
+def test_export_chrome_trace(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    _stats().export(path, 'chrome')
+    with open(path, encoding='utf-8') as f:
+        trace = json.load(f)
+    events = trace['traceEvents']
+    assert [e['name'] for e in events] == ['decode', 'inference']
+    assert all(e['ph'] == 'X' and e['pid'] == os.getpid() for e in events)
+    assert [e['dur'] for e in events] == [0.5e6, 1.5e6]
+    assert trace['otherData']['counters'] == {'no_pose': 2}
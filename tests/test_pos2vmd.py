@@ -0,0 +1,126 @@
+# test_pos2vmd.py - the batched solver against the PyQt6 path (positions_to_frames)
+
+import numpy as np
+import pytest
+
+import posisions as ps
+import pos2vmd
+import quaternions as qt
+
+pytest.importorskip('PyQt6.QtGui')
+
+def _random_world(frames, scale=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    world = np.ones((frames, len(ps.NAMES), 4), dtype=np.float32)
+    world[..., :3] = rng.normal(scale=scale, size=(frames, len(ps.NAMES), 3))
+    return world
+
+def _world(frames):
+    world = np.ones((len(frames), len(ps.NAMES), 4), dtype=np.float32)
+    world[..., :3] = np.array(frames) * [1, -1, 1]
+    return world
+
+def _rest():
+    """joint positions (33, 3) of a pose with bent arms and knees (meters, y up)"""
+    J = ps.Joint
+    rest = np.zeros((len(ps.NAMES), 3))
+    rest[[J.LEFT_SHOULDER, J.RIGHT_SHOULDER, J.LEFT_HIP, J.RIGHT_HIP]] = [[0.2, 0.5, 0], [-0.2, 0.5, 0],
+                                                                         [0.1, 0, 0], [-0.1, 0, 0]]
+    rest[[J.NOSE, J.LEFT_EAR, J.RIGHT_EAR]] = [[0, 0.7, -0.1], [0.08, 0.72, 0], [-0.08, 0.72, 0]]
+    rest[[J.LEFT_ELBOW, J.LEFT_WRIST, J.RIGHT_ELBOW, J.RIGHT_WRIST]] = [[0.4, 0.3, 0.05], [0.5, 0.1, 0.2],
+                                                                         [-0.4, 0.3, 0.05], [-0.5, 0.1, 0.2]]
+    rest[[J.LEFT_KNEE, J.LEFT_ANKLE, J.RIGHT_KNEE, J.RIGHT_ANKLE]] = [[0.1, -0.4, 0.05], [0.1, -0.8, 0],
+                                                                      [-0.1, -0.4, 0.05], [-0.1, -0.8, 0]]
+    return rest
+
+def _degenerate_world():
+    """frames whose up vectors are zero or (almost) parallel to the bone directions"""
+    J = ps.Joint
+    rest = _rest()
+    frames = []
+    for eps in (0.0, 1e-7, 1e-4):
+        p = rest.copy()
+        # 腕とひざをまっすぐに伸ばす
+        p[J.LEFT_ELBOW] = (p[J.LEFT_SHOULDER] + p[J.LEFT_WRIST]) / 2 + eps
+        p[J.RIGHT_ELBOW] = (p[J.RIGHT_SHOULDER] + p[J.RIGHT_WRIST]) / 2
+        p[J.LEFT_KNEE] = (p[J.LEFT_HIP] + p[J.LEFT_ANKLE]) / 2 + [eps, 0, 0]
+        frames.append(p)
+        # 両肩を背骨と平行に並べる (上半身のupが0になる)
+        p = rest.copy()
+        p[J.LEFT_SHOULDER] = [0, 0.5 + eps, 0]
+        p[J.RIGHT_SHOULDER] = [eps, 0.4, 0]
+        frames.append(p)
+        # 鼻を首と頭の中心を結ぶ線の上に置く
+        p = rest.copy()
+        p[J.NOSE] = [eps, 0.61, 0]
+        frames.append(p)
+    return _world(frames)
+
+def _qt_rotations(world):
+    positions = ps.arrays_to_positions(world, world)
+    return np.array([[(f.rotation.x(), f.rotation.y(), f.rotation.z(), f.rotation.scalar())
+                      for f in pos2vmd.positions_to_frames(info['position'])] for info in positions])
+
+def _baseline_rotations(world):
+    """rotations of the original PyQt6 solver, which normalized the up vector of 上半身 only"""
+    from PyQt6.QtGui import QQuaternion, QVector3D
+    point_table, bone_table = pos2vmd._qt_table(pos2vmd._DEFAULT_RIG)
+    out = []
+    for info in ps.arrays_to_positions(world, world):
+        pos = info['position']
+        points = [sum((pos[name] for name in members[1:]), pos[members[0]]) / len(members)
+                  for members in point_table]
+        rotations = []
+        frame = []
+        for name, (d0, d1), (a0, a1, b0, b1), parent, initial_inv in bone_table:
+            up = QVector3D.crossProduct(points[a1] - points[a0], points[b1] - points[b0])
+            if name == '上半身':
+                up = up.normalized()
+            rotation = QQuaternion.fromDirection(points[d1] - points[d0], up) * initial_inv
+            rotations.append(rotation)
+            r = rotation if parent < 0 else rotations[parent].inverted() * rotation
+            frame.append((r.x(), r.y(), r.z(), r.scalar()))
+        out.append(frame)
+    return np.array(out)
+
+@pytest.mark.parametrize('world', [_random_world(500), _random_world(500, scale=0.01, seed=1),
+                                   _degenerate_world()], ids=['random', 'small', 'degenerate'])
+def test_positions_to_rotations_matches_qt(world):
+    expected = _qt_rotations(world)
+    rotations = pos2vmd.positions_to_rotations(ps.world_points(world))
+    assert rotations.shape == expected.shape
+    # Qtはfloat32で計算するので、その誤差まで許容する
+    assert np.degrees(qt.angle_between(rotations, expected)).max() < 0.05
+
+def test_rotations_do_not_depend_on_scale():
+    # upの長さが閾値以下になるフレーム(degenerate)以外は、関節位置のスケールによらない
+    points = ps.world_points(_random_world(200))
+    rotations = pos2vmd.positions_to_rotations(points)
+    for scale in (0.1, 6.4, 1000.0):
+        scaled = pos2vmd.positions_to_rotations(points * scale)
+        assert np.degrees(qt.angle_between(rotations, scaled)).max() < 1e-4
+
+def test_matches_the_baseline_solver():
+    # upが短くないフレームでは、全ボーンのupを正規化しても元のPyQt6の計算と同じ回転になる
+    world = _random_world(500)
+    rotations = pos2vmd.positions_to_rotations(ps.world_points(world))
+    assert np.degrees(qt.angle_between(rotations, _baseline_rotations(world))).max() < 0.05
+
+def test_short_up_vectors_differ_from_the_baseline():
+    """behavior change: short up vectors are no longer treated as parallel to the bone
+
+    元の計算は上半身以外のupを正規化せずに fromDirection に渡していたので、upの長さが閾値
+    (sqrt(1e-5)) 以下になるほど関節位置が小さいと、曲げた腕や足もまっすぐ伸ばしたときと同じ向きになった。
+    現在はupを正規化するので、同じポーズを小さくしても回転は変わらない。
+    """
+    world = _world([_rest()])
+    small = _world([_rest() * 0.05])
+    baseline = _baseline_rotations(world)
+    baseline_small = _baseline_rotations(small)
+    changed = np.degrees(qt.angle_between(baseline, baseline_small))[0] > 1
+    # 正規化していた上半身は元から変わらず、腕と足は元の計算ではスケールで変わる
+    assert not changed[pos2vmd.BONE_NAMES.index('上半身')]
+    assert changed[[pos2vmd.BONE_NAMES.index(name) for name in ('左腕', '右腕', '左足', '右足')]].all()
+    for points in (world, small):
+        for rotations in (pos2vmd.positions_to_rotations(ps.world_points(points)), _qt_rotations(points)):
+            assert np.degrees(qt.angle_between(rotations, baseline)).max() < 0.05
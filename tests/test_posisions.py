@@ -0,0 +1,71 @@
+# test_posisions.py - smoothing filters at the frame rate of the timeline, and PoseSequence
+
+import numpy as np
+import pytest
+
+import posisions as ps
+
+def _sine(freq, fps, seconds=4):
+    t = np.arange(int(seconds * fps)) / fps
+    return np.broadcast_to(np.sin(2 * np.pi * freq * t)[:, None, None], (len(t), len(ps.NAMES), 3)).copy()
+
+def test_lowpass_cutoff_in_hz():
+    # 5Hzのカットオフより高い7Hzは60fpsでも除かれ、低い2Hzは残る
+    assert np.abs(ps.smooth_array(_sine(7, 60), 'lowpass', 60)).max() < 1e-6
+    assert np.abs(ps.smooth_array(_sine(2, 60), 'lowpass', 60)).max() > 0.9
+    # fpsを渡さないと30fpsとみなされ、7Hzが3.5Hzとして残ってしまう
+    assert np.abs(ps.smooth_array(_sine(7, 60), 'lowpass')).max() > 0.9
+
+def test_one_euro_uses_fps():
+    x = _sine(1, 60)
+    assert np.allclose(ps.smooth_array(x, 'oneeuro', 60), ps.one_euro_filter(x, freq=60))
+    assert not np.allclose(ps.smooth_array(x, 'oneeuro', 60), ps.smooth_array(x, 'oneeuro'))
+    # 間隔 dt を渡した場合は、そのサンプルだけ 1/dt の周波数で計算する
+    f, g = ps.OneEuroFilter(freq=60), ps.OneEuroFilter()
+    assert np.allclose(np.stack([f(p) for p in x]), np.stack([g(p, 1 / 60) for p in x]))
+
+def _landmarks(frames=5, seed=0):
+    rng = np.random.default_rng(seed)
+    world = rng.normal(size=(frames, len(ps.NAMES), 4)).astype(np.float32)
+    image = rng.random((frames, len(ps.NAMES), 4)).astype(np.float32)
+    return world, image
+
+def _vector(v):
+    return [v.x(), v.y(), v.z()]
+
+def test_pose_sequence_matches_positions():
+    pytest.importorskip('PyQt6.QtGui')
+    world, image = _landmarks()
+    sequence = ps.PoseSequence.from_arrays(world, image)
+    assert len(sequence) == 5 and sequence.valid().all()
+    np.testing.assert_array_equal(sequence.visibility, world[..., 3])
+    expected = ps.arrays_to_positions(world, image)
+    for positions, info in zip(sequence.to_positions_list(), expected):
+        assert list(positions['position']) == list(info['position'])
+        for name, v in info['position'].items():
+            np.testing.assert_allclose(_vector(positions['position'][name]), _vector(v), rtol=1e-6)
+        assert positions['extends'] == info['extends']
+    # 辞書の位置と同じ向き(yが上)
+    for positions, points in zip(expected, sequence.points):
+        np.testing.assert_allclose([_vector(positions['position'][n]) for n in ps.NAMES.values()], points,
+                                   rtol=1e-6)
+
+def test_convert_sequence():
+    pytest.importorskip('PyQt6.QtGui')
+    world, image = _landmarks(1)
+    pose_3d, pose_2d = [ps.array_to_landmarks(world[0])], [ps.array_to_landmarks(image[0])]
+    sequence = ps.convert_sequence(pose_3d, pose_2d)
+    positions = ps.convert(pose_3d, pose_2d)
+    assert sequence.to_positions_list()[0]['extends'] == positions['extends']
+    np.testing.assert_allclose(sequence.joint('left_hip')[0], _vector(positions['position']['left_hip']),
+                               rtol=1e-6)
+    assert len(ps.convert_sequence([], [])) == 0
+
+def test_pose_sequence_slices_and_missing_frames():
+    world, image = _landmarks()
+    world[2] = np.nan
+    sequence = ps.PoseSequence.from_arrays(world, image)
+    assert sequence.valid().tolist() == [True, True, False, True, True]
+    part = sequence[1:3]
+    assert len(part) == 2 and np.shares_memory(part.points, sequence.points)
+    np.testing.assert_array_equal(part.joint(ps.Joint.NOSE), sequence.points[1:3, 0])
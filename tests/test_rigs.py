@@ -0,0 +1,63 @@
+# test_rigs.py - rigs loaded from JSON files
+
+import json
+
+import numpy as np
+import pytest
+
+import pos2vmd
+import posisions as ps
+import rigs
+
+def _bone(name, parent, direction, up, rest_direction, rest_up):
+    return {'name': name, 'parent': parent, 'direction': list(direction), 'up': [list(v) for v in up],
+            'rest': [list(rest_direction), list(rest_up)]}
+
+def _write(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    return str(path)
+
+@pytest.fixture
+def mmd_json(tmp_path):
+    """JSON file of the same bones as the built-in mmd rig"""
+    return _write(tmp_path / 'mmd_copy.json',
+                  {'points': rigs.MMD_POINTS, 'bones': [_bone(*b) for b in rigs.MMD_BONES]})
+
+def test_json_rig_matches_builtin(mmd_json):
+    rig = rigs.get_rig(mmd_json)
+    mmd = rigs.get_rig('mmd')
+    assert rig.name == 'mmd_copy' and rig.names == mmd.names
+    for table in ('direction', 'up', 'landmarks', 'weights', 'parents', 'rest_directions', 'initial_inv'):
+        np.testing.assert_array_equal(getattr(rig, table), getattr(mmd, table), err_msg=table)
+    # 2回目はコンパイル済みのものを返す
+    assert rigs.get_rig(mmd_json) is rig
+    points = ps.world_points(np.random.default_rng(0).normal(size=(50, len(ps.NAMES), 4)))
+    np.testing.assert_array_equal(pos2vmd.positions_to_rotations(points, mmd_json),
+                                  pos2vmd.positions_to_rotations(points))
+
+def test_points_default_to_mmd(tmp_path):
+    path = _write(tmp_path / 'no_points.json', {'bones': [_bone(*b) for b in rigs.MMD_BONES]})
+    np.testing.assert_array_equal(rigs.load_rig(path).landmarks, rigs.get_rig('mmd').landmarks)
+
+@pytest.mark.parametrize('bones', [
+    [{'name': '上半身', 'direction': ['waist', 'neck'], 'up': [['waist', 'neck'], ['left_hip', 'right_hip']]}],
+    [{'name': '上半身', 'direction': ['waist', 'neck'], 'rest': [[0, 1, 0], [0, 0, 1]]}],
+    [_bone('上半身', None, ('waist', 'chin'), [('waist', 'neck'), ('left_hip', 'right_hip')], (0, 1, 0), (0, 0, 1))],
+    [_bone('上半身', None, ('waist',), [('waist', 'neck'), ('left_hip', 'right_hip')], (0, 1, 0), (0, 0, 1))],
+    [_bone('頭', '首', ('neck', 'nose'), [('neck', 'nose'), ('left_ear', 'right_ear')], (0, 1, 0), (1, 0, 0))],
+    [rigs.MMD_BONES[0], rigs.MMD_BONES[0]],
+    [_bone('上半身', None, ('waist', 'neck'), [('waist', 'neck'), ('left_hip', 'right_hip')], (0, 1, 0), ())],
+], ids=['no rest', 'no up', 'unknown point', 'bad vector', 'unknown parent', 'duplicate', 'bad rest'])
+def test_malformed_rigs(tmp_path, bones):
+    bones = [_bone(*b) if isinstance(b, tuple) else b for b in bones]
+    path = _write(tmp_path / 'bad.json', {'points': rigs.MMD_POINTS, 'bones': bones})
+    with pytest.raises(ValueError):
+        rigs.load_rig(path)
+
+def test_unknown_rig(tmp_path):
+    with pytest.raises(ValueError):
+        rigs.get_rig(str(tmp_path / 'missing.json'))
+    with pytest.raises(ValueError):
+        rigs.load_rig(_write(tmp_path / 'bad_points.json',
+                             {'points': {'neck': ['collarbone']}, 'bones': [_bone(*rigs.MMD_BONES[0])]}))
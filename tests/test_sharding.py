@@ -0,0 +1,37 @@
+# test_sharding.py - segments of a sharded run and the blending at their seams
+
+import numpy as np
+
+import sharding
+
+def _result(frame_nums, value):
+    frame_nums = np.array(frame_nums)
+    world = np.full((len(frame_nums), 33, 4), value, dtype=np.float32)
+    return frame_nums, world, world[..., :3] * 2
+
+def test_split_segments():
+    segments = sharding.split_segments(100, 3, 10)
+    assert segments == [(0, 0, 33), (23, 33, 66), (56, 66, 100)]
+    # 担当範囲 [owned, stop) はすき間も重なりもなく全フレームを覆う
+    owned = np.concatenate([np.arange(o, s) for _, o, s in segments])
+    assert owned.tolist() == list(range(100))
+    # 重なりは先頭を越えない
+    assert sharding.split_segments(100, 2, 80) == [(0, 0, 50), (0, 50, 100)]
+    # フレーム数より多いジョブは空のセグメントを作らない
+    assert sharding.split_segments(2, 4, 5) == [(0, 0, 1), (0, 1, 2)]
+
+def test_stitch_blends_the_seam():
+    segments = [(0, 0, 40), (30, 40, 80)]
+    # 後のセグメントは重なり部分の35フレームを検出できなかった
+    later = [f for f in range(30, 80) if f != 35]
+    frame_nums, world, image = sharding.stitch([_result(range(40), 0.0), _result(later, 1.0)], segments)
+    assert frame_nums.tolist() == list(range(80))
+    values = world[:, 0, 0]
+    assert (values[:30] == 0).all() and (values[40:] == 1).all()
+    # 片方でしか検出されていないフレームはそのまま
+    assert values[35] == 0
+    # 重なり部分では後のセグメントの重みが線形に増える
+    blended = [f for f in range(30, 40) if f != 35]
+    np.testing.assert_allclose(values[blended], (np.array(blended) - 29) / 11, rtol=1e-6)
+    assert 0 < values[30] < values[39] < 1
+    np.testing.assert_allclose(image[:, 0, 0], values * 2, rtol=1e-6)
@@ -0,0 +1,25 @@
+# test_timeline.py - per-frame timeline of the detections
+
+import numpy as np
+
+import timeline
+
+def test_runs_to_the_last_decoded_frame():
+    line = timeline.Timeline([0, 1, 3, 5], 30, stop=10)
+    assert line.frame_nums.tolist() == list(range(10))
+    assert np.flatnonzero(line.valid).tolist() == [0, 1, 3, 5]
+    # 最後のフレームにもキーフレームを打つ
+    assert np.flatnonzero(line.keys).tolist() == [0, 1, 3, 5, 9]
+    assert np.isnan(line.scatter(np.ones((4, 2)))[6:]).all()
+
+def test_stop_before_the_last_detection():
+    for stop in (None, 0, 3):
+        line = timeline.Timeline([2, 5], 30, stop=stop)
+        assert line.frame_nums.tolist() == list(range(6))
+        assert np.array_equal(line.keys, line.valid)
+
+def test_start_and_empty():
+    line = timeline.Timeline([4, 6], 30, 4, 8)
+    assert line.frame_nums.tolist() == [4, 5, 6, 7]
+    assert line.index.tolist() == [0, 2]
+    assert len(timeline.Timeline([], 30, stop=10)) == 0
@@ -0,0 +1,68 @@
+# test_tracking.py - assignment of the detected poses to per-person tracks
+
+import itertools
+
+import numpy as np
+
+import tracking
+
+def _pose(x, y, value=0.0):
+    """image and world landmarks (33, 4) of a person whose torso is at (x, y)"""
+    image = np.zeros((33, 4), dtype=np.float32)
+    image[:, :2] = x, y
+    world = np.full((33, 4), value, dtype=np.float32)
+    return world, image
+
+def _brute_force(cost):
+    n, m = cost.shape
+    if n > m:
+        rows, cols = _brute_force(cost.T)
+        return cols, rows
+    best = min(itertools.permutations(range(m), n), key=lambda cols: cost[range(n), cols].sum())
+    return list(range(n)), list(best)
+
+def test_assign():
+    rows, cols = tracking.assign([[4, 1, 3], [2, 0, 5], [3, 2, 2]])
+    assert rows.tolist() == [0, 1, 2] and cols.tolist() == [1, 0, 2]
+    rows, cols = tracking.assign(np.zeros((0, 3)))
+    assert len(rows) == len(cols) == 0
+
+def test_assign_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for shape in [(4, 4), (3, 5), (5, 3), (1, 4), (6, 6)]:
+        cost = rng.random(shape)
+        rows, cols = tracking.assign(cost)
+        expected_rows, expected_cols = _brute_force(cost)
+        assert len(rows) == min(shape) and len(set(cols.tolist())) == len(cols)
+        assert np.isclose(cost[rows, cols].sum(), cost[expected_rows, expected_cols].sum())
+
+def test_identity_through_crossing():
+    tracker = tracking.Tracker()
+    rng = np.random.default_rng(0)
+    for frame_num, x in enumerate(np.linspace(0.1, 0.9, 41)):
+        # 2人が左右から近づいてすれ違う (検出の順序は毎フレーム変わる)
+        poses = [_pose(x, 0.45, 0.0), _pose(1 - x, 0.55, 1.0)]
+        order = rng.permutation(2)
+        world = np.array([poses[i][0] for i in order])
+        image = np.array([poses[i][1] for i in order])
+        ids = tracker.update(frame_num, world, image)
+        assert sorted(ids) == [0, 1]
+    results = tracker.results()
+    assert len(results) == 2
+    for frame_nums, world, image in results:
+        assert frame_nums.tolist() == list(range(41))
+        # 同じ人物のランドマークだけが入っている
+        assert len(np.unique(world[:, 0, 0])) == 1
+        assert len(np.unique(image[:, 0, 1])) == 1
+        assert abs(image[-1, 0, 0] - image[0, 0, 0]) > 0.7
+
+def test_new_tracks():
+    tracker = tracking.Tracker(max_distance=0.2, max_missing=5)
+    assert tracker.update(0, *[a[None] for a in _pose(0.2, 0.5)]) == [0]
+    # 離れた位置に現れた人物は別のトラック
+    assert tracker.update(1, *[a[None] for a in _pose(0.8, 0.5)]) == [1]
+    assert tracker.update(3, *[a[None] for a in _pose(0.25, 0.5)]) == [0]
+    # max_missing より長く検出されなかったトラックは終了している
+    assert tracker.update(10, *[a[None] for a in _pose(0.25, 0.5)]) == [2]
+    assert [len(frame_nums) for frame_nums, _, _ in tracker.results()] == [2, 1, 1]
+    assert len(tracker.results(min_frames=2)) == 1
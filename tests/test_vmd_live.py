@@ -0,0 +1,38 @@
+# test_vmd_live.py - LiveConverter fed with results at irregular intervals (no camera or model required)
+
+import types
+import numpy as np
+import pytest
+
+pytest.importorskip('mediapipe')
+pytest.importorskip('cv2')
+
+import benchmark
+import posisions as ps
+import pos2vmd
+import vmd_live
+
+class _Sink():
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame_num, records):
+        self.frames.append((frame_num, records))
+
+def test_one_euro_uses_result_timestamps():
+    world, _ = benchmark.synthetic_landmarks(20, missing=0)
+    # 推定中のフレームが捨てられて、結果の間隔がばらつく
+    timestamps = np.cumsum([0, 33, 33, 100, 33, 167, 33, 66, 33, 33, 200, 33, 33, 33, 66, 33, 33, 33, 100, 33])
+    sink = _Sink()
+    converter = vmd_live.LiveConverter(sink)
+    for w, ts in zip(world, timestamps.tolist()):
+        result = types.SimpleNamespace(pose_world_landmarks=[ps.array_to_landmarks(w)])
+        converter.on_result(result, None, ts)
+
+    one_euro = ps.OneEuroFilter(vmd_live.VMD_FPS)
+    dts = [None] + (np.diff(timestamps) / 1000).tolist()
+    points = np.stack([one_euro(p, dt) for p, dt in zip(ps.world_points(world), dts)])
+    expected = pos2vmd.rotations_to_records(pos2vmd.positions_to_rotations(points), range(len(points)))
+    records = np.concatenate([records for _, records in sink.frames])
+    assert len(sink.frames) == len(world)
+    assert np.array_equal(records['rotation'], expected['rotation'])
@@ -0,0 +1,140 @@
+# test_vmd_mediapipe.py - conversions of recorded landmarks with the replay backend (no model required)
+
+import numpy as np
+import pytest
+
+import benchmark
+import estimators
+import foot_contact
+import landmark_cache
+import quaternions as qt
+import vmd_mediapipe as vm
+from VmdReader import VmdReader
+
+pytest.importorskip('PyQt6.QtGui')
+
+@pytest.fixture
+def recording(tmp_path):
+    """replay file of synthetic landmarks with missing frames"""
+    world, image = benchmark.synthetic_landmarks(300, missing=0.05)
+    valid = ~np.isnan(world).any(axis=(1, 2))
+    path = str(tmp_path / 'recording.npz')
+    landmark_cache.write_landmarks(path, np.flatnonzero(valid), world[valid], image[valid], 30, 16 / 9,
+                                   frame_count=len(world))
+    return path
+
+@pytest.fixture
+def trailing_gap(tmp_path):
+    """replay file of 300 frames where no pose is detected after frame 249"""
+    world, image = benchmark.synthetic_landmarks(250, missing=0)
+    path = str(tmp_path / 'trailing.npz')
+    landmark_cache.write_landmarks(path, np.arange(250), world, image, 30, 16 / 9, frame_count=300)
+    return path
+
+def _replay(recording):
+    return estimators.EstimatorSettings('replay', replay=recording)
+
+def _keyframes(path):
+    motion = VmdReader().read_vmd_file(path)
+    return {(name, int(frame)): np.array(rotation)
+            for name, frame, rotation in zip(motion.names, motion.frames, motion.rotations)}
+
+def test_stream_matches_offline(tmp_path, recording):
+    vm.vmd_convert('replay.mp4', str(tmp_path / 'offline.vmd'), estimator=_replay(recording))
+    vm.vmd_convert_stream('replay.mp4', str(tmp_path / 'stream.vmd'), estimator=_replay(recording))
+    offline = _keyframes(str(tmp_path / 'offline.vmd'))
+    stream = _keyframes(str(tmp_path / 'stream.vmd'))
+    # streamは補間したフレームにもキーフレームを打つ
+    assert set(offline) <= set(stream)
+    keys = sorted(offline)
+    angles = qt.angle_between(np.array([offline[k] for k in keys]), np.array([stream[k] for k in keys]))
+    assert np.degrees(angles).max() < 1e-3
+
+def test_reduced_keyframes_only_on_detected_frames(tmp_path, recording):
+    # 最後のフレームは長さを合わせるために常に残る
+    detected = set(np.load(recording)['frame_nums'].tolist()) | {299}
+    for fit_bezier in (False, True):
+        path = str(tmp_path / 'reduced.vmd')
+        vm.vmd_convert('replay.mp4', path, estimator=_replay(recording), reduce_tolerance=0.5,
+                       fit_bezier=fit_bezier)
+        frames = {frame for _, frame in _keyframes(path)}
+        assert frames and frames <= detected
+
+def test_motion_lasts_until_the_last_decoded_frame(tmp_path, trailing_gap):
+    for name, convert, options in (('offline', vm.vmd_convert, {}),
+                                   ('resample', vm.vmd_convert, {'resample': True}),
+                                   ('reduced', vm.vmd_convert, {'reduce_tolerance': 0.5, 'center_enabled': True}),
+                                   ('stream', vm.vmd_convert_stream, {})):
+        path = str(tmp_path / (name + '.vmd'))
+        convert('replay.mp4', path, estimator=_replay(trailing_gap), **options)
+        keys = _keyframes(path)
+        assert max(frame for _, frame in keys) == 299, name
+        # 検出できなくなった後は最後のポーズのまま
+        last = {bone: rotation for (bone, frame), rotation in keys.items() if frame == 299}
+        held = {bone: rotation for (bone, frame), rotation in keys.items() if frame == 249}
+        assert set(last) and set(last) <= set(held), name
+        for bone in last:
+            assert np.degrees(qt.angle_between(last[bone], held[bone])) < 1e-3, (name, bone)
+
+def test_cached_frame_count(tmp_path, trailing_gap, monkeypatch):
+    # キャッシュのキーに使うモデルのファイルの代わり
+    monkeypatch.setattr(vm, 'MODEL_PATH', trailing_gap)
+    cache = landmark_cache.LandmarkCache(str(tmp_path / 'cache'))
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'not a video')
+    stats = vm.PipelineStats()
+    vm.load_landmarks(str(video), stats=stats, landmarker=estimators.ReplayLandmarker(trailing_gap), cache=cache)
+    assert stats.info['cache'] == 'miss' and stats.info['frame_count'] == 300
+    stats = vm.PipelineStats()
+    vm.load_landmarks(str(video), stats=stats, cache=cache)
+    assert stats.info['cache'] == 'hit' and stats.info['frame_count'] == 300
+
+def test_foot_ik_uses_the_pnp_center(tmp_path):
+    world, _ = benchmark.synthetic_landmarks(120, missing=0)
+    path = str(tmp_path / 'projected.npz')
+    landmark_cache.write_landmarks(path, np.arange(120), world, benchmark.project_landmarks(world), 30, 16 / 9)
+    vmd = str(tmp_path / 'ik.vmd')
+    stats = vm.vmd_convert('replay.mp4', vmd, estimator=_replay(path), contact=foot_contact.ContactSettings())
+    # pnp のセンターを求めたときのみ焦点距離が記録される
+    assert 'focal' in stats.info
+    names = set(VmdReader().read_vmd_file(vmd).names)
+    assert {'センター', '左足ＩＫ', '右足ＩＫ'} <= names
+
+def test_foot_ik_rejects_the_2d_center(tmp_path):
+    assert vm.resolve_center_method(None) == '2d'
+    assert vm.resolve_center_method(None, foot_contact.ContactSettings()) == 'pnp'
+    vmd = str(tmp_path / 'ik.vmd')
+    with pytest.raises(ValueError):
+        vm.vmd_convert('missing.mp4', vmd, center_method='2d', contact=foot_contact.ContactSettings())
+    assert not (tmp_path / 'ik.vmd').exists()
+
+def test_stream_reduce(tmp_path, recording):
+    full = str(tmp_path / 'stream.vmd')
+    reduced = str(tmp_path / 'reduced.vmd')
+    vm.vmd_convert_stream('replay.mp4', full, estimator=_replay(recording))
+    stats = vm.vmd_convert_stream('replay.mp4', reduced, estimator=_replay(recording), reduce_tolerance=0.5,
+                                  chunk_size=64)
+    full_keys = _keyframes(full)
+    reduced_keys = _keyframes(reduced)
+    assert set(reduced_keys) < set(full_keys)
+    assert stats.info['kept'] == len(reduced_keys) and stats.info['max_error'] <= 0.5 + 1e-6
+    # チャンクの先頭と末尾のフレームは常に残る
+    frames = {frame for _, frame in reduced_keys}
+    assert {0, 63, 64, 299} <= frames
+
+def test_sharded_stats(tmp_path):
+    import cv2
+    video = str(tmp_path / 'video.avi')
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 30, (32, 18))
+    for _ in range(60):
+        writer.write(np.zeros((18, 32, 3), np.uint8))
+    writer.release()
+    world, image = benchmark.synthetic_landmarks(60, missing=0)
+    replay = str(tmp_path / 'recording.npz')
+    landmark_cache.write_landmarks(replay, np.arange(60), world, image, 30, 16 / 9, frame_count=60)
+    stats = vm.PipelineStats()
+    frame_nums, _, _ = vm.detect_landmarks_sharded(video, 2, overlap=10, stats=stats, estimator=_replay(replay))
+    assert frame_nums.tolist() == list(range(60))
+    # 各ワーカーの推定した回数を合算する (重ねた10フレームは両方で数える)
+    assert stats.stages['inference'].count == 70
+    assert stats.info['frame_count'] == 60
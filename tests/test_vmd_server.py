@@ -0,0 +1,147 @@
+# test_vmd_server.py - conversion jobs of recorded landmarks (replay, no model required)
+
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pytest
+
+import benchmark
+import landmark_cache
+import vmd_server
+from VmdReader import VmdReader
+
+pytest.importorskip('PyQt6.QtGui')
+
+class GatedService(vmd_server.ConversionService):
+    """ConversionService whose jobs start converting only after gate is set"""
+    def __init__(self, *args, **kwargs):
+        self.gate = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def _run(self, job):
+        self.gate.wait(30)
+        super()._run(job)
+
+@pytest.fixture
+def files(tmp_path):
+    """(input video, replay file) of a conversion with the replay backend"""
+    world, image = benchmark.synthetic_landmarks(60, missing=0)
+    replay = str(tmp_path / 'recording.npz')
+    landmark_cache.write_landmarks(replay, np.arange(60), world, image, 30, 16 / 9, frame_count=60)
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'not decoded by the replay backend')
+    return str(video), replay
+
+@pytest.fixture
+def service(tmp_path):
+    service = GatedService(max_jobs=1, max_queue=1, output_dir=str(tmp_path / 'out'), pool_size=0)
+    yield service
+    service.gate.set()
+    service.close()
+
+@pytest.fixture
+def server(service):
+    server = vmd_server.HTTPServer(('127.0.0.1', 0), service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _wait_state(job, state):
+    deadline = time.time() + 30
+    while job.state != state and time.time() < deadline:
+        time.sleep(0.01)
+    assert job.state == state
+
+def _post(server, path, body, content_type):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=30)
+    connection.request('POST', path, body, {'Content-Type': content_type})
+    response = connection.getresponse()
+    data = json.loads(response.read())
+    connection.close()
+    return response.status, response.getheader('Retry-After'), data
+
+def test_submit(service, files):
+    video, replay = files
+    service.gate.set()
+    job = service.submit(video, {'replay': replay, 'reduce': 0.5}, 'a.vmd')
+    assert job.done.wait(30) and job.state == vmd_server.DONE, job.error
+    assert job.output == os.path.join(os.path.realpath(service.output_dir), 'a.vmd')
+    motion = VmdReader().read_vmd_file(job.output)
+    assert len(motion.bone_frames) and motion.frames.max() == 59
+    assert job.to_dict()['frames'] == 60
+
+def test_cancel(service, files):
+    video, replay = files
+    running = service.submit(video, {'replay': replay})
+    _wait_state(running, vmd_server.RUNNING)
+    queued = service.submit(video, {'replay': replay})
+    assert service.cancel(queued.id) and queued.state == vmd_server.CANCELLED
+    assert service.cancel(running.id)
+    service.gate.set()
+    assert running.done.wait(30) and running.state == vmd_server.CANCELLED
+    assert not service.cancel(running.id)
+    assert not os.path.exists(running.output)
+    assert service.status()['cancelled'] == 2
+
+def test_queue_full(service, server, files):
+    video, replay = files
+    body = json.dumps({'input': video, 'options': {'replay': replay}})
+    status, _, running = _post(server, '/jobs', body, 'application/json')
+    assert status == 202
+    _wait_state(service.get(running['id']), vmd_server.RUNNING)
+    assert _post(server, '/jobs', body, 'application/json')[0] == 202
+    status, retry_after, _ = _post(server, '/jobs', body, 'application/json')
+    assert status == 429 and retry_after == '1'
+    assert service.status()['queued'] == 1
+
+def test_rejected_requests(service, server, files, tmp_path):
+    video, replay = files
+    options = {'replay': replay}
+    requests = [
+        # ブラウザがプリフライトなしで送れる Content-Type
+        (json.dumps({'input': video, 'options': options}), 'text/plain', 415),
+        ({'input': video, 'options': options, 'output': '../escaped.vmd'}, None, 400),
+        ({'input': video, 'options': options, 'output': str(tmp_path / 'escaped.vmd')}, None, 400),
+        ({'input': video, 'options': options, 'output': 'uploads/a.vmd'}, None, 400),
+        ({'input': str(tmp_path / 'missing.mp4'), 'options': options}, None, 400),
+        ({'input': str(tmp_path), 'options': options}, None, 400),
+        ({'input': video, 'options': {'replay': str(tmp_path)}}, None, 400),
+    ]
+    for body, content_type, expected in requests:
+        if content_type is None:
+            body, content_type = json.dumps(body), 'application/json'
+        assert _post(server, '/jobs', body, content_type)[0] == expected, body
+    assert not os.path.exists(tmp_path / 'escaped.vmd')
+    assert service.status()['queued'] == 0 and not service.jobs
+
+def test_upload_with_invalid_options(service, server, files):
+    video, replay = files
+    replay = urllib.parse.quote(replay)
+    with open(video, 'rb') as f:
+        data = f.read()
+    for query in ('reduce=oops', 'reduce="oops"', 'unknown=1'):
+        status, _, _ = _post(server, '/jobs?filename=a.mp4&replay=%s&%s' % (replay, query), data,
+                             'application/octet-stream')
+        assert status == 400, query
+    assert _post(server, '/jobs?filename=a.mp4&replay=' + replay, data, 'application/json')[0] == 415
+    assert os.listdir(service.upload_dir) == []
+    service.gate.set()
+    status, _, job = _post(server, '/jobs?filename=a.mp4&replay=' + replay, data, 'application/octet-stream')
+    assert status == 202
+    assert service.get(job['id']).done.wait(30) and service.get(job['id']).state == vmd_server.DONE
+    assert os.listdir(service.upload_dir) == []
+
+def test_foot_ik_options():
+    assert vmd_server.job_options({'foot_ik': True})['center_method'] == 'pnp'
+    assert vmd_server.job_options({'foot_ik': True, 'center_method': 'pnp'})['center_method'] == 'pnp'
+    assert vmd_server.job_options({})['center_method'] == '2d'
+    for options in ({'foot_ik': True, 'center_method': '2d'}, {'center_method': 'xyz'}):
+        with pytest.raises(ValueError):
+            vmd_server.job_options(options)